@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from catalog import LibraryCatalog
+from converter import (AudioConverter, ReplayGainBatch, ffmpeg_available, file_format, needs_conversion,
+                       outputs_by_track)
+from downloader import Downloader, detect_platform
+from journal import JOURNAL_CONVERTING, JOURNAL_DONE, JOURNAL_DOWNLOADED, JobJournal
+from metrics import Metrics, MetricsExporter
+from pipeline import ConversionPipeline
+from scheduler import DONE, FAILED, SKIPPED, DownloadJob, DownloadScheduler, parse_links, read_links_file
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRunner:
+    def __init__(self, config: dict, output_formats: Optional[List[str]] = None, token: Optional[str] = None):
+        self.config = config
+        self.output_formats = output_formats or []
+        self.metrics = Metrics()
+        self.metrics_exporter = MetricsExporter.from_config(self.metrics, config).start()
+        self.catalog = LibraryCatalog(config["library_db"], [config["output_dir"], config["converted_dir"]],
+                                      metrics=self.metrics)
+        self.converter = AudioConverter(config, on_evict=self.catalog.remove_many, metrics=self.metrics,
+                                        on_retag=self.catalog.add_many)
+        self.downloader = Downloader(config, self.converter, library=self.catalog, metrics=self.metrics)
+        self.downloader.yandex_token = token
+        self.output_lock = threading.Lock()
+        self.failed = 0
+        self.journal = JobJournal(config["library_db"], config["journal_flush_ms"] / 1000)
+        self.pipeline = ConversionPipeline(
+            self.converter,
+            on_result=self.on_converted,
+            workers=self.converter.worker_count(),
+            queue_size=config["pipeline_queue_size"],
+            metrics=self.metrics
+        )
+
+        self.scheduler = DownloadScheduler(
+            handlers={"spotify": self.run_spotify_job, "yandex": self.run_yandex_job},
+            max_workers=config["max_concurrent_downloads"],
+            platform_limits=config["platform_concurrency"],
+            on_update=self.report,
+            metrics=self.metrics
+        )
+
+    def run_spotify_job(self, job: DownloadJob) -> List[str]:
+        return self.finish(job, self.downloader.download_spotify_track(
+            job.url, on_skip=job.skipped.append, output_formats=self.output_formats,
+            on_fail=job.failed_tracks.append))
+
+    def run_yandex_job(self, job: DownloadJob) -> List[str]:
+        if self.output_formats and self.config["yandex_streaming"]:
+            files = self.downloader.run_yandex_download(job.url, self.output_formats, on_skip=job.skipped.append,
+                                                        on_fail=job.failed_tracks.append)
+            self.journal.finish_download(job.platform, job.url, files, to_convert=[])
+            for filepath in files:
+                output_format = os.path.splitext(filepath)[1].lstrip('.').lower()
+                self.emit(job.url, job.platform, DONE, filepath, None, output_format)
+            self.converter.apply_replaygain(outputs_by_track(files))
+            # Reported right here; with output formats set, report() only speaks up for failures.
+            return files
+        return self.finish(job, self.downloader.run_yandex_download(
+            job.url, on_skip=job.skipped.append, output_formats=self.output_formats,
+            on_fail=job.failed_tracks.append))
+
+    def finish(self, job: DownloadJob, files: List[str]) -> List[str]:
+        to_convert = [f for f in files if needs_conversion(f, self.output_formats)]
+        self.journal.finish_download(job.platform, job.url, files, to_convert)
+        # The job's tracks get their album gain once the last one is through conversion.
+        album = ReplayGainBatch(self.converter, len(files))
+        for filepath in files:
+            if filepath not in to_convert:
+                if self.output_formats:
+                    # Downloaded in the format asked for; no decode, no encode.
+                    self.emit(job.url, job.platform, DONE, filepath, filepath, file_format(filepath))
+                album.add(filepath, [filepath])
+        for filepath in to_convert:
+            # Conversion overlaps with the downloads still in flight; a full queue makes us wait.
+            self.pipeline.submit(filepath, self.output_formats, (job, album))
+        return files
+
+    def on_converted(self, source: str, outputs: Dict[str, str], context):
+        job, album = context
+        self.journal.finish_conversion(
+            job.platform, job.url, source, all(f in outputs for f in self.output_formats))
+        for output_format in self.output_formats:
+            if output_format in outputs:
+                self.emit(job.url, job.platform, DONE, outputs[output_format], source, output_format)
+            else:
+                self.emit(job.url, job.platform, FAILED, source_file=source, output_format=output_format,
+                          error="Conversion failed")
+        album.add(source, outputs.values())
+
+    def emit(self, url: str, platform: Optional[str], status: str, file: Optional[str] = None,
+             source_file: Optional[str] = None, output_format: Optional[str] = None,
+             error: Optional[str] = None):
+        if status == FAILED:
+            self.failed += 1
+        record = {
+            "url": url,
+            "platform": platform,
+            "status": status,
+            "file": file,
+            "source_file": source_file,
+            "format": output_format,
+            "error": error
+        }
+        # One JSON object per line, flushed right away, so pipes see results as they happen.
+        with self.output_lock:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+
+    def report(self, job: DownloadJob):
+        self.journal.on_job_update(job)
+        if job.state in (DONE, SKIPPED, FAILED):
+            # One line per lost track, so a partly failed album doesn't pass for a finished one.
+            for track in job.failed_tracks:
+                self.emit(job.url, job.platform, FAILED, error=f"Download failed: {track}")
+        if job.state == FAILED and not job.failed_tracks:
+            self.emit(job.url, job.platform, FAILED, error=job.error or "Nothing was downloaded")
+        elif job.state == DONE and not self.output_formats:
+            for filepath in job.files:
+                self.emit(job.url, job.platform, DONE, filepath, filepath,
+                          os.path.splitext(filepath)[1].lstrip('.').lower())
+        if job.state in (DONE, SKIPPED):
+            for filepath in job.skipped:
+                self.emit(job.url, job.platform, SKIPPED, filepath, filepath,
+                          os.path.splitext(filepath)[1].lstrip('.').lower())
+
+    def submit(self, platform: str, links: List[str]):
+        # Links left unfinished by an interrupted run carry on from where they stopped.
+        previous = {entry.url: entry for entry in self.journal.entries(platform, links)}
+        downloads = []
+        for link in links:
+            entry = previous.get(link)
+            if entry is None or entry.output_formats != self.output_formats or \
+                    not all(os.path.exists(f) for f in entry.files):
+                downloads.append(link)
+            elif entry.state == JOURNAL_DONE:
+                for filepath in entry.files:
+                    self.emit(link, platform, SKIPPED, filepath, filepath,
+                              os.path.splitext(filepath)[1].lstrip('.').lower())
+            elif entry.state in (JOURNAL_DOWNLOADED, JOURNAL_CONVERTING):
+                # Already downloaded; outputs that were finished come straight from the conversion cache.
+                job = DownloadJob(job_id=-1, platform=platform, url=link, state=DONE, files=entry.files)
+                self.finish(job, entry.files)
+            else:
+                downloads.append(link)
+
+        if len(downloads) < len(links):
+            logger.info(f"Resuming {len(links) - len(downloads)} {platform} links from an interrupted run")
+        self.journal.add(platform, downloads, self.output_formats)
+        self.scheduler.submit(platform, downloads)
+
+    def run(self, links) -> int:
+        by_platform = {}
+        for link in links:
+            platform = detect_platform(link)
+            if platform is None:
+                self.emit(link, None, FAILED, error="Unrecognised link")
+                continue
+            by_platform.setdefault(platform, []).append(link)
+
+        if "yandex" in by_platform and not self.downloader.yandex_token and not self.config["offline"]:
+            for link in by_platform.pop("yandex"):
+                self.emit(link, "yandex", FAILED, error="Yandex links need --token or YANDEX_MUSIC_TOKEN")
+
+        try:
+            # Brings the dedup index up to date with whatever changed on disk since last time.
+            self.catalog.rescan()
+            for platform, platform_links in by_platform.items():
+                self.submit(platform, platform_links)
+            while not self.scheduler.is_idle():
+                time.sleep(0.1)
+            self.pipeline.join()
+            # Everything made it, so there's nothing for a later run to resume.
+            self.journal.forget_finished()
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, the next run with these links picks up from here")
+            # Closed first, so the jobs dropped below stay unfinished in the journal.
+            self.journal.close()
+            self.scheduler.cancel_pending()
+            self.converter.cancel_conversions()
+            return 130
+        finally:
+            self.journal.close()
+            self.scheduler.shutdown()
+            self.pipeline.close()
+            self.downloader.close()
+            self.converter.close()
+            self.catalog.close()
+            self.metrics_exporter.close()
+
+        return 1 if self.failed else 0
+
+
+def run_batch(links_path: str, config: dict, output_formats: Optional[List[str]] = None,
+              token: Optional[str] = None) -> int:
+    output_formats = output_formats or []
+    for output_format in output_formats:
+        if output_format not in config["supported_formats"]:
+            logger.error(f"Unsupported format: {output_format}. Pick from {', '.join(config['supported_formats'])}")
+            return 2
+
+    # Only bother FFmpeg if we actually have something for it to do.
+    if output_formats and not ffmpeg_available():
+        logger.error("FFmpeg is not installed or not found in PATH.")
+        return 2
+
+    try:
+        links = parse_links(sys.stdin.read()) if links_path == "-" else read_links_file(links_path)
+    except (OSError, UnicodeDecodeError) as e:
+        logger.error(f"Error reading links file {links_path}: {e}")
+        return 2
+
+    token = token or os.environ.get("YANDEX_MUSIC_TOKEN")
+    return BatchRunner(config, output_formats, token).run(links)
@@ -0,0 +1,155 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from bench.fixtures import synthesize
+from bench.workloads import WORKLOADS
+from bench.yandex_stub import YandexStub, make_certificate
+
+logger = logging.getLogger("bench")
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+FAKE_SPOTDL = Path(__file__).resolve().parent / "fake_spotdl"
+COLUMNS = ("tracks_per_sec", "p50_ms", "p95_ms", "cpu_percent", "peak_rss_mb")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_workload(name: str, size: int, workdir: str, options: dict, env: dict) -> Optional[dict]:
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, "bench.log"), "w") as log:
+        process = subprocess.run(
+            [sys.executable, "-m", "bench.workloads", name, str(size), workdir, json.dumps(options)],
+            cwd=REPO_ROOT, env=env, stdout=subprocess.PIPE, stderr=log, text=True
+        )
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        logger.error(f"{name} x{size} failed (exit {process.returncode}), see {workdir}/bench.log")
+        return None
+    return json.loads(lines[-1])
+
+
+def format_value(value) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_table(results: List[dict], baseline: Dict[tuple, dict]):
+    header = f"{'workload':<10}{'size':>7}" + "".join(f"{column:>16}" for column in COLUMNS)
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        before = baseline.get((result["workload"], result["size"]), {})
+        cells = []
+        for column in COLUMNS:
+            cell = format_value(result.get(column))
+            if before.get(column) and result.get(column) is not None:
+                cell += f" ({(result[column] / before[column] - 1) * 100:+.0f}%)"
+            cells.append(f"{cell:>16}")
+        print(f"{result['workload']:<10}{result['size']:>7}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m bench",
+        description="Offline benchmarks for downloading, converting and listing the library."
+    )
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help=f"comma-separated, from: {', '.join(WORKLOADS)}")
+    parser.add_argument("--sizes", default="10,100,1000", help="track counts, e.g. 10,100,1000,10000")
+    parser.add_argument("--output", default="bench-results.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--fixture-seconds", type=float, default=5, help="length of the synthesized audio")
+    parser.add_argument("--formats", default="", help="target formats for the download workloads, e.g. m4a")
+    parser.add_argument("--convert-format", default="flac", help="target format for the convert workload")
+    parser.add_argument("--stub-delay-ms", type=float, default=0, help="added latency per Yandex stub request")
+    parser.add_argument("--stub-throttle", type=float, default=0,
+                        help="share of Yandex stub requests answered with 429, e.g. 0.05")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    workloads = [name.strip() for name in args.workloads.split(",") if name.strip()]
+    unknown = [name for name in workloads if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(unknown)}")
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    if not shutil.which("ffmpeg"):
+        logger.error("ffmpeg is needed for the audio fixtures and the convert workload")
+        return 2
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(r["workload"], r["size"]): r for r in json.load(f)["results"]}
+
+    root = tempfile.mkdtemp(prefix="music-bench-")
+    stub = None
+    try:
+        fixtures = synthesize(os.path.join(root, "fixtures"), args.fixture_seconds)
+        env = dict(os.environ)
+        # The fake spotdl shadows a real one, in the worker processes too.
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [str(FAKE_SPOTDL), str(REPO_ROOT), os.environ.get("PYTHONPATH")]))
+        env["BENCH_FIXTURES"] = fixtures
+        options = {
+            "fixtures": fixtures,
+            "formats": [fmt for fmt in args.formats.split(",") if fmt],
+            "convert_format": args.convert_format,
+        }
+        if "yandex" in workloads:
+            cert, key = make_certificate(root)
+            env["SSL_CERT_FILE"] = cert
+            stub = YandexStub(fixtures, cert, key, args.stub_delay_ms, args.stub_throttle).start()
+            options["yandex_api_url"] = stub.api_url
+
+        results = []
+        for name in workloads:
+            for size in sizes:
+                logger.info(f"Running {name} x{size}...")
+                result = run_workload(name, size, os.path.join(root, f"{name}-{size}"), options, env)
+                if result:
+                    results.append(result)
+
+        print_table(results, baseline)
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "args": vars(args),
+                },
+                "results": results
+            }, f, indent=2)
+        logger.info(f"Results saved to {args.output}")
+        return 0 if len(results) == len(workloads) * len(sizes) else 1
+    finally:
+        if stub:
+            if stub.throttled:
+                logger.info(f"The Yandex stub answered {stub.throttled} requests with 429")
+            stub.stop()
+        if args.keep:
+            logger.info(f"Working directory kept at {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# A stand-in for spotdl with the same surface spotdl_worker.py uses. Songs come from
+# "https://open.spotify.com/playlist/<n>" (n songs), files are copies of the synthesized
+# fixtures in $BENCH_FIXTURES, and the delays below stand in for the network and encoder.
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ARTIST = "Bench Artist"
+STARTUP_SECONDS = float(os.environ.get("BENCH_SPOTDL_STARTUP_MS", "200")) / 1000
+SEARCH_SECONDS = float(os.environ.get("BENCH_SPOTDL_SEARCH_MS", "50")) / 1000
+SONG_SECONDS = float(os.environ.get("BENCH_SPOTDL_SONG_MS", "100")) / 1000
+
+
+class Song:
+    def __init__(self, playlist: str, index: int, download_url=None):
+        self.playlist = playlist
+        self.index = index
+        self.name = f"Track {index}"
+        self.artist = ARTIST
+        self.artists = [ARTIST]
+        self.duration = 180 + index % 60
+        self.song_id = f"{playlist}-{index}"
+        self.display_name = f"{ARTIST} - {self.name}"
+        self.download_url = download_url
+
+    @property
+    def json(self) -> dict:
+        return {
+            "name": self.name, "artist": self.artist, "artists": self.artists, "duration": self.duration,
+            "song_id": self.song_id, "display_name": self.display_name, "download_url": self.download_url,
+            "playlist": self.playlist, "index": self.index,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Song":
+        return cls(data["playlist"], data["index"], data.get("download_url"))
+
+
+class ProgressHandler:
+    update_callback = None
+
+
+class Tracker:
+    def __init__(self, song: Song):
+        self.song = song
+        self.progress = 0
+
+
+class Downloader:
+    def __init__(self, settings: dict):
+        self.settings = dict(settings)
+        self.progress_handler = ProgressHandler()
+
+    def report(self, tracker: Tracker, progress: int, message: str):
+        tracker.progress = progress
+        if self.progress_handler.update_callback:
+            self.progress_handler.update_callback(tracker, message)
+
+    def download_song(self, song: Song):
+        tracker = Tracker(song)
+        self.report(tracker, 0, "Downloading")
+        if not song.download_url:
+            # The audio-source search that cached songs get to skip.
+            time.sleep(SEARCH_SECONDS)
+            song.download_url = f"https://youtube.invalid/watch?v={song.song_id}"
+        time.sleep(SONG_SECONDS / 2)
+        self.report(tracker, 50, "Converting")
+        time.sleep(SONG_SECONDS / 2)
+
+        extension = self.settings["format"]
+        output = (self.settings["output"]
+                  .replace("{artists}", song.artist)
+                  .replace("{title}", song.name)
+                  .replace("{output-ext}", extension))
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        shutil.copyfile(os.path.join(os.environ["BENCH_FIXTURES"], f"fixture.{extension}"), output)
+        self.report(tracker, 100, "Done")
+        return song, output
+
+
+class Spotdl:
+    def __init__(self, client_id, client_secret, headless=False, downloader_settings=None, **kwargs):
+        # The real one spends this importing its dependencies and logging in to Spotify.
+        time.sleep(STARTUP_SECONDS)
+        self.downloader = Downloader(downloader_settings or {})
+
+    def search(self, queries):
+        time.sleep(SEARCH_SECONDS)
+        songs = []
+        for query in queries:
+            match = re.search(r"playlist/(\d+)", query)
+            count = int(match.group(1)) if match else 1
+            songs.extend(Song(f"bench{count}", index) for index in range(1, count + 1))
+        return songs
+
+    def download_songs(self, songs):
+        with ThreadPoolExecutor(max_workers=int(self.downloader.settings.get("threads") or 1)) as executor:
+            return list(executor.map(self.downloader.download_song, songs))
@@ -0,0 +1,3 @@
+from spotdl import Song
+
+__all__ = ["Song"]
@@ -0,0 +1 @@
+DEFAULT_CONFIG = {"client_id": "bench", "client_secret": "bench"}
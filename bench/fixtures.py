@@ -0,0 +1,35 @@
+import logging
+import os
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+# What each service hands over, so the fakes can serve the real thing: Yandex's MP3 and ADTS AAC,
+# plus everything spotdl can be asked to write.
+FIXTURE_FORMATS = {
+    "mp3": ["-b:a", "320k"],
+    "aac": ["-c:a", "aac", "-b:a", "256k", "-f", "adts"],
+    "m4a": ["-c:a", "aac", "-b:a", "256k"],
+    "flac": [],
+    "wav": [],
+}
+
+
+def synthesize(directory: str, seconds: float) -> str:
+    # A stereo tone from ffmpeg's lavfi sources: no audio files in the repo, same bytes on every machine.
+    # Returns the folder holding fixture.<format> for every format above.
+    directory = os.path.join(directory, f"tone-{seconds:g}s")
+    os.makedirs(directory, exist_ok=True)
+    for fmt, args in FIXTURE_FORMATS.items():
+        path = os.path.join(directory, f"fixture.{fmt}")
+        if not os.path.exists(path):
+            logger.info(f"Synthesizing {path}")
+            subprocess.run(
+                ["ffmpeg", "-y", "-loglevel", "error",
+                 "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={seconds:g}",
+                 "-f", "lavfi", "-i", f"sine=frequency=660:sample_rate=44100:duration={seconds:g}",
+                 "-filter_complex", "[0:a][1:a]join=inputs=2:channel_layout=stereo",
+                 *args, path],
+                check=True
+            )
+    return directory
@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Windows: wall-clock numbers only.
+    resource = None
+
+from catalog import LibraryCatalog
+from converter import AudioConverter
+from metrics import Metrics
+from progress import DOWNLOAD, ProgressEvent
+from settings import DEFAULT_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Each workload runs in a fresh interpreter (python -m bench.workloads <name> <size> <workdir> <options>),
+# so peak RSS and CPU belong to that workload alone. The result is the last line on stdout.
+
+
+class Recorder:
+    # Sits where the GUI's ProgressBus would, but keeps timings instead of coalescing them away.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first: Dict[str, float] = {}
+        self.last: Dict[str, float] = {}
+
+    def publish(self, event: ProgressEvent):
+        if event.stage != DOWNLOAD:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            self.first.setdefault(event.item, now)
+            if event.percent is not None and event.percent >= 100:
+                self.last[event.item] = now
+
+    def status(self, message: str):
+        pass
+
+    def latencies(self) -> List[float]:
+        # From a track's first progress report to its last.
+        return [self.last[item] - self.first[item] for item in self.last]
+
+
+class Measure:
+    def __enter__(self):
+        self.seconds = None
+        self.cpu_start = cpu_seconds()
+        self.start = time.perf_counter()
+        return self
+
+    def stop_clock(self):
+        # Wall time ends here; CPU keeps counting until the block exits, so worker processes
+        # shut down inside it are reaped and their CPU time lands in RUSAGE_CHILDREN.
+        self.seconds = time.perf_counter() - self.start
+
+    def __exit__(self, *exc):
+        if self.seconds is None:
+            self.stop_clock()
+        self.cpu = None if self.cpu_start is None else cpu_seconds() - self.cpu_start
+
+
+def cpu_seconds() -> Optional[float]:
+    if resource is None:
+        return None
+    # Children count too: spotdl workers and ffmpeg do most of the work in some workloads.
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    )
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile_ms(samples: List[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))] * 1000
+
+
+def bench_config(workdir: str, options: dict) -> dict:
+    config = dict(DEFAULT_CONFIG)
+    config.update(
+        output_dir=os.path.join(workdir, "downloads"),
+        converted_dir=os.path.join(workdir, "converted"),
+        library_db=os.path.join(workdir, "library.db"),
+    )
+    config.update(options.get("config", {}))
+    os.makedirs(config["output_dir"], exist_ok=True)
+    return config
+
+
+def stage_breakdown(metrics: Metrics) -> dict:
+    # Mean milliseconds per stage, from the same spans the app exports.
+    return {stage: stats["mean_seconds"] * 1000 for stage, stats in metrics.snapshot()["stages"].items()}
+
+
+def copy_fixture(fixtures: str, fmt: str, directory: str, size: int) -> List[str]:
+    source = os.path.join(fixtures, f"fixture.{fmt}")
+    paths = []
+    for index in range(1, size + 1):
+        path = os.path.join(directory, f"Bench Artist - Track {index}.{fmt}")
+        shutil.copyfile(source, path)
+        paths.append(path)
+    return paths
+
+
+def spotify_download(size: int, config: dict, options: dict):
+    from downloader import Downloader
+
+    metrics = Metrics()
+    catalog = LibraryCatalog(config["library_db"], [config["output_dir"], config["converted_dir"]], metrics=metrics)
+    converter = AudioConverter(config, metrics=metrics)
+    recorder = Recorder()
+    downloader = Downloader(config, converter, progress=recorder, library=catalog, metrics=metrics)
+    try:
+        with Measure() as measure:
+            files = downloader.download_spotify_track(
+                f"https://open.spotify.com/playlist/{size}", output_formats=options.get("formats"))
+            measure.stop_clock()
+            # Inside the block, so the spotdl workers are reaped and their CPU time counted.
+            downloader.close()
+    finally:
+        converter.close()
+        catalog.close()
+    return len(files), measure, recorder.latencies(), {"stages_ms": stage_breakdown(metrics)}
+
+
+def yandex_download(size: int, config: dict, options: dict):
+    from downloader import Downloader, make_pooled_request
+
+    metrics = Metrics()
+    catalog = LibraryCatalog(config["library_db"], [config["output_dir"], config["converted_dir"]], metrics=metrics)
+    converter = AudioConverter(config, metrics=metrics)
+    recorder = Recorder()
+    downloader = Downloader(config, converter, progress=recorder, library=catalog, metrics=metrics)
+    downloader.yandex_token = "bench"
+
+    async def connect_to_stub():
+        from yandex_music import ClientAsync
+
+        await downloader.ensure_http_session()
+        downloader.yandex_client = ClientAsync(
+            "bench", base_url=options["yandex_api_url"], request=make_pooled_request(downloader.http_connector, downloader.yandex_api))
+        downloader.yandex_client_token = "bench"
+
+    try:
+        downloader.get_loop_thread().run(connect_to_stub())
+        with Measure() as measure:
+            files = downloader.run_yandex_download(
+                f"https://music.yandex.ru/users/bench/playlists/{size}", output_formats=options.get("formats"))
+    finally:
+        downloader.close()
+        converter.close()
+        catalog.close()
+    return len(files), measure, recorder.latencies(), {"stages_ms": stage_breakdown(metrics)}
+
+
+def convert(size: int, config: dict, options: dict):
+    sources = copy_fixture(options["fixtures"], "mp3", config["output_dir"], size)
+    converter = AudioConverter(config)
+    target = options.get("convert_format", "flac")
+    latencies = []
+
+    def convert_one(path: str) -> bool:
+        start = time.perf_counter()
+        converted = bool(converter.convert_audio(path, target))
+        latencies.append(time.perf_counter() - start)
+        return converted
+
+    # The same fan-out as the convert dialog: one ffmpeg per worker, results as they finish.
+    try:
+        with Measure() as measure:
+            with ThreadPoolExecutor(max_workers=converter.worker_count()) as executor:
+                converted = sum(executor.map(convert_one, sources))
+    finally:
+        converter.close()
+    return converted, measure, latencies, {"format": target, "workers": converter.worker_count()}
+
+
+def library_refresh(size: int, config: dict, options: dict):
+    from song_list import SongIndex
+
+    copy_fixture(options["fixtures"], "mp3", config["output_dir"], size)
+    catalog = LibraryCatalog(config["library_db"], [config["output_dir"], config["converted_dir"]])
+    extra = {}
+    try:
+        with Measure() as scan:
+            catalog.rescan()
+        extra["cold_scan_ms"] = scan.seconds * 1000
+
+        # What the song list does on startup: everything from the catalog into the search index.
+        latencies = []
+        with Measure() as measure:
+            for _ in range(int(options.get("repeats", 5))):
+                start = time.perf_counter()
+                index = SongIndex(catalog.sort_key)
+                index.set_tracks(catalog.list_tracks())
+                latencies.append(time.perf_counter() - start)
+
+        # A batch finishing: one new file, picked up by a rescan and slotted into the list.
+        catalog.on_change = lambda added, removed: index.add_many(added)
+        os.makedirs(config["converted_dir"], exist_ok=True)
+        new_file = copy_fixture(options["fixtures"], "mp3", config["converted_dir"], 1)[0]
+        start = time.perf_counter()
+        catalog.rescan()
+        extra["incremental_ms"] = (time.perf_counter() - start) * 1000
+        os.remove(new_file)
+
+        start = time.perf_counter()
+        index.set_query("track 1")
+        index.step(float("inf"))
+        extra["search_ms"] = (time.perf_counter() - start) * 1000
+        extra["search_matches"] = len(index.matches)
+    finally:
+        catalog.close()
+    # Throughput here is tracks loaded per second of a full list refresh.
+    return size * len(latencies), measure, latencies, extra
+
+
+WORKLOADS = {
+    "spotify": spotify_download,
+    "yandex": yandex_download,
+    "convert": convert,
+    "library": library_refresh,
+}
+
+
+def run(name: str, size: int, workdir: str, options: dict) -> dict:
+    config = bench_config(workdir, options)
+    tracks, measure, latencies, extra = WORKLOADS[name](size, config, options)
+    return {
+        "workload": name,
+        "size": size,
+        "tracks": tracks,
+        "seconds": measure.seconds,
+        "tracks_per_sec": tracks / measure.seconds if measure.seconds else None,
+        "p50_ms": percentile_ms(latencies, 0.50),
+        "p95_ms": percentile_ms(latencies, 0.95),
+        "cpu_seconds": measure.cpu,
+        "cpu_percent": measure.cpu / measure.seconds * 100 if measure.cpu is not None and measure.seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "extra": extra,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    name, size, workdir, options = sys.argv[1], int(sys.argv[2]), sys.argv[3], json.loads(sys.argv[4])
+    print(json.dumps(run(name, size, workdir, options)))
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import random
+import re
+import ssl
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+ARTIST = "Bench Artist"
+
+
+def make_certificate(directory: str) -> tuple:
+    # yandex_music always builds https:// file links, so the stand-in CDN needs a certificate.
+    # Trusted by pointing SSL_CERT_FILE at it in the process being measured.
+    cert = os.path.join(directory, "stub-cert.pem")
+    key = os.path.join(directory, "stub-key.pem")
+    if not os.path.exists(cert):
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+             "-keyout", key, "-out", cert, "-subj", "/CN=127.0.0.1",
+             "-addext", "subjectAltName=IP:127.0.0.1"],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    return cert, key
+
+
+def track_json(track_id: int) -> dict:
+    return {
+        "id": str(track_id),
+        "title": f"Track {track_id}",
+        "artists": [{"id": 1, "name": ARTIST}],
+        "albums": [{"id": 1, "title": "Bench Album"}],
+        "durationMs": 10000 + track_id,
+        "available": True,
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API and CDN, so connection pooling shows up in the numbers.
+    protocol_version = "HTTP/1.1"
+    stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200, headers: Dict[str, str] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, result):
+        self.send_body(json.dumps({"result": result}).encode("utf-8"), "application/json")
+
+    def throttle(self) -> bool:
+        # Some share of requests bounce with a 429, to exercise the rate limiter and retries.
+        if not self.stub.should_throttle():
+            return False
+        self.send_body(b'{"error": {"name": "too-many-requests", "message": "Too many requests"}}',
+                       "application/json", 429, {"Retry-After": "1"})
+        return True
+
+    def do_GET(self):
+        self.stub.delay()
+        if self.throttle():
+            return
+        path = urlparse(self.path).path
+
+        match = re.fullmatch(r"/users/([^/]+)/playlists/(\d+)", path)
+        if match:
+            # Short entries only, the way big playlists come back; the client fetches the rest in bulk.
+            count = int(match.group(2))
+            self.send_json({
+                "owner": {"uid": 1, "login": match.group(1)},
+                "cover": None, "madeFor": None, "playCounter": None, "playlistAbsence": None,
+                "uid": 1, "kind": count, "title": f"Bench {count}", "trackCount": count, "revision": 1,
+                "tracks": [{"id": str(i), "albumId": "1", "timestamp": "2024-01-01T00:00:00+00:00"}
+                           for i in range(1, count + 1)],
+            })
+            return
+
+        # Tracks ask for their info as "<track>:<album>".
+        match = re.fullmatch(r"/tracks/(\d+)(?::\d+)?/download-info", path)
+        if match:
+            track_id = match.group(1)
+            self.send_json([
+                {"codec": codec, "bitrateInKbps": bitrate, "gain": False, "preview": False, "direct": False,
+                 "downloadInfoUrl": f"{self.stub.api_url}/download-info/{track_id}/{codec}"}
+                for codec, bitrate in (("mp3", 320), ("mp3", 192), ("aac", 256), ("aac", 64))
+            ])
+            return
+
+        match = re.fullmatch(r"/download-info/(\d+)/(\w+)", path)
+        if match:
+            track_id, codec = match.groups()
+            xml = (f"<?xml version=\"1.0\" encoding=\"utf-8\"?><download-info>"
+                   f"<host>{self.stub.cdn_host}</host><path>/{codec}/{track_id}</path>"
+                   f"<ts>0001</ts><region>-1</region><s>bench</s></download-info>")
+            self.send_body(xml.encode("utf-8"), "text/xml")
+            return
+
+        match = re.fullmatch(r"/get-mp3/[^/]+/[^/]+/(\w+)/(\d+)", path)
+        if match:
+            self.send_file(self.stub.files[match.group(1)])
+            return
+
+        self.send_body(b'{"error": "not found"}', "application/json", 404)
+
+    def do_POST(self):
+        self.stub.delay()
+        if self.throttle():
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        if urlparse(self.path).path == "/tracks":
+            ids = [i for value in form.get("track-ids", []) for i in value.split(",") if i]
+            self.send_json([track_json(int(i.split(":")[0])) for i in ids])
+            return
+        self.send_body(b'{"error": "not found"}', "application/json", 404)
+
+    def send_file(self, data: bytes):
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if not match:
+            self.send_body(data, "audio/mpeg")
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2)), len(data) - 1) if match.group(2) else len(data) - 1
+        if start >= len(data):
+            self.send_body(b"", "audio/mpeg", 416, {"Content-Range": f"bytes */{len(data)}"})
+            return
+        self.send_body(data[start:end + 1], "audio/mpeg", 206, {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+
+
+class YandexStub:
+    # The Yandex API on plain HTTP and the file CDN on HTTPS, both on localhost.
+    # Playlist /users/bench/playlists/<n> has tracks 1..n.
+    def __init__(self, fixtures: str, cert: str, key: str, delay_ms: float = 0, throttle: float = 0):
+        self.files = {}
+        for codec in ("mp3", "aac"):
+            with open(os.path.join(fixtures, f"fixture.{codec}"), "rb") as f:
+                self.files[codec] = f.read()
+        self.delay_seconds = delay_ms / 1000
+        self.throttle = throttle
+        self.throttled = 0
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        handler = type("Handler", (StubHandler,), {"stub": self})
+
+        self.api = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.cdn = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.cdn.socket = context.wrap_socket(self.cdn.socket, server_side=True)
+        for server in (self.api, self.cdn):
+            server.daemon_threads = True
+
+        self.api_url = f"http://127.0.0.1:{self.api.server_address[1]}"
+        self.cdn_host = f"127.0.0.1:{self.cdn.server_address[1]}"
+        self.threads = [
+            threading.Thread(target=server.serve_forever, name="yandex-stub", daemon=True)
+            for server in (self.api, self.cdn)
+        ]
+
+    def delay(self):
+        # Stands in for the round trip to a real server.
+        if self.delay_seconds:
+            time.sleep(self.delay_seconds)
+
+    def should_throttle(self) -> bool:
+        with self.lock:
+            if self.throttle and self.random.random() < self.throttle:
+                self.throttled += 1
+                return True
+            return False
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        for server in (self.api, self.cdn):
+            server.shutdown()
+            server.server_close()
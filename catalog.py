@@ -0,0 +1,288 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import mutagen
+except ImportError:
+    # Comes along with spotdl, but the catalog still works on file names alone without it.
+    mutagen = None
+
+from metrics import SPAN_CATALOG, Metrics
+
+logger = logging.getLogger(__name__)
+
+# Downloads still in flight (http_download's .part and .partN files and their .meta), not tracks yet.
+PARTIAL_DOWNLOAD = re.compile(r"\.part\d*(\.meta)?$", re.IGNORECASE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    format TEXT NOT NULL,
+    duration REAL,
+    artist TEXT,
+    title TEXT,
+    album TEXT,
+    match_key TEXT
+);
+CREATE INDEX IF NOT EXISTS tracks_root ON tracks (root, name);
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    source_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (source_id, path)
+);
+"""
+
+TRACK_COLUMNS = "path, root, name, size, mtime, format, duration, artist, title, album"
+
+# Featured artists, remaster notes and the like differ between services for the same recording.
+NOISE = re.compile(
+    r"[(\[][^)\]]*(feat|ft\.|with|remaster|version|edit)[^)\]]*[)\]]"
+    r"|\s-\s[^-]*(remaster|version|edit)[^-]*$"
+    r"|\s(feat|ft)\.?\s.*$"
+)
+
+
+@dataclass
+class Track:
+    path: str
+    root: str
+    name: str
+    size: int
+    mtime: float
+    format: str
+    duration: Optional[float] = None
+    artist: Optional[str] = None
+    title: Optional[str] = None
+    album: Optional[str] = None
+
+
+def read_track(path: str, root: str, stat: Optional[os.stat_result] = None) -> Track:
+    stat = stat or os.stat(path)
+    name = os.path.basename(path)
+    stem, _, extension = name.rpartition('.')
+    track = Track(
+        path=path,
+        root=root,
+        name=name,
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        format=extension.lower() if stem else ""
+    )
+
+    if mutagen is not None:
+        try:
+            audio = mutagen.File(path, easy=True)
+            if audio is not None:
+                track.duration = getattr(audio.info, "length", None)
+                tags = audio.tags or {}
+                track.artist = (tags.get("artist") or [None])[0]
+                track.title = (tags.get("title") or [None])[0]
+                track.album = (tags.get("album") or [None])[0]
+        except Exception as e:
+            logger.debug(f"Could not read tags from {path}: {e}")
+
+    # Both downloaders name files "Artist - Title", which is a decent fallback.
+    if not track.title and " - " in (stem or name):
+        track.artist, track.title = (stem or name).split(" - ", 1)
+    return track
+
+
+def match_key(artist: Optional[str], title: Optional[str]) -> Optional[str]:
+    if not artist or not title:
+        return None
+
+    def normalize(text: str) -> str:
+        text = unicodedata.normalize("NFKD", text.casefold())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        text = NOISE.sub(" ", text)
+        return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+    # spotdl writes every artist ("A, B"), Yandex only the first; the first one is what both agree on.
+    first_artist = re.split(r",|&|\bfeat\b|\bft\b", artist.casefold())[0]
+    artist_key, title_key = normalize(first_artist), normalize(title)
+    return f"{artist_key}|{title_key}" if artist_key and title_key else None
+
+
+class LibraryCatalog:
+    def __init__(self, db_path: str, roots: Iterable[str],
+                 on_change: Optional[Callable[[List[Track], List[str]], None]] = None,
+                 metrics: Optional[Metrics] = None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.root_order = {root: index for index, root in enumerate(self.roots)}
+        # Told about every batch of (added or changed tracks, removed paths), so views can update
+        # in place instead of re-reading the whole library.
+        self.on_change = on_change
+        self.metrics = metrics or Metrics()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(tracks)")}
+        if "match_key" not in columns:
+            # A library.db from before the dedup lookup.
+            with self.db:
+                self.db.execute("ALTER TABLE tracks ADD COLUMN match_key TEXT")
+                rows = self.db.execute("SELECT path, artist, title FROM tracks").fetchall()
+                self.db.executemany(
+                    "UPDATE tracks SET match_key = ? WHERE path = ?",
+                    [(match_key(artist, title), path) for path, artist, title in rows]
+                )
+        # Not in SCHEMA: on an old database the column doesn't exist until the ALTER above.
+        self.db.execute("CREATE INDEX IF NOT EXISTS tracks_match_key ON tracks (match_key)")
+
+    def sort_key(self, track: Track) -> tuple:
+        return self.root_order.get(track.root, len(self.root_order)), track.root, track.name
+
+    def _changed(self, added: List[Track], removed: List[str]):
+        if self.on_change and (added or removed):
+            try:
+                self.on_change(added, removed)
+            except Exception as e:
+                logger.error(f"Error reporting library change: {e}", exc_info=True)
+
+    def root_for(self, path: str) -> Optional[str]:
+        directory = os.path.dirname(os.path.abspath(path))
+        return directory if directory in self.roots else None
+
+    def _upsert(self, tracks: List[Track]):
+        self.db.executemany(
+            f"INSERT OR REPLACE INTO tracks ({TRACK_COLUMNS}, match_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(t.path, t.root, t.name, t.size, t.mtime, t.format, t.duration, t.artist, t.title, t.album,
+              match_key(t.artist, t.title))
+             for t in tracks]
+        )
+
+    def add_many(self, paths: Iterable[str]) -> List[Track]:
+        tracks = []
+        with self.metrics.span(SPAN_CATALOG, item="add"):
+            for path in paths:
+                path = os.path.abspath(path)
+                root = self.root_for(path)
+                if root is None or PARTIAL_DOWNLOAD.search(path):
+                    continue
+                try:
+                    tracks.append(read_track(path, root))
+                except OSError as e:
+                    logger.warning(f"Not cataloguing {path}: {e}")
+            if tracks:
+                with self.lock, self.db:
+                    self._upsert(tracks)
+                self._changed(tracks, [])
+        return tracks
+
+    def add(self, path: str) -> Optional[Track]:
+        tracks = self.add_many([path])
+        return tracks[0] if tracks else None
+
+    def add_sources(self, sources: Iterable[Tuple[str, str]]):
+        # (source_id, path): remembers which service track a file came from, e.g. "yandex:12345".
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO sources VALUES (?, ?)",
+                [(source_id, os.path.abspath(path)) for source_id, path in sources]
+            )
+
+    def find_duplicate(self, source_id: Optional[str], artist: Optional[str], title: Optional[str],
+                       duration: Optional[float], tolerance: float = 2.0) -> Optional[str]:
+        # Joined against tracks, so a file that has since been deleted no longer counts.
+        with self.lock:
+            if source_id:
+                row = self.db.execute(
+                    "SELECT t.path FROM sources s JOIN tracks t ON t.path = s.path WHERE s.source_id = ? LIMIT 1",
+                    (source_id,)
+                ).fetchone()
+                if row:
+                    return row[0]
+
+            key = match_key(artist, title)
+            if key is None:
+                return None
+            rows = self.db.execute("SELECT path, duration FROM tracks WHERE match_key = ?", (key,)).fetchall()
+
+        for path, known_duration in rows:
+            # Same name but a different length is a different cut (live, extended...), not a duplicate.
+            if duration is None or known_duration is None or abs(known_duration - duration) <= tolerance:
+                return path
+        return None
+
+    def remove_many(self, paths: Iterable[str]):
+        paths = [os.path.abspath(p) for p in paths]
+        with self.metrics.span(SPAN_CATALOG, item="remove"):
+            with self.lock, self.db:
+                self.db.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in paths])
+            self._changed([], paths)
+
+    def rescan(self) -> bool:
+        with self.metrics.span(SPAN_CATALOG, item="rescan"):
+            return self._rescan()
+
+    def _rescan(self) -> bool:
+        changed = False
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+            root_mtime = os.stat(root).st_mtime
+            with self.lock:
+                row = self.db.execute("SELECT mtime FROM roots WHERE path = ?", (root,)).fetchone()
+            # Adding, removing or renaming a file bumps the folder's mtime. No bump, no scan.
+            if row and row[0] == root_mtime:
+                continue
+            changed = self._rescan_root(root) or changed
+            with self.lock, self.db:
+                self.db.execute("INSERT OR REPLACE INTO roots VALUES (?, ?)", (root, root_mtime))
+        return changed
+
+    def _rescan_root(self, root: str) -> bool:
+        with self.lock:
+            known: Dict[str, tuple] = {
+                path: (size, mtime)
+                for path, size, mtime in self.db.execute("SELECT path, size, mtime FROM tracks WHERE root = ?", (root,))
+            }
+
+        updated = []
+        seen = set()
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if not entry.is_file() or PARTIAL_DOWNLOAD.search(entry.name):
+                    continue
+                path = os.path.abspath(entry.path)
+                seen.add(path)
+                stat = entry.stat()
+                if known.get(path) == (stat.st_size, stat.st_mtime):
+                    continue
+                updated.append(read_track(path, root, stat))
+
+        removed = [path for path in known if path not in seen]
+        if updated or removed:
+            logger.info(f"Catalog rescan of {root}: {len(updated)} new/changed, {len(removed)} removed")
+            with self.lock, self.db:
+                self._upsert(updated)
+                self.db.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in removed])
+            self._changed(updated, removed)
+        return bool(updated or removed)
+
+    def list_tracks(self) -> List[Track]:
+        with self.lock:
+            rows = self.db.execute(f"SELECT {TRACK_COLUMNS} FROM tracks").fetchall()
+        return sorted((Track(*row) for row in rows), key=self.sort_key)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,142 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Collection, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    source TEXT NOT NULL,
+    format TEXT NOT NULL,
+    params TEXT NOT NULL,
+    source_size INTEGER NOT NULL,
+    source_mtime REAL NOT NULL,
+    output TEXT NOT NULL,
+    output_size INTEGER NOT NULL,
+    output_mtime REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (source, format, params)
+);
+CREATE INDEX IF NOT EXISTS conversions_last_used ON conversions (last_used);
+"""
+
+
+class ConversionCache:
+    def __init__(self, db_path: str, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def lookup(self, source: str, output_format: str, params: str) -> Optional[str]:
+        source = os.path.abspath(source)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT source_size, source_mtime, output, output_size, output_mtime FROM conversions "
+                "WHERE source = ? AND format = ? AND params = ?",
+                (source, output_format, params)
+            ).fetchone()
+        if row is None:
+            return None
+
+        source_size, source_mtime, output, output_size, output_mtime = row
+        try:
+            source_stat = os.stat(source)
+            output_stat = os.stat(output)
+        except OSError:
+            self._forget(source, output_format, params)
+            return None
+
+        # Source re-downloaded, or someone fiddled with the output: the old result is stale.
+        if (source_stat.st_size, source_stat.st_mtime) != (source_size, source_mtime) or \
+                (output_stat.st_size, output_stat.st_mtime) != (output_size, output_mtime):
+            self._forget(source, output_format, params)
+            return None
+
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE conversions SET last_used = ? WHERE source = ? AND format = ? AND params = ?",
+                (time.time(), source, output_format, params)
+            )
+        return output
+
+    def store_many(self, source: str, outputs: List[Tuple[str, str, str]]):
+        # All outputs of one ffmpeg run land in a single transaction.
+        source = os.path.abspath(source)
+        source_stat = os.stat(source)
+        now = time.time()
+        rows = []
+        for output_format, params, output in outputs:
+            output_stat = os.stat(output)
+            rows.append((source, output_format, params, source_stat.st_size, source_stat.st_mtime,
+                         output, output_stat.st_size, output_stat.st_mtime, now))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def store(self, source: str, output_format: str, params: str, output: str):
+        self.store_many(source, [(output_format, params, output)])
+
+    def refresh(self, path: str):
+        # The file's tags were rewritten in place. Same audio, so its conversions (or the
+        # conversion that made it) still count; they just need the new size and mtime.
+        path_stat = os.stat(path)
+        absolute = os.path.abspath(path)
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE conversions SET source_size = ?, source_mtime = ? WHERE source = ?",
+                (path_stat.st_size, path_stat.st_mtime, absolute)
+            )
+            # Outputs are stored the way they were named, which may be relative to converted_dir's parent.
+            self.db.execute(
+                "UPDATE conversions SET output_size = ?, output_mtime = ? WHERE output IN (?, ?)",
+                (path_stat.st_size, path_stat.st_mtime, path, absolute)
+            )
+
+    def _forget(self, source: str, output_format: str, params: str):
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM conversions WHERE source = ? AND format = ? AND params = ?",
+                (source, output_format, params)
+            )
+
+    def enforce_limit(self, keep: Collection[str] = ()) -> List[str]:
+        if self.max_bytes <= 0:
+            return []
+
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(output_size), 0) FROM conversions").fetchone()[0]
+            if total <= self.max_bytes:
+                return []
+            rows = self.db.execute(
+                "SELECT source, format, params, output, output_size FROM conversions ORDER BY last_used"
+            ).fetchall()
+
+        evicted = []
+        for source, output_format, params, output, output_size in rows:
+            if total <= self.max_bytes:
+                break
+            if output in keep:
+                continue
+            try:
+                os.remove(output)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not evict {output}: {e}")
+                continue
+            self._forget(source, output_format, params)
+            total -= output_size
+            evicted.append(output)
+
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} converted files to stay under the cache size cap")
+        return evicted
+
+    def close(self):
+        with self.lock:
+            self.db.close()
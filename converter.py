@@ -0,0 +1,445 @@
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional
+
+from conversion_cache import ConversionCache
+from loudness import (PCM_ARGS, PCM_READ_BYTES, Loudness, LoudnessAnalyzer, LoudnessCache, album_loudness,
+                      missing_modules, replaygain_tags, write_replaygain)
+from metrics import SPAN_CONVERT, SPAN_LOUDNESS, Metrics
+from progress import CONVERT, ProgressBus, ProgressEvent, parse_ffmpeg_duration, parse_ffmpeg_progress
+
+logger = logging.getLogger(__name__)
+
+# Already the codec the target wants, just in a different container: the audio is copied, not re-encoded.
+STREAM_COPY = {("aac", "m4a")}
+
+
+def file_format(path: str) -> str:
+    return os.path.splitext(path)[1].lstrip('.').lower()
+
+
+def needs_conversion(path: str, output_formats: Iterable[str]) -> bool:
+    # False when the file already is every format asked for, so it can skip conversion altogether.
+    source = file_format(path)
+    return any(fmt.lower() != source for fmt in output_formats)
+
+
+def outputs_by_track(files: Iterable[str]) -> Dict[str, List[str]]:
+    # Streamed conversions leave no source behind, just one file per format; the first stands in for it.
+    tracks: Dict[str, List[str]] = {}
+    for path in files:
+        tracks.setdefault(os.path.splitext(path)[0], []).append(path)
+    return {outputs[0]: outputs for outputs in tracks.values()}
+
+
+def stderr_tail(stderr: bytes, lines: int = 10) -> str:
+    # The banner comes first and the actual complaint last.
+    return "\n".join(stderr.decode("utf-8", errors="replace").strip().splitlines()[-lines:])
+
+
+def ffmpeg_available() -> bool:
+    try:
+        subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+
+
+class AudioConverter:
+    def __init__(self, config: dict, on_evict: Optional[Callable[[List[str]], None]] = None,
+                 progress: Optional[ProgressBus] = None, metrics: Optional[Metrics] = None,
+                 on_retag: Optional[Callable[[List[str]], None]] = None):
+        self.config = config
+        self.on_evict = on_evict
+        # Told about files whose tags were rewritten in place, so the library can re-read them.
+        self.on_retag = on_retag
+        self.progress = progress
+        self.metrics = metrics or Metrics()
+        self.cache = ConversionCache(
+            config["library_db"],
+            int(config.get("converted_cache_max_mb") or 0) * 1024 * 1024
+        )
+        self.loudness = None
+        if config.get("replaygain"):
+            missing = missing_modules()
+            if missing:
+                logger.warning(f"ReplayGain needs {' and '.join(missing)} (pip install {' '.join(missing)}), "
+                               f"leaving files untagged")
+            else:
+                self.loudness = LoudnessCache(config["library_db"])
+
+        # Every ffmpeg we spawn lives here with the cancel event of whoever asked for it,
+        # so Cancel can actually pull the plug on just that batch.
+        self.active_conversions = {}
+        self.conversion_lock = threading.Lock()
+        self.stopped = False
+
+    def worker_count(self) -> int:
+        # 0 (or anything silly) means "one ffmpeg per core".
+        try:
+            workers = int(self.config.get("conversion_workers") or 0)
+        except (TypeError, ValueError):
+            workers = 0
+        return workers if workers > 0 else (os.cpu_count() or 1)
+
+    def encoder_args(self, output_format: str) -> List[str]:
+        return [str(arg) for arg in self.config.get("encoder_options", {}).get(output_format, [])]
+
+    def output_args(self, source_format: Optional[str], output_format: str) -> List[str]:
+        encoder_args = self.encoder_args(output_format)
+        if (source_format, output_format) in STREAM_COPY and not encoder_args:
+            return ["-c:a", "copy"]
+        return encoder_args
+
+    def is_cancelled(self, cancel: Optional[threading.Event]) -> bool:
+        return self.stopped or (cancel is not None and cancel.is_set())
+
+    def convert_audio(self, input_path: str, output_format: str,
+                      cancel: Optional[threading.Event] = None) -> Optional[str]:
+        return self.convert_to_formats(input_path, [output_format], cancel).get(output_format)
+
+    def convert_to_formats(self, input_path: str, output_formats: Iterable[str],
+                           cancel: Optional[threading.Event] = None) -> Dict[str, str]:
+        if self.is_cancelled(cancel):
+            return {}
+
+        if not os.path.exists(input_path):
+            logger.error(f"Input file does not exist: {input_path}")
+            return {}
+
+        results = {}
+        pending = []
+        input_extension = file_format(input_path)
+        for output_format in dict.fromkeys(fmt.lower() for fmt in output_formats):
+            if input_extension == output_format:
+                logger.info(f"{input_path} is already {output_format}, nothing to convert")
+                results[output_format] = input_path
+                continue
+
+            params = " ".join(self.output_args(input_extension, output_format))
+            cached_path = self.cache.lookup(input_path, output_format, params)
+            if cached_path:
+                logger.info(f"Already converted, reusing: {cached_path}")
+                results[output_format] = cached_path
+                continue
+            pending.append(output_format)
+
+        if not pending:
+            return results
+
+        converted_dir = Path(self.config["converted_dir"])
+        converted_dir.mkdir(parents=True, exist_ok=True)
+
+        stem = os.path.basename(input_path).rsplit('.', 1)[0]
+        output_paths = {fmt: converted_dir / f"{stem}.{fmt}" for fmt in pending}
+        analyzer = None
+        if self.loudness is not None and self.loudness.lookup(input_path) is None:
+            # Measured off the conversion's own decode, not a second pass over the file later.
+            analyzer = LoudnessAnalyzer()
+
+        try:
+            # One decode, many encodes: every requested format is its own output of the same ffmpeg run.
+            command = ["ffmpeg", "-y"]
+            if self.progress and analyzer is None:
+                # Machine-readable progress on stdout instead of the human status line on stderr.
+                command += ["-progress", "pipe:1", "-nostats"]
+            command += ["-i", input_path]
+            for output_format, output_path in output_paths.items():
+                command += ["-map", "0:a:0", "-vn", *self.output_args(input_extension, output_format),
+                            str(output_path)]
+            if analyzer is not None:
+                # And one more output: raw PCM on stdout, for the loudness analysis.
+                command += ["-map", "0:a:0", "-vn", *PCM_ARGS, "pipe:1"]
+
+            with self.metrics.span(SPAN_CONVERT, job=input_path, item=",".join(pending)) as span:
+                span.bytes = os.path.getsize(input_path)
+                process, stderr = self.run_ffmpeg(command, input_path, cancel, analyzer)
+                if process.returncode != 0:
+                    span.fail()
+
+            if self.is_cancelled(cancel):
+                # Whatever ffmpeg managed to write before we killed it is garbage.
+                for output_path in output_paths.values():
+                    output_path.unlink(missing_ok=True)
+                logger.info(f"Conversion cancelled: {input_path}")
+                return {}
+
+            if process.returncode == 0:
+                logger.info(f"Successfully converted {input_path} to {', '.join(pending)}")
+                converted = {fmt: str(path) for fmt, path in output_paths.items()}
+                self.remember(input_path, converted)
+                results.update(converted)
+                if analyzer is not None:
+                    self.store_loudness(input_path, analyzer.result())
+            else:
+                error_output = stderr.decode('utf-8', errors='replace')
+                logger.error(f"FFmpeg error for {input_path}: {error_output}")
+        except Exception as e:
+            logger.error(f"Error converting {input_path} to {', '.join(pending)}: {e}", exc_info=True)
+        return results
+
+    def run_ffmpeg(self, command: List[str], input_path: str, cancel: Optional[threading.Event] = None,
+                   analyzer: Optional[LoudnessAnalyzer] = None):
+        logger.debug(f"Executing ffmpeg command: {' '.join(command)}")
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE if self.progress or analyzer else subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        with self.conversion_lock:
+            self.active_conversions[process] = cancel
+            if self.is_cancelled(cancel):
+                process.kill()
+        try:
+            stderr = self.wait_with_progress(process, input_path, analyzer)
+        except BaseException:
+            # Nobody is reading its pipes any more; it would sit there blocked.
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            with self.conversion_lock:
+                self.active_conversions.pop(process, None)
+        return process, stderr
+
+    def publish_progress(self, input_path: str, position: float, total: Optional[float]):
+        if self.progress:
+            self.progress.publish(ProgressEvent(
+                job=input_path,
+                stage=CONVERT,
+                message=os.path.basename(input_path),
+                percent=min(100.0, position * 100 / total) if total else None
+            ))
+
+    def wait_with_progress(self, process: subprocess.Popen, input_path: str,
+                           analyzer: Optional[LoudnessAnalyzer] = None) -> bytes:
+        if not self.progress and analyzer is None:
+            return process.communicate()[1]
+
+        # stderr has to be drained alongside stdout or ffmpeg blocks on a full pipe.
+        # It's also where the input's duration turns up, which turns seconds into a percentage.
+        stderr_lines = []
+        duration = {}
+
+        def read_stderr():
+            for line in process.stderr:
+                stderr_lines.append(line)
+                if "total" not in duration:
+                    total = parse_ffmpeg_duration(line.decode("utf-8", errors="replace"))
+                    if total:
+                        duration["total"] = total
+
+        reader = threading.Thread(target=read_stderr, name="ffmpeg-stderr", daemon=True)
+        reader.start()
+        if analyzer is not None:
+            # stdout is the decoded audio, and how much of it came through is the progress.
+            for data in iter(lambda: process.stdout.read(PCM_READ_BYTES), b""):
+                analyzer.feed(data)
+                self.publish_progress(input_path, analyzer.seconds, duration.get("total"))
+        else:
+            for line in process.stdout:
+                position = parse_ffmpeg_progress(line.decode("utf-8", errors="replace"))
+                if position is not None:
+                    self.publish_progress(input_path, position, duration.get("total"))
+        process.wait()
+        reader.join()
+        return b"".join(stderr_lines)
+
+    async def convert_stream(self, chunks: AsyncIterator[bytes], stem: str,
+                             output_formats: Iterable[str], source_format: Optional[str] = None) -> Dict[str, str]:
+        converted_dir = Path(self.config["converted_dir"])
+        converted_dir.mkdir(parents=True, exist_ok=True)
+        output_paths = {fmt: converted_dir / f"{stem}.{fmt}" for fmt in dict.fromkeys(output_formats)}
+
+        # Same multi-output command as convert_to_formats, except the input is whatever
+        # arrives on stdin. No intermediate file ever hits the disk.
+        command = ["ffmpeg", "-y", "-i", "pipe:0"]
+        for output_format, output_path in output_paths.items():
+            command += ["-map", "0:a:0", "-vn", *self.output_args(source_format, output_format), str(output_path)]
+        logger.debug(f"Executing ffmpeg command: {' '.join(command)}")
+
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stderr_task = asyncio.ensure_future(process.stderr.read())
+        stopped = False
+        try:
+            async for chunk in chunks:
+                if self.is_cancelled(None):
+                    stopped = True
+                    break
+                process.stdin.write(chunk)
+                # drain() waits while the pipe is full, so memory stays at roughly one chunk.
+                await process.stdin.drain()
+            if stopped:
+                process.kill()
+            else:
+                process.stdin.close()
+            await process.wait()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg quit before the input ran out (bad codec, bad data); why is on its stderr.
+            await process.wait()
+            stderr = await stderr_task
+            logger.error(f"FFmpeg exited with {process.returncode} while streaming {stem}: {stderr_tail(stderr)}")
+            for output_path in output_paths.values():
+                output_path.unlink(missing_ok=True)
+            raise
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            for output_path in output_paths.values():
+                output_path.unlink(missing_ok=True)
+            raise
+        finally:
+            stderr = await stderr_task
+
+        if stopped:
+            if hasattr(chunks, "aclose"):
+                # Lets the download behind the chunks close its connection now.
+                await chunks.aclose()
+            for output_path in output_paths.values():
+                output_path.unlink(missing_ok=True)
+            logger.info(f"Conversion cancelled: {stem}")
+            return {}
+
+        if process.returncode != 0:
+            logger.error(f"FFmpeg error while streaming {stem}: {stderr.decode('utf-8', errors='replace')}")
+            for output_path in output_paths.values():
+                output_path.unlink(missing_ok=True)
+            return {}
+
+        logger.info(f"Successfully streamed {stem} to {', '.join(output_paths)}")
+        return {fmt: str(path) for fmt, path in output_paths.items()}
+
+    def remember(self, input_path: str, outputs: Dict[str, str]):
+        input_extension = file_format(input_path)
+        try:
+            self.cache.store_many(input_path, [
+                (output_format, " ".join(self.output_args(input_extension, output_format)), output_path)
+                for output_format, output_path in outputs.items()
+            ])
+            evicted = self.cache.enforce_limit(keep=set(outputs.values()))
+            if evicted and self.on_evict:
+                self.on_evict(evicted)
+        except Exception as e:
+            # A cache hiccup is not worth failing a perfectly good conversion over.
+            logger.error(f"Error updating conversion cache: {e}", exc_info=True)
+
+    def store_loudness(self, path: str, result: Loudness):
+        try:
+            self.loudness.store(path, result)
+        except Exception as e:
+            logger.error(f"Error caching loudness of {path}: {e}", exc_info=True)
+
+    def analyze(self, path: str, cancel: Optional[threading.Event] = None) -> Optional[Loudness]:
+        cached = self.loudness.lookup(path)
+        if cached is not None:
+            return cached
+        # Nothing was converted from this one (already the right format, or converted on an
+        # earlier run), so it gets a decode of its own, with nothing encoded.
+        analyzer = LoudnessAnalyzer()
+        command = ["ffmpeg", "-i", path, "-map", "0:a:0", "-vn", *PCM_ARGS, "pipe:1"]
+        with self.metrics.span(SPAN_LOUDNESS, job=path, item="analyse") as span:
+            span.bytes = os.path.getsize(path)
+            process, stderr = self.run_ffmpeg(command, path, cancel, analyzer)
+            if process.returncode != 0:
+                span.fail()
+                if not self.is_cancelled(cancel):
+                    logger.error(f"FFmpeg error analysing {path}: {stderr.decode('utf-8', errors='replace')}")
+                return None
+        result = analyzer.result()
+        self.store_loudness(path, result)
+        return result
+
+    def apply_replaygain(self, batch: Dict[str, Iterable[str]], cancel: Optional[threading.Event] = None) -> int:
+        # batch: each source file and the files made from it (the source itself, if it's one of them).
+        # Everything in it counts as one album. Returns how many files got new tags.
+        if self.loudness is None or not batch:
+            return 0
+        tracks: Dict[str, Loudness] = {}
+        for source in batch:
+            if self.is_cancelled(cancel):
+                return 0
+            try:
+                result = self.analyze(source, cancel)
+            except Exception as e:
+                logger.error(f"Error analysing {source}: {e}", exc_info=True)
+                continue
+            if result is not None and result.integrated is not None:
+                tracks[source] = result
+        if not tracks:
+            return 0
+
+        album = album_loudness(tracks.values())
+        tagged: List[str] = []
+        with self.metrics.span(SPAN_LOUDNESS, job=next(iter(tracks)), item="tag"):
+            for source, track in tracks.items():
+                tags = replaygain_tags(track, album)
+                for path in dict.fromkeys(batch[source]):
+                    try:
+                        if write_replaygain(path, tags):
+                            tagged.append(path)
+                            self.retagged(path)
+                    except Exception as e:
+                        logger.warning(f"Could not write ReplayGain tags to {path}: {e}")
+        if tagged and self.on_retag:
+            # New size and mtime; the catalog would otherwise think these changed behind its back.
+            self.on_retag(tagged)
+        logger.info(f"ReplayGain: {len(tracks)} tracks, album gain {album.gain:+.2f} dB, {len(tagged)} files tagged")
+        return len(tagged)
+
+    def retagged(self, path: str):
+        # Only the tags changed, so what's cached about the audio is still good.
+        try:
+            self.cache.refresh(path)
+            self.loudness.refresh(path)
+        except Exception as e:
+            logger.error(f"Error updating caches for {path}: {e}", exc_info=True)
+
+    def close(self):
+        self.cache.close()
+        if self.loudness is not None:
+            self.loudness.close()
+
+    def cancel_conversions(self, cancel: Optional[threading.Event] = None):
+        # With an event, only that batch stops. Without one, everything stops for good (app exit).
+        with self.conversion_lock:
+            if cancel is None:
+                self.stopped = True
+            else:
+                cancel.set()
+            for process, owner in self.active_conversions.items():
+                if cancel is None or owner is cancel:
+                    try:
+                        process.kill()
+                    except OSError:
+                        pass
+
+
+class ReplayGainBatch:
+    # One download job's files come out of parallel conversions one at a time; once the last
+    # one is in (converted, failed or passed through as-is) they're tagged together, as an album.
+    def __init__(self, converter: AudioConverter, expected: int):
+        self.converter = converter
+        self.remaining = expected
+        self.files: Dict[str, List[str]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, source: str, outputs: Iterable[str]):
+        with self.lock:
+            outputs = list(outputs)
+            if outputs:
+                self.files[source] = outputs
+            self.remaining -= 1
+            if self.remaining:
+                return
+        self.converter.apply_replaygain(self.files)
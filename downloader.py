@@ -0,0 +1,568 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from async_loop import EventLoopThread
+from catalog import LibraryCatalog
+from converter import AudioConverter, needs_conversion
+from http_download import download_file
+from metadata_cache import MetadataCache, OfflineMiss
+from metrics import SPAN_DOWNLOAD, SPAN_RESOLVE, Metrics
+from progress import DOWNLOAD, ProgressBus, ProgressEvent
+from rate_limit import ProviderLimiter
+from spotdl_worker import SpotdlError, SpotdlWorkerPool, classify_spotdl_error
+
+logger = logging.getLogger(__name__)
+
+# tracks() takes a list of IDs; this keeps each request's query string a sane length.
+YANDEX_TRACKS_BATCH = 100
+
+# Formats spotdl can write itself, straight from the matched source.
+SPOTDL_FORMATS = ("mp3", "m4a", "flac", "wav", "opus", "ogg")
+YANDEX_AAC_CODECS = ("aac", "he-aac")
+# Yandex serves AAC as a raw ADTS stream, which is an .aac file, not an .m4a one.
+YANDEX_CODEC_EXTENSIONS = {"mp3": "mp3", "aac": "aac", "he-aac": "aac"}
+
+
+def detect_platform(url: str) -> Optional[str]:
+    if "spotify.com" in url or url.startswith("spotify:"):
+        return "spotify"
+    if "music.yandex" in url or url.isdigit():
+        return "yandex"
+    return None
+
+
+def safe_filename(name: str) -> str:
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", name).strip() or "untitled"
+
+
+def track_file_stem(track) -> str:
+    if not track.artists:
+        # Some Yandex tracks (sound effects, podcasts) come without any artist.
+        return safe_filename(track.title or "")
+    return safe_filename(f"{track.artists[0].name} - {track.title}")
+
+
+def make_pooled_request(connector, limiter: Optional[ProviderLimiter] = None):
+    from yandex_music.utils.request_async import Request
+
+    class PooledRequest(Request):
+        async def _request_wrapper(self, *args, **kwargs):
+            # aiohttp.request() opens a throwaway connection per call unless it's handed a connector.
+            kwargs.setdefault("connector", connector)
+            request = super()._request_wrapper
+            if limiter is None:
+                return await request(*args, **kwargs)
+            # Every API call, from any job, is paced and retried here. A fresh copy of the
+            # arguments per attempt, since the wrapper rewrites the timeout in place.
+            return await limiter.call(lambda: request(*args, **dict(kwargs)), f"Yandex API {args[1] if len(args) > 1 else 'call'}")
+
+    return PooledRequest()
+
+
+def source_format(output_formats: Optional[List[str]]) -> Optional[str]:
+    # Which of the requested formats to fetch, when there's a choice. Both services really
+    # serve AAC, which goes into m4a without re-encoding; failing that, a lossless target
+    # keeps the best source there is and the lossy targets are made from it.
+    formats = [fmt.lower() for fmt in output_formats or []]
+    for fmt in ("m4a", "flac", "wav", "mp3"):
+        if fmt in formats:
+            return fmt
+    return formats[0] if formats else None
+
+
+def pick_download_info(infos: list, target_format: Optional[str]):
+    if target_format == "m4a":
+        return max(infos, key=lambda i: (i.codec in YANDEX_AAC_CODECS, i.bitrate_in_kbps))
+    if target_format in (None, "mp3"):
+        return max(infos, key=lambda i: (i.codec == "mp3", i.bitrate_in_kbps))
+    # Lossless targets can't get better than the source; take the richest one.
+    return max(infos, key=lambda i: i.bitrate_in_kbps)
+
+
+def yandex_track_key(track_id) -> str:
+    # Playlist entries come as "track:album"; the track number alone identifies the metadata.
+    return f"yandex:track:{str(track_id).split(':')[0]}"
+
+
+def parse_yandex_url(url: str) -> Tuple[str, str, Optional[str]]:
+    # Returns (kind, id, owner): a single track, a whole album, or a user's playlist.
+    match = re.search(r"track/(\d+)", url)
+    if match:
+        return "track", match.group(1), None
+    match = re.search(r"album/(\d+)", url)
+    if match:
+        return "album", match.group(1), None
+    match = re.search(r"users/([^/?#]+)/playlists/(\d+)", url)
+    if match:
+        return "playlist", match.group(2), match.group(1)
+    return "track", url.strip(), None
+
+
+class Downloader:
+    def __init__(self, config: dict, converter: AudioConverter,
+                 progress: Optional[ProgressBus] = None,
+                 library: Optional[LibraryCatalog] = None,
+                 metrics: Optional[Metrics] = None):
+        self.config = config
+        self.converter = converter
+        # Workers never touch the UI; they publish here and the UI picks it up at its own pace.
+        self.progress = progress
+        # Checked before anything is fetched, so tracks we already have are never downloaded twice.
+        self.library = library
+        self.metrics = metrics or Metrics()
+
+        # One loop thread owns the Yandex client and every connection it makes.
+        # Created on first use, so Spotify-only sessions never start it.
+        self.loop_thread = None
+        self.loop_thread_lock = threading.Lock()
+        self.http_connector = None
+        self.http_session = None
+        self.client_lock = None
+        self.resolve_slots = None
+        self.download_slots = None
+        self.yandex_client = None
+        self.yandex_client_token = None
+        self.yandex_token = None
+        # Per-service pacing, retries and adaptive concurrency; the configured limits are the ceilings.
+        self.yandex_api = ProviderLimiter.from_config("yandex", config, int(config["yandex_resolve_concurrency"]))
+        self.yandex_cdn = ProviderLimiter.from_config(
+            "yandex_cdn", config,
+            int(config["yandex_parallel_downloads"]) * max(1, int(config["download_parallel_ranges"])),
+            retries=int(config["download_retries"])
+        )
+        self.spotify_limiter = ProviderLimiter.from_config(
+            "spotify", config, int(config["platform_concurrency"].get("spotify", 1)), latency_aware=False)
+
+        # URL -> tracklist and track ID -> metadata, so a re-sync only looks up what's new.
+        self.metadata = MetadataCache(
+            config["library_db"],
+            float(config["metadata_cache_ttl_hours"]) * 3600,
+            int(config["metadata_cache_max_entries"]),
+            offline=bool(config["offline"])
+        )
+
+        # spotdl loads once per worker and stays warm for the whole session.
+        self.spotdl_pool = SpotdlWorkerPool(config, config["platform_concurrency"].get("spotify", 1))
+
+    def set_status(self, message: str):
+        if self.progress:
+            self.progress.status(message)
+
+    def publish_progress(self, job: str, item: str, percent: Optional[float] = None, message: str = "",
+                         bytes_done: Optional[int] = None, bytes_total: Optional[int] = None):
+        if self.progress:
+            self.progress.publish(ProgressEvent(
+                job=job, stage=DOWNLOAD, item=item, message=message,
+                percent=percent, bytes_done=bytes_done, bytes_total=bytes_total
+            ))
+
+    def byte_progress(self, job: str, item: str) -> Optional[Callable[[int, Optional[int]], None]]:
+        if not self.progress:
+            return None
+
+        def on_progress(done: int, total: Optional[int]):
+            percent = min(100.0, done * 100 / total) if total else None
+            self.publish_progress(job, item, percent, "downloading", done, total)
+
+        return on_progress
+
+    def get_loop_thread(self) -> EventLoopThread:
+        with self.loop_thread_lock:
+            if self.loop_thread is None:
+                self.loop_thread = EventLoopThread("yandex-loop")
+            return self.loop_thread
+
+    async def ensure_http_session(self):
+        import aiohttp
+
+        if self.http_session is None:
+            self.http_connector = aiohttp.TCPConnector(
+                limit=int(self.config["http_pool_size"]),
+                ttl_dns_cache=300
+            )
+            self.http_session = aiohttp.ClientSession(connector=self.http_connector)
+            self.client_lock = asyncio.Lock()
+            # Shared by every Yandex job, so one big album can't open hundreds of requests at once.
+            self.resolve_slots = asyncio.Semaphore(max(1, int(self.config["yandex_resolve_concurrency"])))
+            self.download_slots = asyncio.Semaphore(max(1, int(self.config["yandex_parallel_downloads"])))
+        return self.http_session
+
+    async def initialize_yandex_client(self, token: str):
+        await self.ensure_http_session()
+        async with self.client_lock:
+            # Concurrent jobs all land here at once; only the first one actually logs in.
+            if self.yandex_client is not None and self.yandex_client_token == token:
+                return
+            try:
+                # Imported here so Spotify-only and headless runs never pay for it.
+                from yandex_music import ClientAsync
+                client = ClientAsync(token, request=make_pooled_request(self.http_connector, self.yandex_api))
+                # Offline, the client only rebuilds cached tracks, and init() would go to the network.
+                self.yandex_client = client if self.metadata.offline else await client.init()
+                self.yandex_client_token = token
+                logger.info("Yandex Music client initialized successfully")
+            except Exception as e:
+                logger.error(f"Error initializing Yandex Music client: {e}", exc_info=True)
+                raise
+
+    def find_in_library(self, source_id: str, artist: Optional[str], title: Optional[str],
+                        duration: Optional[float]) -> Optional[str]:
+        if self.library is None or not self.config["skip_existing"]:
+            return None
+        existing = self.library.find_duplicate(
+            source_id, artist, title, duration, float(self.config["dedup_duration_tolerance_s"]))
+        if existing:
+            logger.info(f"Skipping {artist} - {title}, already in the library: {existing}")
+        return existing
+
+    def remember_downloads(self, sources: List[Tuple[str, str]]):
+        if self.library is None or not sources:
+            return
+        self.library.add_many(path for _, path in sources)
+        self.library.add_sources(sources)
+
+    def download_spotify_track(self, url: str, on_skip: Optional[Callable[[str], None]] = None,
+                               output_formats: Optional[List[str]] = None,
+                               on_fail: Optional[Callable[[str], None]] = None) -> List[str]:
+        try:
+            Path(self.config["output_dir"]).mkdir(exist_ok=True)
+
+            logger.info(f"Starting Spotify download for URL: {url}")
+            self.set_status("Downloading from Spotify...")
+
+            # spotdl resolves and downloads in one call; the first progress report (or the
+            # library check, whichever comes first) is where one ends and the other begins.
+            started = time.perf_counter()
+            resolved_at = []
+
+            def mark_resolved():
+                if not resolved_at:
+                    resolved_at.append(time.perf_counter())
+                    self.metrics.observe(SPAN_RESOLVE, resolved_at[0] - started, job=url)
+
+            def on_progress(message: dict):
+                mark_resolved()
+                # spotdl's own tracker already knows the percentage; no need to scrape its console output.
+                self.publish_progress(url, message["song"], message["progress"], message["message"])
+
+            key = f"spotify:{url}"
+            songs = self.metadata.get(key)
+            if songs is None and self.metadata.offline:
+                raise OfflineMiss(f"{url} is not cached and offline mode is on")
+
+            skipped = []
+
+            def select(resolved: List[dict]) -> List[int]:
+                mark_resolved()
+                # Asked again on a retry, so start over.
+                skipped.clear()
+                chosen = []
+                for index, song in enumerate(resolved):
+                    existing = self.find_in_library(
+                        f"spotify:{song.get('song_id')}", song.get("artist"), song.get("name"), song.get("duration"))
+                    if existing:
+                        skipped.append(existing)
+                    else:
+                        chosen.append(index)
+                return chosen
+
+            # spotdl writes the format we're after directly, instead of an MP3 we'd transcode again.
+            output_format = source_format(output_formats)
+            if output_format not in SPOTDL_FORMATS:
+                output_format = None
+
+            # Cached songs carry their matched audio source too, so spotdl skips both searches.
+            result = {"files": []}
+            try:
+                # Throttled or cut-off jobs are retried; with a library, songs that did make it
+                # are skipped the second time round.
+                result = self.spotify_limiter.call_blocking(
+                    lambda: self.spotdl_pool.download(
+                        url, on_progress, songs, select if self.library else None, output_format),
+                    f"Spotify download of {url}",
+                    classify=classify_spotdl_error
+                )
+            finally:
+                files = result["files"]
+                self.metrics.observe(
+                    SPAN_DOWNLOAD, time.perf_counter() - (resolved_at or [started])[0], job=url,
+                    bytes=sum(os.path.getsize(path) for path in files if os.path.exists(path)),
+                    ok=bool(files or skipped)
+                )
+            if result.get("songs") and not self.metadata.offline:
+                self.metadata.put(key, result["songs"])
+            self.remember_downloads([(f"spotify:{song_id}", path) for song_id, path in result.get("sources", [])])
+            for path in skipped:
+                if on_skip:
+                    on_skip(path)
+            missing = result.get("missing") or []
+            if missing:
+                logger.warning(f"{len(missing)} songs from {url} failed to download: {', '.join(missing)}")
+            for name in missing:
+                if on_fail:
+                    on_fail(name)
+
+            if files:
+                logger.info(f"Spotify download completed successfully: {len(files)} files, {len(skipped)} skipped")
+                self.set_status("Download completed")
+            elif skipped:
+                logger.info(f"Everything in {url} is already in the library")
+                self.set_status("Already in the library")
+            else:
+                logger.error(f"spotdl downloaded nothing for {url}")
+                self.set_status("Download failed")
+            return files
+
+        except (SpotdlError, OfflineMiss) as e:
+            logger.error(f"Spotify download failed for {url}: {e}")
+            self.set_status(f"Download failed: {e}")
+            return []
+        except Exception as e:
+            logger.error(f"Error downloading Spotify track: {e}", exc_info=True)
+            self.set_status("Download failed")
+            return []
+
+    def remember_yandex_tracks(self, tracks: list):
+        self.metadata.put_many({yandex_track_key(track.id): track.to_dict() for track in tracks})
+
+    async def fetch_yandex_tracks(self, track_ids: List[str]) -> list:
+        from yandex_music import Track
+
+        known = {
+            key: Track.de_json(data, self.yandex_client)
+            for key, data in self.metadata.get_many(yandex_track_key(i) for i in track_ids).items()
+        }
+        missing = [i for i in track_ids if yandex_track_key(i) not in known]
+        if missing:
+            if self.metadata.offline:
+                raise OfflineMiss(f"{len(missing)} tracks are not cached and offline mode is on")
+            batches = [missing[i:i + YANDEX_TRACKS_BATCH] for i in range(0, len(missing), YANDEX_TRACKS_BATCH)]
+            results = await asyncio.gather(*[self.yandex_client.tracks(batch) for batch in batches])
+            fetched = [track for batch in results for track in batch]
+            self.remember_yandex_tracks(fetched)
+            known.update((yandex_track_key(track.id), track) for track in fetched)
+            logger.info(f"Fetched metadata for {len(missing)} tracks, {len(track_ids) - len(missing)} were cached")
+        return [known[yandex_track_key(i)] for i in track_ids if yandex_track_key(i) in known]
+
+    async def list_yandex_collection(self, kind: str, item_id: str, owner: Optional[str]) -> List[str]:
+        if kind == "album":
+            # One call returns the whole tracklist with full metadata.
+            album = await self.yandex_client.albums_with_tracks(item_id)
+            tracks = [track for volume in (album.volumes or []) for track in volume]
+            self.remember_yandex_tracks(tracks)
+            return [str(track.id) for track in tracks]
+
+        playlist = await self.yandex_client.users_playlists(item_id, owner)
+        shorts = playlist.tracks or []
+        self.remember_yandex_tracks([short.track for short in shorts if short.track])
+        return [short.track_id for short in shorts]
+
+    async def resolve_yandex_tracks(self, url: str) -> list:
+        kind, item_id, owner = parse_yandex_url(url)
+        if kind == "track":
+            track_ids = [item_id]
+        else:
+            key = f"yandex:{kind}:{owner}/{item_id}" if owner else f"yandex:{kind}:{item_id}"
+            # Albums don't change, so their tracklist is good for the whole TTL. Playlists are
+            # re-listed on every online run (that's what a re-sync is for); the tracks in them
+            # still come from the cache and only new ones get looked up.
+            track_ids = None
+            if kind == "album" or self.metadata.offline:
+                track_ids = self.metadata.get(key)
+            if track_ids is None:
+                if self.metadata.offline:
+                    raise OfflineMiss(f"{url} is not cached and offline mode is on")
+                track_ids = await self.list_yandex_collection(kind, item_id, owner)
+                self.metadata.put(key, track_ids)
+
+        tracks = await self.fetch_yandex_tracks(track_ids)
+
+        available = [track for track in tracks if track.available is not False]
+        if len(available) < len(tracks):
+            logger.warning(f"{len(tracks) - len(available)} tracks in {url} are not available for download")
+        logger.info(f"Resolved {url} to {len(available)} tracks")
+        return available
+
+    async def resolve_download_link(self, track, target_format: Optional[str], job: str = "") -> Tuple[str, str]:
+        # Returns the direct link and the file extension its codec calls for.
+        async with self.resolve_slots:
+            with self.metrics.span(SPAN_RESOLVE, job=job, item=track_file_stem(track)):
+                # Only the chosen variant needs a direct link, not every bitrate on offer.
+                infos = await track.get_download_info_async()
+                info = pick_download_info(infos, target_format)
+                logger.debug(f"Picked {info.codec} {info.bitrate_in_kbps}k for track {track.id}")
+                link = await info.get_direct_link_async()
+            return link, YANDEX_CODEC_EXTENSIONS.get(info.codec, info.codec)
+
+    async def fetch_yandex_file(self, link: str, filepath: str, track, job: str):
+        async with self.download_slots:
+            logger.info(f"Starting Yandex download for track ID: {track.id}")
+            with self.metrics.span(SPAN_DOWNLOAD, job=job, item=track_file_stem(track)) as span:
+                await download_file(
+                    self.http_session,
+                    link,
+                    filepath,
+                    chunk_size=int(self.config["yandex_chunk_kb"]) * 1024,
+                    parallel_ranges=int(self.config["download_parallel_ranges"]),
+                    split_min_bytes=int(self.config["download_split_min_mb"]) * 1024 * 1024,
+                    retries=int(self.config["download_retries"]),
+                    on_progress=self.byte_progress(job, track_file_stem(track)),
+                    limiter=self.yandex_cdn
+                )
+                span.bytes = os.path.getsize(filepath)
+
+    async def download_yandex_track(self, track, target_format: Optional[str] = None, job: str = "") -> Optional[str]:
+        try:
+            os.makedirs(self.config["output_dir"], exist_ok=True)
+
+            stem = track_file_stem(track)
+            if self.metadata.offline:
+                for extension in dict.fromkeys(YANDEX_CODEC_EXTENSIONS.values()):
+                    filepath = os.path.join(self.config["output_dir"], f"{stem}.{extension}")
+                    if os.path.exists(filepath):
+                        return filepath
+                raise OfflineMiss(f"{stem} was never downloaded and offline mode is on")
+
+            link, extension = await self.resolve_download_link(track, target_format, job)
+            filename = f"{stem}.{extension}"
+            filepath = os.path.join(self.config["output_dir"], filename)
+            await self.fetch_yandex_file(link, filepath, track, job)
+            logger.info(f"Successfully downloaded: {filename}")
+            return filepath
+        except Exception as e:
+            logger.error(f"Error downloading Yandex track {track.id}: {e}", exc_info=True)
+            return None
+
+    async def stream_yandex_track(self, track, output_formats: List[str], job: str = "") -> List[str]:
+        try:
+            if self.metadata.offline:
+                raise OfflineMiss("streaming needs the network and offline mode is on")
+            link, extension = await self.resolve_download_link(track, source_format(output_formats), job)
+            stem = track_file_stem(track)
+            if not needs_conversion(f"{stem}.{extension}", output_formats):
+                # The source already is what was asked for; ffmpeg has nothing to add.
+                converted_dir = self.config["converted_dir"]
+                os.makedirs(converted_dir, exist_ok=True)
+                filepath = os.path.join(converted_dir, f"{stem}.{extension}")
+                await self.fetch_yandex_file(link, filepath, track, job)
+                return [filepath]
+            chunk_size = int(self.config["yandex_chunk_kb"]) * 1024
+
+            # A stream can't resume into ffmpeg, so it's paced but not retried.
+            async with self.download_slots, self.yandex_cdn.slot():
+                logger.info(f"Streaming Yandex track {track.id} into {', '.join(output_formats)}")
+                # Download and conversion overlap here, so this one span covers both.
+                with self.metrics.span(SPAN_DOWNLOAD, job=job, item=stem) as span:
+                    async with self.http_session.get(link) as response:
+                        response.raise_for_status()
+                        on_progress = self.byte_progress(job, stem)
+                        span.bytes = 0
+
+                        async def chunks():
+                            async for chunk in response.content.iter_chunked(chunk_size):
+                                span.bytes += len(chunk)
+                                if on_progress:
+                                    on_progress(span.bytes, response.content_length)
+                                yield chunk
+
+                        outputs = await self.converter.convert_stream(chunks(), stem, output_formats, extension)
+                    if not outputs:
+                        span.fail()
+            return list(outputs.values())
+        except Exception as e:
+            logger.error(f"Error streaming Yandex track {track.id}: {e}", exc_info=True)
+            return []
+
+    def run_yandex_download(self, url: str, stream_formats: Optional[List[str]] = None,
+                            on_skip: Optional[Callable[[str], None]] = None,
+                            output_formats: Optional[List[str]] = None,
+                            on_fail: Optional[Callable[[str], None]] = None) -> List[str]:
+        # output_formats: what the files will be converted to afterwards, which decides the
+        # variant worth downloading. stream_formats: convert on the fly instead. on_skip and
+        # on_fail hear about the tracks that were already there and the ones that didn't make it.
+        token = self.yandex_token
+        skipped = []
+        failed = []
+        target_format = source_format(output_formats)
+
+        async def download_one(track) -> List[str]:
+            source_id = f"yandex:{track.id}"
+            existing = self.find_in_library(
+                source_id,
+                track.artists[0].name if track.artists else None,
+                track.title,
+                track.duration_ms / 1000 if track.duration_ms else None
+            )
+            if existing:
+                skipped.append(existing)
+                if on_skip:
+                    on_skip(existing)
+                return []
+
+            if stream_formats:
+                files = await self.stream_yandex_track(track, stream_formats, job=url)
+            else:
+                filepath = await self.download_yandex_track(track, target_format, job=url)
+                files = [filepath] if filepath else []
+            if not files:
+                # The reason is in the log already; the job's result still has to say which one.
+                label = f"{track_file_stem(track)} ({source_id})"
+                failed.append(label)
+                if on_fail:
+                    on_fail(label)
+            self.remember_downloads([(source_id, path) for path in files])
+            return files
+
+        async def async_download():
+            await self.initialize_yandex_client(token)
+            self.set_status("Fetching track info from Yandex Music...")
+            try:
+                with self.metrics.span(SPAN_RESOLVE, job=url):
+                    tracks = await self.resolve_yandex_tracks(url)
+            except Exception as e:
+                logger.error(f"Could not resolve Yandex link {url}: {e}", exc_info=True)
+                self.set_status("Download failed")
+                return []
+
+            self.set_status(f"Downloading {len(tracks)} tracks from Yandex Music...")
+            # Link resolution and downloads for all tracks are queued at once;
+            # the shared semaphores decide how many actually run.
+            results = await asyncio.gather(*[download_one(track) for track in tracks])
+            files = [path for paths in results for path in paths]
+
+            if files:
+                self.set_status("Download completed")
+            elif skipped:
+                self.set_status("Already in the library")
+            else:
+                self.set_status("Download failed")
+            if skipped:
+                logger.info(f"{len(skipped)} of {len(tracks)} tracks from {url} were already in the library")
+            if failed:
+                logger.warning(f"{len(failed)} of {len(tracks)} tracks from {url} failed: {', '.join(failed)}")
+            return files
+
+        # Every job is just another coroutine on the shared loop, so they overlap freely.
+        return self.get_loop_thread().run(async_download())
+
+    async def close_http_session(self):
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
+    def close(self):
+        self.spotdl_pool.close()
+        self.metadata.close()
+        if self.loop_thread is not None:
+            try:
+                self.loop_thread.run(self.close_http_session(), timeout=5)
+            except Exception as e:
+                logger.warning(f"Error closing HTTP session: {e}")
+            self.loop_thread.stop()
+            self.loop_thread = None
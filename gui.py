@@ -0,0 +1,738 @@
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+import customtkinter as ctk
+import logging
+import threading
+from pathlib import Path
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+from catalog import LibraryCatalog, Track
+from converter import AudioConverter, ReplayGainBatch, ffmpeg_available, needs_conversion
+from downloader import Downloader
+from journal import JOURNAL_CONVERTING, JOURNAL_DOWNLOADED, JobJournal
+from metrics import Metrics, MetricsExporter
+from pipeline import ConversionPipeline
+from progress import CONVERT, CONVERTED, DOWNLOAD, JOB, STATUS, ProgressBus, ProgressEvent
+from scheduler import DONE, RUNNING, DownloadJob, DownloadScheduler, parse_links, read_links_file
+from settings import CONFIG_PATH, load_config, save_config
+from song_list import VirtualSongList
+
+logger = logging.getLogger(__name__)
+
+class MusicDownloaderApp:
+    def __init__(self, config_path: Path = CONFIG_PATH):
+        self.window = ctk.CTk()
+        self.window.title("Shadow Wizard Kitten Gang")
+        self.window.geometry("800x600")
+        
+        # Because dark mode is cooler, obviously.
+        ctk.set_appearance_mode("dark")
+        ctk.set_default_color_theme("blue")
+        
+        self.config_path = config_path
+        self.config = load_config(config_path)
+        
+        self.status_var = tk.StringVar(value="Ready")
+        self.queue_var = tk.StringVar(value="")
+        self.reported_failures = 0
+        # Everything off the Tk thread reports through here; drain_progress() picks it up once a frame.
+        self.progress = ProgressBus()
+        self.progress_listeners: List[Callable[[ProgressEvent], None]] = []
+        self.jobs_by_url: Dict[str, DownloadJob] = {}
+        self.job_progress: Dict[str, Dict[str, float]] = {}
+        # Library changes from any thread, applied to the song list in bulk once a frame.
+        self.library_lock = threading.Lock()
+        self.library_changes: List[tuple] = []
+        # Per-stage timings from every component, served or dumped as configured.
+        self.metrics = Metrics()
+        self.metrics_exporter = MetricsExporter.from_config(self.metrics, self.config).start()
+        
+        self.catalog = LibraryCatalog(
+            self.config["library_db"],
+            [self.config["output_dir"], self.config["converted_dir"]],
+            on_change=self.on_library_change,
+            metrics=self.metrics
+        )
+        self.converter = AudioConverter(self.config, on_evict=self.catalog.remove_many, progress=self.progress,
+                                        metrics=self.metrics, on_retag=self.catalog.add_many)
+        self.downloader = Downloader(self.config, self.converter, progress=self.progress, library=self.catalog,
+                                     metrics=self.metrics)
+        # Finished downloads flow straight into conversion while the rest keep downloading.
+        self.pipeline = ConversionPipeline(
+            self.converter,
+            on_result=self.on_pipeline_result,
+            workers=self.converter.worker_count(),
+            queue_size=self.config["pipeline_queue_size"],
+            metrics=self.metrics
+        )
+        # Survives crashes and restarts, so a half-done playlist carries on next time.
+        self.journal = JobJournal(self.config["library_db"], self.config["journal_flush_ms"] / 1000)
+        
+        self.scheduler = DownloadScheduler(
+            handlers={"spotify": self.run_spotify_job, "yandex": self.run_yandex_job},
+            max_workers=self.config["max_concurrent_downloads"],
+            platform_limits=self.config["platform_concurrency"],
+            on_update=self.on_job_update,
+            metrics=self.metrics
+        )
+        
+        self.setup_ui()
+        
+        # Is FFmpeg installed? Or are we just pretending it's installed?
+        self.check_ffmpeg()
+        
+        self.refresh_file_list()
+        self.rescan_library()
+        self.resume_unfinished()
+        self.drain_progress()
+
+    def check_ffmpeg(self):
+        if ffmpeg_available():
+            logger.info("FFmpeg is available.")
+        else:
+            messagebox.showerror("Error", "FFmpeg is not installed or not found in PATH.")
+            logger.error("FFmpeg is not installed or not found in PATH.")
+            self.window.destroy()
+
+    def setup_ui(self):
+        self.main_container = ctk.CTkFrame(self.window)
+        self.main_container.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        self.welcome_frame = self.create_welcome_frame()
+        self.download_frame = self.create_download_frame()
+
+        # Built by Chun - because who else would build it?
+        fine_print = ctk.CTkLabel(
+            self.window,
+            text="Built by Chun",
+            font=("Helvetica", 10),
+            anchor="se"
+        )
+        fine_print.place(relx=1.0, rely=1.0, anchor="se")
+
+        self.show_welcome_screen()
+
+    def create_welcome_frame(self) -> ctk.CTkFrame:
+        frame = ctk.CTkFrame(self.main_container)
+        
+        welcome_label = ctk.CTkLabel(
+            frame,
+            text="Welcome to Music Downloader",
+            font=("Helvetica", 24, "bold")
+        )
+        welcome_label.pack(pady=20)
+        
+        platform_frame = ctk.CTkFrame(frame)
+        platform_frame.pack(pady=20)
+        
+        ctk.CTkLabel(
+            platform_frame,
+            text="Select your music platform:",
+            font=("Helvetica", 16)
+        ).pack(pady=10)
+        
+        ctk.CTkButton(
+            platform_frame,
+            text="Yandex Music",
+            command=lambda: self.select_platform("yandex")
+        ).pack(pady=5)
+        
+        ctk.CTkButton(
+            platform_frame,
+            text="Spotify",
+            command=lambda: self.select_platform("spotify")
+        ).pack(pady=5)
+        
+        return frame
+        
+    def create_download_frame(self) -> ctk.CTkFrame:
+        frame = ctk.CTkFrame(self.main_container)
+        
+        url_frame = ctk.CTkFrame(frame)
+        url_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ctk.CTkLabel(url_frame, text="Song URLs:").pack(side=tk.LEFT, anchor="n", padx=5)
+        # One link per line. Paste a whole playlist's worth, we don't judge.
+        self.url_text = ctk.CTkTextbox(url_frame, width=300, height=70)
+        self.url_text.pack(side=tk.LEFT, padx=5)
+        ctk.CTkButton(url_frame, text="Load Links...", command=self.load_links_file).pack(side=tk.LEFT, anchor="n", padx=5)
+        
+        self.token_var = tk.StringVar()
+        token_frame = ctk.CTkFrame(frame)
+        token_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ctk.CTkLabel(token_frame, text="API Token:").pack(side=tk.LEFT, padx=5)
+        self.token_entry = ctk.CTkEntry(token_frame, textvariable=self.token_var, width=300, show="*")
+        self.token_entry.pack(side=tk.LEFT, padx=5)
+        
+        ctk.CTkLabel(frame, textvariable=self.status_var).pack(pady=5)
+        
+        jobs_frame = ctk.CTkFrame(frame)
+        jobs_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ctk.CTkLabel(jobs_frame, textvariable=self.queue_var).pack(anchor="w", padx=5)
+        
+        self.jobs_listbox = tk.Listbox(
+            jobs_frame,
+            bg="#2b2b2b",
+            fg="white",
+            selectbackground="#1f538d",
+            height=5
+        )
+        self.jobs_listbox.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
+        jobs_scrollbar = ttk.Scrollbar(jobs_frame)
+        jobs_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        self.jobs_listbox.config(yscrollcommand=jobs_scrollbar.set)
+        jobs_scrollbar.config(command=self.jobs_listbox.yview)
+        
+        search_frame = ctk.CTkFrame(frame)
+        search_frame.pack(fill=tk.X, padx=10, pady=(5, 0))
+        
+        ctk.CTkLabel(search_frame, text="Search:").pack(side=tk.LEFT, padx=5)
+        self.search_var = tk.StringVar()
+        ctk.CTkEntry(search_frame, textvariable=self.search_var, width=300).pack(side=tk.LEFT, padx=5)
+        # Artist, title or format, any part of it; every word has to match.
+        self.search_var.trace_add("write", lambda *_: self.songs_list.set_filter(self.search_var.get()))
+        
+        list_frame = ctk.CTkFrame(frame)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        self.songs_list = VirtualSongList(
+            list_frame,
+            sort_key=self.catalog.sort_key,
+            frame_budget=self.frame_budget(),
+            height=15
+        )
+        self.songs_list.pack(fill=tk.BOTH, expand=True)
+        
+        button_frame = ctk.CTkFrame(frame)
+        button_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ctk.CTkButton(button_frame, text="Download", command=self.start_download).pack(side=tk.LEFT, padx=5)
+        ctk.CTkButton(button_frame, text="Cancel Queued", command=self.cancel_queued_downloads).pack(side=tk.LEFT, padx=5)
+        ctk.CTkButton(button_frame, text="Convert", command=self.show_convert_dialog).pack(side=tk.LEFT, padx=5)
+        ctk.CTkButton(button_frame, text="Clear List", command=self.clear_list).pack(side=tk.LEFT, padx=5)
+        
+        self.auto_convert_var = tk.BooleanVar(value=self.config["auto_convert"])
+        self.auto_format_var = tk.StringVar(value=self.config["auto_convert_format"])
+        ctk.CTkCheckBox(
+            button_frame,
+            text="Auto-convert to",
+            variable=self.auto_convert_var,
+            command=self.update_auto_convert
+        ).pack(side=tk.LEFT, padx=5)
+        ctk.CTkOptionMenu(
+            button_frame,
+            variable=self.auto_format_var,
+            values=self.config["supported_formats"],
+            command=lambda _: self.update_auto_convert(),
+            width=80
+        ).pack(side=tk.LEFT, padx=5)
+        
+        return frame
+
+    def start_download(self):
+        urls = parse_links(self.url_text.get("1.0", tk.END))
+        if not urls:
+            messagebox.showwarning("Warning", "Please enter a URL")
+            return
+        
+        if self.current_platform == "yandex":
+            token = self.token_var.get().strip()
+            if not token and not self.config["offline"]:
+                messagebox.showwarning("Warning", "Please enter your Yandex Music token")
+                return
+            # A Yandex token is only needed once per batch, not once per song.
+            self.downloader.yandex_token = token
+        
+        self.url_text.delete("1.0", tk.END)
+        # Fixed at queueing time: changing the setting later doesn't touch what's already queued,
+        # and the journal resumes them with the same formats.
+        output_formats = self.auto_convert_formats()
+        self.journal.add(self.current_platform, urls, output_formats)
+        self.scheduler.submit(self.current_platform, urls, output_formats)
+        self.status_var.set(f"Queued {len(urls)} downloads")
+
+    def load_links_file(self):
+        path = filedialog.askopenfilename(
+            title="Load links",
+            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
+        )
+        if not path:
+            return
+        try:
+            links = read_links_file(path)
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error(f"Error reading links file {path}: {e}", exc_info=True)
+            messagebox.showerror("Error", f"Could not read {os.path.basename(path)}: {e}")
+            return
+        self.url_text.insert(tk.END, "\n".join(links) + "\n")
+
+    def update_auto_convert(self):
+        # Workers read these from the config, so they never have to touch Tk variables.
+        self.config["auto_convert"] = self.auto_convert_var.get()
+        self.config["auto_convert_format"] = self.auto_format_var.get()
+
+    def auto_convert_formats(self) -> List[str]:
+        return [self.config["auto_convert_format"]] if self.config["auto_convert"] else []
+
+    def job_formats(self, job: DownloadJob) -> List[str]:
+        # What the job was queued with, in this run or the one before.
+        return self.auto_convert_formats() if job.output_formats is None else job.output_formats
+
+    def finish_download(self, job: DownloadJob, files: List[str],
+                        output_formats: Optional[List[str]] = None) -> List[str]:
+        # The downloader has already put these in the catalog (and the dedup index).
+        if output_formats is None:
+            output_formats = self.auto_convert_formats()
+        # Files that came down in the wanted format already are finished as they are.
+        to_convert = [f for f in files if needs_conversion(f, output_formats)]
+        self.journal.finish_download(job.platform, job.url, files, to_convert)
+        # Tagged as one album once the last of the job's conversions is done.
+        album = ReplayGainBatch(self.converter, len(files))
+        for filepath in files:
+            if filepath not in to_convert:
+                album.add(filepath, [filepath])
+        for filepath in to_convert:
+            # Blocks while the conversion queue is full, which is exactly the point.
+            self.pipeline.submit(filepath, output_formats, (job, album))
+        return files
+
+    def run_spotify_job(self, job: DownloadJob) -> List[str]:
+        output_formats = self.job_formats(job)
+        files = self.downloader.download_spotify_track(
+            job.url, on_skip=job.skipped.append, output_formats=output_formats, on_fail=job.failed_tracks.append)
+        return self.finish_download(job, files, output_formats)
+
+    def run_yandex_job(self, job: DownloadJob) -> List[str]:
+        output_formats = self.job_formats(job)
+        if output_formats and self.config["yandex_streaming"]:
+            # Straight from the network into ffmpeg: the files are already converted.
+            files = self.downloader.run_yandex_download(job.url, output_formats, on_skip=job.skipped.append,
+                                                        on_fail=job.failed_tracks.append)
+            return self.finish_download(job, files, output_formats=[])
+        files = self.downloader.run_yandex_download(
+            job.url, on_skip=job.skipped.append, output_formats=output_formats, on_fail=job.failed_tracks.append)
+        return self.finish_download(job, files, output_formats)
+
+    def resume_unfinished(self):
+        entries = self.journal.unfinished()
+        if not entries:
+            return
+
+        held_back = []
+        downloads: Dict[Tuple[str, Tuple[str, ...]], List[str]] = {}
+        conversions = []
+        for entry in entries:
+            if entry.state in (JOURNAL_DOWNLOADED, JOURNAL_CONVERTING) and entry.files and \
+                    all(os.path.exists(f) for f in entry.files):
+                conversions.append(entry)
+            elif entry.platform == "yandex" and not self.config["offline"]:
+                # No token until someone types it in; these wait in the link box instead.
+                held_back.append(entry.url)
+            else:
+                downloads.setdefault((entry.platform, tuple(entry.output_formats)), []).append(entry.url)
+
+        for (platform, output_formats), urls in downloads.items():
+            self.scheduler.submit(platform, urls, list(output_formats))
+        if held_back:
+            self.url_text.insert(tk.END, "\n".join(held_back) + "\n")
+
+        def resume_conversions():
+            for entry in conversions:
+                job = DownloadJob(job_id=-1, platform=entry.platform, url=entry.url, state=DONE, files=entry.files)
+                # Outputs finished before the restart come straight back out of the conversion cache.
+                self.finish_download(job, entry.files, entry.output_formats)
+
+        # The pipeline queue is bounded and submit() waits for room, which the Tk thread mustn't.
+        threading.Thread(target=resume_conversions, daemon=True).start()
+
+        message = f"Resumed {len(entries) - len(held_back)} unfinished jobs from last time"
+        if held_back:
+            message += f"; {len(held_back)} Yandex links need your token (select Yandex Music and hit Download)"
+        self.status_var.set(message)
+
+    def frame_budget(self) -> float:
+        # Half a frame for filtering, the rest is for drawing and everything else.
+        return 0.5 / max(1, int(self.config["ui_fps"]))
+
+    def on_library_change(self, added: List[Track], removed: List[str]):
+        with self.library_lock:
+            self.library_changes.append((added, removed))
+
+    def apply_library_changes(self):
+        with self.library_lock:
+            changes, self.library_changes = self.library_changes, []
+        if not changes:
+            return
+        # Folded into one removal and one insertion, whatever happened in between.
+        added: Dict[str, Track] = {}
+        removed = set()
+        for batch_added, batch_removed in changes:
+            for path in batch_removed:
+                added.pop(path, None)
+                removed.add(path)
+            for track in batch_added:
+                added[track.path] = track
+                removed.discard(track.path)
+        self.songs_list.remove_paths(removed)
+        self.songs_list.add_tracks(added.values())
+
+    def on_job_update(self, job: DownloadJob):
+        self.journal.on_job_update(job)
+        self.progress.publish(ProgressEvent(job=job.url, stage=JOB, item=str(job.job_id)))
+
+    def on_pipeline_result(self, source: str, outputs: Dict[str, str], context):
+        job, album = context
+        self.journal.finish_conversion(job.platform, job.url, source, bool(outputs))
+        if outputs:
+            self.catalog.add_many(outputs.values())
+        self.progress.publish(ProgressEvent(
+            job=source, stage=CONVERTED, item="pipeline", message="converted" if outputs else "failed"))
+        album.add(source, outputs.values())
+
+    def drain_progress(self):
+        try:
+            touched: Dict[int, DownloadJob] = {}
+            queue_changed = False
+            for event in self.progress.drain():
+                if event.stage == STATUS:
+                    self.status_var.set(event.message)
+                elif event.stage == JOB:
+                    job = self.scheduler.jobs[int(event.item)]
+                    self.jobs_by_url[job.url] = job
+                    if job.state != RUNNING:
+                        self.job_progress.pop(job.url, None)
+                    touched[job.job_id] = job
+                    queue_changed = True
+                elif event.stage == DOWNLOAD:
+                    job = self.jobs_by_url.get(event.job)
+                    if job is not None and job.state == RUNNING and event.percent is not None:
+                        self.job_progress.setdefault(job.url, {})[event.item] = event.percent
+                        touched[job.job_id] = job
+                        self.status_var.set(f"{event.item}: {event.message or 'downloading'} ({event.percent:.0f}%)")
+                elif event.stage == CONVERTED and event.item == "pipeline":
+                    queue_changed = True
+
+                for listener in list(self.progress_listeners):
+                    listener(event)
+
+            self.apply_library_changes()
+            # drain() hands events back in last-changed order; rows are indexed by job_id.
+            for job_id in sorted(touched):
+                self.update_job_row(touched[job_id])
+            if queue_changed:
+                self.update_queue_summary()
+        except Exception as e:
+            logger.error(f"Error updating progress: {e}", exc_info=True)
+        finally:
+            # A fixed frame rate, however busy the workers are.
+            self.window.after(max(10, 1000 // int(self.config["ui_fps"])), self.drain_progress)
+
+    def cancel_queued_downloads(self):
+        cancelled = self.scheduler.cancel_pending()
+        cancelled_conversions = self.pipeline.cancel_pending()
+        self.status_var.set(f"Cancelled {cancelled} queued downloads and {cancelled_conversions} queued conversions")
+
+    def update_queue_status(self):
+        counts = self.scheduler.counts()
+        self.queue_var.set(
+            f"Queued: {counts['queued']} | Running: {counts['running']} | "
+            f"Done: {counts['done']} | Skipped: {counts['skipped']} | Failed: {counts['failed']} | "
+            f"Converting: {self.pipeline.pending()}"
+        )
+        if self.scheduler.is_idle() and not self.pipeline.pending():
+            self.journal.forget_finished()
+        return counts
+
+    def job_row(self, job: DownloadJob) -> str:
+        state = job.state
+        progress = self.job_progress.get(job.url)
+        if job.state == RUNNING and progress:
+            # A playlist is as far along as its tracks are, on average.
+            state = f"{job.state} {min(100.0, sum(progress.values()) / len(progress)):.0f}%"
+        row = f"[{state}] {job.platform}: {job.url}"
+        if job.failed_tracks and job.state != RUNNING:
+            row += f" ({len(job.failed_tracks)} tracks failed)"
+        return row
+
+    def update_job_row(self, job: DownloadJob):
+        # Row n is always job n: jobs we haven't heard about yet get their row now, so
+        # replacing this one never shifts anyone else's.
+        for earlier in self.scheduler.jobs[self.jobs_listbox.size():job.job_id]:
+            self.jobs_listbox.insert(tk.END, self.job_row(earlier))
+        if job.job_id < self.jobs_listbox.size():
+            self.jobs_listbox.delete(job.job_id)
+        self.jobs_listbox.insert(job.job_id, self.job_row(job))
+
+    def update_queue_summary(self):
+        counts = self.update_queue_status()
+        
+        # One summary when the queue drains beats a dialog per broken link.
+        new_failures = counts['failed'] - self.reported_failures
+        if new_failures > 0 and self.scheduler.is_idle():
+            self.reported_failures = counts['failed']
+            messagebox.showwarning("Warning", f"{new_failures} downloads failed. Check music_downloader.log for details.")
+
+    def show_convert_dialog(self):
+        selected_paths = self.songs_list.selected_paths()
+        if not selected_paths:
+            messagebox.showwarning("Warning", "Please select songs to convert")
+            return
+        
+        dialog = ctk.CTkToplevel(self.window)
+        dialog.title("Audio Converter")
+        dialog.geometry("500x600")
+        
+        dialog.transient(self.window)
+        dialog.grab_set()
+        
+        dialog.focus_set()
+        dialog.lift()
+        
+        main_frame = ctk.CTkFrame(dialog)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=20)
+        
+        header_label = ctk.CTkLabel(
+            main_frame,
+            text="Convert Audio Files",
+            font=("Helvetica", 20, "bold")
+        )
+        header_label.pack(pady=(0, 20))
+        
+        files_frame = ctk.CTkFrame(main_frame)
+        files_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 20))
+        
+        files_label = ctk.CTkLabel(
+            files_frame,
+            text="Selected Files:",
+            font=("Helvetica", 14, "bold")
+        )
+        files_label.pack(anchor="w", padx=10, pady=(10, 5))
+        
+        # Shares the track objects with the main list rather than copying names row by row.
+        files_list = VirtualSongList(
+            files_frame,
+            sort_key=self.catalog.sort_key,
+            frame_budget=self.frame_budget(),
+            selectable=False,
+            height=8
+        )
+        files_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        tracks = self.songs_list.index.tracks
+        files_list.set_tracks([track for track in tracks if track.path in self.songs_list.selected])
+        
+        format_frame = ctk.CTkFrame(main_frame)
+        format_frame.pack(fill=tk.X, pady=(0, 20))
+        
+        format_label = ctk.CTkLabel(
+            format_frame,
+            text="Output Formats:",
+            font=("Helvetica", 14, "bold")
+        )
+        format_label.pack(anchor="w", padx=10, pady=(10, 5))
+        
+        # Tick as many as you like, every source still only gets decoded once.
+        format_vars = {
+            fmt: tk.BooleanVar(value=fmt == self.config["default_format"])
+            for fmt in self.config["supported_formats"]
+        }
+        formats_container = ctk.CTkFrame(format_frame)
+        formats_container.pack(fill=tk.X, padx=10, pady=(0, 10))
+        
+        for fmt, fmt_var in format_vars.items():
+            ctk.CTkCheckBox(
+                formats_container,
+                text=fmt.upper(),
+                variable=fmt_var,
+                font=("Helvetica", 12)
+            ).pack(side=tk.LEFT, padx=10)
+        
+        progress_frame = ctk.CTkFrame(main_frame)
+        progress_frame.pack(fill=tk.X, pady=(0, 20))
+        
+        progress_var = tk.StringVar(value="")
+        progress_label = ctk.CTkLabel(
+            progress_frame,
+            textvariable=progress_var,
+            font=("Helvetica", 12)
+        )
+        progress_label.pack(pady=10)
+        
+        progress_bar = ctk.CTkProgressBar(progress_frame)
+        progress_bar.pack(fill=tk.X, padx=10, pady=(0, 10))
+        progress_bar.set(0)
+        
+        buttons_frame = ctk.CTkFrame(main_frame)
+        buttons_frame.pack(fill=tk.X, pady=(0, 10))
+        
+        cancel_event = threading.Event()
+        
+        def cancel_conversion():
+            self.converter.cancel_conversions(cancel_event)
+            dialog.destroy()
+        
+        def start_conversion():
+            output_formats = [fmt for fmt, fmt_var in format_vars.items() if fmt_var.get()]
+            if not output_formats:
+                messagebox.showwarning("Warning", "Please pick at least one output format", parent=dialog)
+                return
+            self.convert_selected_songs(selected_paths, output_formats, dialog, progress_var, progress_bar, cancel_event)
+        
+        ctk.CTkButton(
+            buttons_frame,
+            text="Convert",
+            command=start_conversion,
+            width=120
+        ).pack(side=tk.RIGHT, padx=5)
+        
+        ctk.CTkButton(
+            buttons_frame,
+            text="Cancel",
+            command=cancel_conversion,
+            width=120
+        ).pack(side=tk.RIGHT, padx=5)
+
+    def convert_selected_songs(self, selected_paths: List[str], output_formats: List[str],
+                            dialog: ctk.CTkToplevel, progress_var: tk.StringVar,
+                            progress_bar: ctk.CTkProgressBar, cancel_event: threading.Event):
+        total_files = len(selected_paths)
+        converted_files = []
+        failed_conversions = []
+        workers = max(1, min(self.converter.worker_count(), total_files))
+        
+        progress_bar.set(0)
+        progress_var.set(f"Converting {total_files} files ({workers} at a time)...")
+        
+        selected = set(selected_paths)
+        finished = set()
+        partial: Dict[str, float] = {}
+        
+        def on_progress(event: ProgressEvent):
+            if cancel_event.is_set() or event.job not in selected or event.job in finished:
+                return
+            if event.stage == CONVERT and event.percent is not None:
+                partial[event.job] = min(100.0, event.percent)
+            elif event.stage == CONVERTED and event.item == "dialog":
+                finished.add(event.job)
+                partial.pop(event.job, None)
+                verb = "Converted" if event.message == "converted" else "Failed"
+                progress_var.set(f"{verb} {len(finished)}/{total_files}: {os.path.basename(event.job)}")
+            else:
+                return
+            # Finished files plus however far ffmpeg has got with the ones in flight.
+            progress_bar.set((len(finished) + sum(partial.values()) / 100) / total_files)
+            if len(finished) == total_files:
+                conversion_finished()
+        
+        def conversion_finished():
+            # The new files are already in the song list; the catalog passed them along.
+            if converted_files:
+                progress_var.set("Conversion completed successfully!")
+                messagebox.showinfo("Success", f"Successfully converted {len(converted_files)} files")
+            if failed_conversions:
+                messagebox.showwarning("Warning", f"Failed to convert {len(failed_conversions)} files")
+        
+        self.progress_listeners.append(on_progress)
+        
+        def stop_listening(event):
+            if event.widget is dialog and on_progress in self.progress_listeners:
+                self.progress_listeners.remove(on_progress)
+        
+        dialog.bind("<Destroy>", stop_listening, add="+")
+        
+        def conversion_task():
+            tagged: Dict[str, List[str]] = {}
+            try:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="convert") as executor:
+                    futures = {
+                        executor.submit(self.converter.convert_to_formats, input_path, output_formats, cancel_event): input_path
+                        for input_path in selected_paths
+                    }
+                    # Whoever finishes first gets reported first. No waiting in line.
+                    for future in as_completed(futures):
+                        input_path = futures[future]
+                        outputs = future.result()
+                        converted = len(outputs) == len(output_formats)
+                        if outputs:
+                            converted_files.extend(outputs.values())
+                            self.catalog.add_many(outputs.values())
+                        if not converted:
+                            failed_conversions.append(input_path)
+                        self.progress.publish(ProgressEvent(
+                            job=input_path, stage=CONVERTED, item="dialog",
+                            message="converted" if converted else "failed"))
+                        if outputs:
+                            tagged[input_path] = list(outputs.values())
+                # The last of those events wraps things up in the dialog, once the UI gets to it.
+                # The selection is one album as far as ReplayGain goes; the loudness was measured
+                # during the conversions, so this is just tag writing.
+                self.converter.apply_replaygain(tagged, cancel_event)
+            except Exception as e:
+                logger.error(f"Error during conversion: {e}", exc_info=True)
+                error = str(e)
+                self.window.after(0, lambda: progress_var.set(f"Error: {error}"))
+                self.window.after(0, lambda: messagebox.showerror("Error", f"Conversion failed: {error}"))
+                self.window.after(0, dialog.destroy)
+        
+        # Because why not add some excitement to conversion?
+        threading.Thread(target=conversion_task, daemon=True).start()
+
+    def clear_list(self):
+        self.songs_list.set_tracks([])
+
+    def show_welcome_screen(self):
+        self.download_frame.pack_forget()
+        self.welcome_frame.pack(fill=tk.BOTH, expand=True)
+
+    def select_platform(self, platform: str):
+        self.current_platform = platform
+        self.welcome_frame.pack_forget()
+        self.download_frame.pack(fill=tk.BOTH, expand=True)
+        
+        if platform == "yandex":
+            self.token_entry.pack()
+        else:
+            self.token_entry.pack_forget()
+
+    def cleanup(self):
+        try:
+            # First, so the work interrupted below is still unfinished when we come back.
+            self.journal.close()
+            self.converter.cancel_conversions()
+            self.pipeline.close()
+            self.scheduler.shutdown()
+            self.downloader.close()
+            self.converter.close()
+            self.catalog.close()
+            self.metrics_exporter.close()
+            
+            save_config(self.config, self.config_path)
+                
+        except Exception as e:
+            logger.error(f"Error during cleanup: {e}", exc_info=True)
+
+    def run(self):
+        try:
+            self.window.mainloop()
+        finally:
+            self.cleanup()
+
+    def rescan_library(self):
+        def rescan_task():
+            try:
+                # Whatever changed reaches the song list through on_library_change().
+                self.catalog.rescan()
+            except Exception as e:
+                logger.error(f"Error rescanning library: {e}", exc_info=True)
+        
+        # A first scan of a big library reads a lot of tags; the UI has better things to do.
+        threading.Thread(target=rescan_task, daemon=True).start()
+
+    def refresh_file_list(self):
+        # The one full load; after this the list only ever gets the changes.
+        self.songs_list.set_tracks(self.catalog.list_tracks())
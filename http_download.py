@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Callable, Optional, Tuple
+
+from rate_limit import RETRYABLE_STATUSES, TRANSIENT, ProviderLimiter, classify_error
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        # Seconds the server asked us to wait, from Retry-After.
+        self.retry_after = retry_after
+
+
+class RangeNotSupported(DownloadError):
+    # A 200 to a bounded range: this server only ever sends the whole file. Not worth retrying,
+    # the download has to go back to one stream.
+    def __init__(self, url: str):
+        super().__init__(f"Server ignored the range request for {url}", 200)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Only the delta-seconds form; CDNs don't bother with the HTTP-date one.
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+def classify_download_error(error: BaseException) -> Optional[str]:
+    # A cut-off transfer or a short range is worth another go, status or not.
+    if isinstance(error, DownloadError) and error.status is None:
+        return TRANSIENT
+    return classify_error(error)
+
+
+def part_path(dest: str) -> str:
+    return f"{dest}.part"
+
+
+def segment_path(dest: str, index: int) -> str:
+    return f"{dest}.part{index}"
+
+
+def info_path(path: str) -> str:
+    # Which file a .part holds bytes of, so a resume never stitches two different files together.
+    return f"{path}.meta"
+
+
+def read_part_info(path: str) -> Optional[dict]:
+    try:
+        with open(info_path(path), encoding="utf-8") as f:
+            info = json.load(f)
+        return info if isinstance(info, dict) else None
+    except (OSError, ValueError):
+        return None
+
+
+def write_part_info(path: str, headers, total: Optional[int]):
+    # A strong ETag if there is one, else Last-Modified; both work as If-Range validators.
+    etag = headers.get("ETag")
+    validator = etag if etag and not etag.startswith("W/") else headers.get("Last-Modified")
+    with open(info_path(path), "w", encoding="utf-8") as f:
+        json.dump({"validator": validator, "total": total}, f)
+
+
+def remove_part(path: str):
+    for leftover in (path, info_path(path)):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+async def probe(session, url: str) -> Tuple[Optional[int], bool]:
+    # A one-byte range request tells us the size and whether ranges work, without a HEAD
+    # (some CDNs sign URLs per method and reject HEAD outright).
+    async with session.get(url, headers={"Range": "bytes=0-0"}) as response:
+        if response.status == 206:
+            match = re.search(r"/(\d+)$", response.headers.get("Content-Range", ""))
+            return (int(match.group(1)) if match else None), True
+        if response.status == 200:
+            return response.content_length, False
+        raise DownloadError(f"HTTP {response.status} while probing {url}")
+
+
+async def fetch_range(session, url: str, path: str, start: int, end: Optional[int], chunk_size: int,
+                      on_chunk: Optional[Callable[[int, Optional[int]], None]] = None,
+                      on_restart: Optional[Callable[[int], None]] = None,
+                      expected_total: Optional[int] = None):
+    # Whatever is already in the file is ours, as long as it's from the same file; only ask for
+    # what's missing.
+    have = os.path.getsize(path) if os.path.exists(path) else 0
+    info = read_part_info(path) if have else None
+    if have and (info is None or (expected_total and info.get("total") != expected_total)):
+        logger.info(f"{path} is from an earlier version of {url}, starting it over")
+        remove_part(path)
+        if on_restart:
+            on_restart(have)
+        have, info = 0, None
+    if end is not None and start + have > end:
+        return
+
+    headers = {}
+    if start + have > 0 or end is not None:
+        headers["Range"] = f"bytes={start + have}-{'' if end is None else end}"
+        if have and info.get("validator"):
+            # If the file changed since, the server sends all of the new one instead.
+            headers["If-Range"] = info["validator"]
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 416 and end is None:
+            # Asked to resume at the very end: the file was already complete.
+            return
+        if response.status in RETRYABLE_STATUSES:
+            raise DownloadError(f"HTTP {response.status}", response.status,
+                                parse_retry_after(response.headers.get("Retry-After")))
+        if response.status not in (200, 206):
+            raise DownloadError(f"HTTP {response.status} for {url}", response.status)
+
+        mode = "ab"
+        if response.status == 200 and headers.get("Range"):
+            if end is not None:
+                raise RangeNotSupported(url)
+            # No range support, or the file changed: start over rather than appending garbage.
+            mode = "wb"
+            if have and on_restart:
+                on_restart(have)
+
+        # Size of the whole file, not just this range, so split downloads can add up their parts.
+        total = response.content_length
+        match = re.search(r"/(\d+)$", response.headers.get("Content-Range", ""))
+        if match:
+            total = int(match.group(1))
+
+        if mode == "ab" and have and info.get("total") and total != info["total"]:
+            # No validator to go on, but a different size means a different file (another bitrate,
+            # say). The next attempt starts from scratch.
+            remove_part(path)
+            if on_restart:
+                on_restart(have)
+            raise DownloadError(f"{url} is {total} bytes now, not {info['total']}; starting over")
+        if mode == "wb" or not have:
+            write_part_info(path, response.headers, total)
+
+        with open(path, mode) as f:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                f.write(chunk)
+                if on_chunk:
+                    on_chunk(len(chunk), total)
+
+
+async def with_retries(operation, retries: int, what: str, limiter: Optional[ProviderLimiter] = None):
+    # Each attempt resumes where the last one stopped. With a limiter, every attempt also takes
+    # one of its slots and tells it how things went.
+    limiter = limiter or ProviderLimiter(what)
+    return await limiter.call(operation, what, retries, classify_download_error)
+
+
+async def download_file(session, url: str, dest: str, chunk_size: int = 256 * 1024,
+                        parallel_ranges: int = 1, split_min_bytes: int = 8 * 1024 * 1024,
+                        retries: int = 3,
+                        on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+                        limiter: Optional[ProviderLimiter] = None) -> str:
+    partial = part_path(dest)
+    segments = 1
+    total = None
+
+    if parallel_ranges > 1:
+        total, accepts_ranges = await probe(session, url)
+        if accepts_ranges and total and total >= split_min_bytes:
+            segments = parallel_ranges
+
+    paths = [partial] if segments == 1 else [segment_path(dest, i) for i in range(segments)]
+    # Whatever survived an earlier attempt counts as done already.
+    done = [sum(os.path.getsize(p) for p in paths if os.path.exists(p))]
+
+    def on_chunk(size: int, file_total: Optional[int]):
+        done[0] += size
+        on_progress(done[0], file_total)
+
+    def on_restart(discarded: int):
+        done[0] -= discarded
+
+    chunk_callback = on_chunk if on_progress else None
+
+    if segments > 1:
+        bounds = [(total * i // segments, total * (i + 1) // segments - 1) for i in range(segments)]
+        tasks = [
+            asyncio.ensure_future(with_retries(
+                lambda i=i, start=start, end=end: fetch_range(
+                    session, url, segment_path(dest, i), start, end, chunk_size, chunk_callback, on_restart, total),
+                retries,
+                f"{dest} (part {i + 1}/{segments})",
+                limiter
+            ))
+            for i, (start, end) in enumerate(bounds)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except RangeNotSupported:
+            # The probe said ranges work, the actual requests say otherwise (a different CDN node,
+            # say). The segments are useless: drop them and fetch the file in one go.
+            logger.warning(f"Server ignored range requests for {dest}, downloading it in one piece")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for path in paths:
+                if os.path.exists(path):
+                    done[0] -= os.path.getsize(path)
+                remove_part(path)
+            segments = 1
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    if segments == 1:
+        await with_retries(
+            lambda: fetch_range(session, url, partial, 0, None, chunk_size, chunk_callback, on_restart, total),
+            retries, dest, limiter)
+    else:
+        with open(partial, "wb") as out:
+            for i in range(segments):
+                with open(segment_path(dest, i), "rb") as segment:
+                    while True:
+                        block = segment.read(chunk_size)
+                        if not block:
+                            break
+                        out.write(block)
+        if os.path.getsize(partial) != total:
+            remove_part(partial)
+            raise DownloadError(f"Expected {total} bytes for {dest}, got something else")
+        for i in range(segments):
+            remove_part(segment_path(dest, i))
+
+    # The final name only ever appears once the whole file is there.
+    os.replace(partial, dest)
+    if os.path.exists(info_path(partial)):
+        os.remove(info_path(partial))
+    return dest
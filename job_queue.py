@@ -0,0 +1,213 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+from scheduler import CANCELLED, DONE, FAILED, JOB_STATES, QUEUED, RUNNING, SKIPPED
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATES = (DONE, SKIPPED, FAILED, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS server_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    platform TEXT NOT NULL,
+    url TEXT NOT NULL,
+    output_formats TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    files TEXT NOT NULL DEFAULT '[]',
+    skipped TEXT NOT NULL DEFAULT '[]',
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS server_jobs_state ON server_jobs (state, platform, id);
+"""
+
+JOB_COLUMNS = ("id, platform, url, output_formats, state, worker, lease_expires, attempts, submitted, started, "
+               "finished, files, skipped, error")
+
+
+class LeaseLost(Exception):
+    # The job was cancelled, or its lease ran out and another worker has it now.
+    pass
+
+
+@dataclass
+class QueuedJob:
+    id: int
+    platform: str
+    url: str
+    output_formats: List[str] = field(default_factory=list)
+    state: str = QUEUED
+    worker: Optional[str] = None
+    lease_expires: Optional[float] = None
+    attempts: int = 0
+    submitted: float = 0.0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    files: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def job_from_row(row: tuple) -> QueuedJob:
+    (job_id, platform, url, output_formats, state, worker, lease_expires, attempts, submitted, started,
+     finished, files, skipped, error) = row
+    return QueuedJob(job_id, platform, url, json.loads(output_formats), state, worker, lease_expires, attempts,
+                     submitted, started, finished, json.loads(files), json.loads(skipped), error)
+
+
+class JobQueue:
+    # The server's side of the worker model: jobs wait here until a worker claims one. A claim
+    # is a lease; workers renew it while they work, and a job whose worker went quiet goes back
+    # in the queue for someone else, up to max_attempts times.
+    def __init__(self, db_path: str, max_attempts: int = 3):
+        self.max_attempts = max(1, int(max_attempts))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def submit(self, platform: str, urls: Iterable[str], output_formats: Iterable[str] = ()) -> List[QueuedJob]:
+        formats = json.dumps(list(output_formats))
+        now = time.time()
+        with self.lock, self.db:
+            ids = [
+                self.db.execute(
+                    "INSERT INTO server_jobs (platform, url, output_formats, state, submitted) VALUES (?, ?, ?, ?, ?)",
+                    (platform, url, formats, QUEUED, now)
+                ).lastrowid
+                for url in urls
+            ]
+        return self.get_many(ids)
+
+    def get(self, job_id: int) -> Optional[QueuedJob]:
+        jobs = self.get_many([job_id])
+        return jobs[0] if jobs else None
+
+    def get_many(self, job_ids: List[int]) -> List[QueuedJob]:
+        if not job_ids:
+            return []
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {JOB_COLUMNS} FROM server_jobs WHERE id IN ({', '.join('?' * len(job_ids))}) ORDER BY id",
+                job_ids
+            ).fetchall()
+        return [job_from_row(row) for row in rows]
+
+    def list_jobs(self, state: Optional[str] = None, after: int = 0, limit: int = 100) -> List[QueuedJob]:
+        query = f"SELECT {JOB_COLUMNS} FROM server_jobs WHERE id > ?"
+        params: list = [after]
+        if state:
+            query += " AND state = ?"
+            params.append(state)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY id LIMIT ?", (*params, max(1, min(int(limit), 1000)))).fetchall()
+        return [job_from_row(row) for row in rows]
+
+    def finished_since(self, since: float, after: int = 0, limit: int = 100) -> List[QueuedJob]:
+        # Results in the order they came in. A poller pages through with the last (finished, id):
+        # jobs can finish within the same clock tick, and a page may end between them.
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {JOB_COLUMNS} FROM server_jobs WHERE finished > ? OR (finished = ? AND id > ?) "
+                "ORDER BY finished, id LIMIT ?",
+                (since, since, after, max(1, min(int(limit), 1000)))
+            ).fetchall()
+        return [job_from_row(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            rows = self.db.execute("SELECT state, COUNT(*) FROM server_jobs GROUP BY state").fetchall()
+        counts = {state: 0 for state in JOB_STATES}
+        counts.update(dict(rows))
+        return counts
+
+    def expire_leases(self) -> int:
+        with self.lock, self.db:
+            return self._expire_leases(time.time())
+
+    def _expire_leases(self, now: float) -> int:
+        expired = self.db.execute(
+            "SELECT id, worker, attempts FROM server_jobs WHERE state = ? AND lease_expires < ?", (RUNNING, now)
+        ).fetchall()
+        for job_id, worker, attempts in expired:
+            if attempts >= self.max_attempts:
+                logger.warning(f"Job {job_id} lost its worker {worker} {attempts} times, giving up on it")
+                self.db.execute(
+                    "UPDATE server_jobs SET state = ?, finished = ?, error = ?, lease_expires = NULL WHERE id = ?",
+                    (FAILED, now, f"Worker {worker} stopped responding", job_id)
+                )
+            else:
+                logger.warning(f"Worker {worker} stopped responding, job {job_id} goes back in the queue")
+                self.db.execute(
+                    "UPDATE server_jobs SET state = ?, worker = NULL, lease_expires = NULL WHERE id = ?",
+                    (QUEUED, job_id)
+                )
+        return len(expired)
+
+    def claim(self, worker: str, lease_seconds: float, platforms: Optional[Iterable[str]] = None) -> Optional[QueuedJob]:
+        now = time.time()
+        query = "SELECT id FROM server_jobs WHERE state = ?"
+        params: list = [QUEUED]
+        if platforms:
+            platforms = list(platforms)
+            query += f" AND platform IN ({', '.join('?' * len(platforms))})"
+            params += platforms
+        with self.lock, self.db:
+            self._expire_leases(now)
+            row = self.db.execute(query + " ORDER BY id LIMIT 1", params).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE server_jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                "started = ? WHERE id = ?",
+                (RUNNING, worker, now + lease_seconds, now, row[0])
+            )
+        return self.get(row[0])
+
+    def renew(self, job_id: int, worker: str, lease_seconds: float):
+        with self.lock, self.db:
+            updated = self.db.execute(
+                "UPDATE server_jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?",
+                (time.time() + lease_seconds, job_id, worker, RUNNING)
+            ).rowcount
+        if not updated:
+            raise LeaseLost(f"Job {job_id} is no longer {worker}'s")
+
+    def complete(self, job_id: int, worker: str, state: str, files: List[str], skipped: List[str],
+                 error: Optional[str] = None) -> QueuedJob:
+        if state not in FINISHED_STATES:
+            raise ValueError(f"Not a finished state: {state}")
+        with self.lock, self.db:
+            updated = self.db.execute(
+                "UPDATE server_jobs SET state = ?, files = ?, skipped = ?, error = ?, finished = ?, "
+                "lease_expires = NULL WHERE id = ? AND worker = ? AND state = ?",
+                (state, json.dumps(files), json.dumps(skipped), error, time.time(), job_id, worker, RUNNING)
+            ).rowcount
+        if not updated:
+            raise LeaseLost(f"Job {job_id} is no longer {worker}'s")
+        return self.get(job_id)
+
+    def cancel(self, job_id: int) -> Optional[QueuedJob]:
+        # A running job's worker finds out at its next renewal and drops the result.
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE server_jobs SET state = ?, finished = ?, lease_expires = NULL WHERE id = ? AND state IN (?, ?)",
+                (CANCELLED, time.time(), job_id, QUEUED, RUNNING)
+            )
+        return self.get(job_id)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
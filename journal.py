@@ -0,0 +1,188 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from scheduler import CANCELLED, FAILED, RUNNING, SKIPPED, DownloadJob
+
+logger = logging.getLogger(__name__)
+
+# Where a link is on its way from "pasted in" to "files on disk in every format asked for".
+JOURNAL_QUEUED = "queued"
+JOURNAL_DOWNLOADING = "downloading"
+JOURNAL_DOWNLOADED = "downloaded"
+JOURNAL_CONVERTING = "converting"
+JOURNAL_DONE = "done"
+JOURNAL_FAILED = "failed"
+JOURNAL_CANCELLED = "cancelled"
+
+FINISHED_STATES = (JOURNAL_DONE, JOURNAL_FAILED, JOURNAL_CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    platform TEXT NOT NULL,
+    url TEXT NOT NULL,
+    state TEXT NOT NULL,
+    files TEXT NOT NULL,
+    output_formats TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (platform, url)
+);
+CREATE INDEX IF NOT EXISTS journal_state ON journal (state);
+"""
+
+
+@dataclass
+class JournalEntry:
+    platform: str
+    url: str
+    state: str
+    files: List[str] = field(default_factory=list)
+    output_formats: List[str] = field(default_factory=list)
+
+
+class JobJournal:
+    def __init__(self, db_path: str, flush_interval: float = 0.5):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+        # State changes pile up here and go to disk together, one transaction per interval,
+        # however many jobs are moving. A crash loses at most the last interval, and
+        # replaying those few jobs is harmless.
+        self.dirty: Dict[Tuple[str, str], Tuple[str, Optional[List[str]]]] = {}
+        self.remaining: Dict[Tuple[str, str], set] = {}
+        self.conversion_failures = set()
+        self.closed = False
+        self.wake = threading.Event()
+        self.flush_interval = max(0.05, flush_interval)
+        self.flusher = threading.Thread(target=self._flush_loop, name="journal-flush", daemon=True)
+        self.flusher.start()
+
+    def add(self, platform: str, urls: Iterable[str], output_formats: Iterable[str] = ()):
+        formats = json.dumps(list(output_formats))
+        now = time.time()
+        with self.lock:
+            if self.closed:
+                return
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, '[]', ?, ?)",
+                    [(platform, url, JOURNAL_QUEUED, formats, now) for url in urls]
+                )
+
+    def set_state(self, platform: str, url: str, state: str, files: Optional[List[str]] = None):
+        with self.lock:
+            if self.closed:
+                return
+            if files is None and (platform, url) in self.dirty:
+                # Don't let a later state change drop a file list that hasn't been written yet.
+                files = self.dirty[(platform, url)][1]
+            self.dirty[(platform, url)] = (state, files)
+
+    def on_job_update(self, job: DownloadJob):
+        # Successful downloads are recorded by finish_download(), which knows what comes next.
+        if job.state == RUNNING:
+            self.set_state(job.platform, job.url, JOURNAL_DOWNLOADING)
+        elif job.state == SKIPPED:
+            self.set_state(job.platform, job.url, JOURNAL_DONE, job.skipped)
+        elif job.state == FAILED:
+            self.set_state(job.platform, job.url, JOURNAL_FAILED)
+        elif job.state == CANCELLED:
+            self.set_state(job.platform, job.url, JOURNAL_CANCELLED)
+
+    def finish_download(self, platform: str, url: str, files: List[str], to_convert: List[str]):
+        if not files:
+            # Failed or skipped outright; on_job_update() records which.
+            return
+        if not to_convert:
+            self.set_state(platform, url, JOURNAL_DONE, files)
+            return
+        with self.lock:
+            self.remaining[(platform, url)] = set(to_convert)
+        self.set_state(platform, url, JOURNAL_DOWNLOADED, files)
+
+    def finish_conversion(self, platform: str, url: str, source: str, converted: bool):
+        key = (platform, url)
+        with self.lock:
+            remaining = self.remaining.get(key)
+            if remaining is None:
+                return
+            remaining.discard(source)
+            if not converted:
+                self.conversion_failures.add(key)
+            if remaining:
+                state = JOURNAL_CONVERTING
+            else:
+                del self.remaining[key]
+                state = JOURNAL_FAILED if key in self.conversion_failures else JOURNAL_DONE
+                self.conversion_failures.discard(key)
+        self.set_state(platform, url, state)
+
+    def entries(self, platform: Optional[str] = None, urls: Optional[Iterable[str]] = None) -> List[JournalEntry]:
+        self.flush()
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT platform, url, state, files, output_formats FROM journal ORDER BY rowid"
+            ).fetchall()
+        wanted = set(urls) if urls is not None else None
+        return [
+            JournalEntry(row_platform, url, state, json.loads(files), json.loads(output_formats))
+            for row_platform, url, state, files, output_formats in rows
+            if (platform is None or row_platform == platform) and (wanted is None or url in wanted)
+        ]
+
+    def unfinished(self) -> List[JournalEntry]:
+        return [entry for entry in self.entries() if entry.state not in FINISHED_STATES]
+
+    def forget_finished(self):
+        # Once everything has drained there's nothing left to resume, and the table stays small.
+        self.flush()
+        with self.lock, self.db:
+            self.db.execute(
+                f"DELETE FROM journal WHERE state IN ({', '.join('?' * len(FINISHED_STATES))})",
+                FINISHED_STATES
+            )
+
+    def flush(self):
+        with self.lock:
+            if self.closed or not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, {}
+            now = time.time()
+            with self.db:
+                for (platform, url), (state, files) in dirty.items():
+                    if files is None:
+                        self.db.execute(
+                            "UPDATE journal SET state = ?, updated = ? WHERE platform = ? AND url = ?",
+                            (state, now, platform, url)
+                        )
+                    else:
+                        self.db.execute(
+                            "UPDATE journal SET state = ?, files = ?, updated = ? WHERE platform = ? AND url = ?",
+                            (state, json.dumps(files), now, platform, url)
+                        )
+
+    def _flush_loop(self):
+        while not self.wake.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"Error writing job journal: {e}", exc_info=True)
+
+    def close(self):
+        # Anything reported after this (like jobs cancelled by shutting down) stays unfinished
+        # in the journal, which is exactly what should be resumed next time.
+        if self.closed:
+            return
+        self.flush()
+        self.wake.set()
+        self.flusher.join(timeout=2)
+        with self.lock:
+            self.closed = True
+            self.db.close()
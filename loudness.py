@@ -0,0 +1,310 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    # Only ReplayGain needs it; everything else works without.
+    np = None
+
+try:
+    import mutagen
+    from mutagen.id3 import TXXX, ID3FileType
+    from mutagen.mp4 import MP4, MP4FreeForm
+    from mutagen.wave import WAVE
+except ImportError:
+    mutagen = None
+
+logger = logging.getLogger(__name__)
+
+# What ffmpeg hands us to analyse: 48 kHz stereo float, whatever the source was. The K-weighting
+# coefficients below are for 48 kHz, and mono comes out as two equal channels, which is how it
+# sounds on a pair of speakers anyway.
+SAMPLE_RATE = 48000
+CHANNELS = 2
+PCM_ARGS = ["-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "-f", "f32le"]
+FRAME_BYTES = 4 * CHANNELS
+PCM_READ_BYTES = SAMPLE_RATE * FRAME_BYTES
+
+# ReplayGain 2.0 plays everything as loud as -18 LUFS.
+REFERENCE_LUFS = -18.0
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# BS.1770 K-weighting at 48 kHz: a high shelf for the head, then a high pass.
+SHELF = ([1.53512485958697, -2.69169618940638, 1.19839281085285], [1.0, -1.69065929318241, 0.73248077421585])
+HIGH_PASS = ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621])
+# Both filters as one impulse response. It has died down to nothing well before this many samples.
+TAPS = 8192
+FFT_SIZE = 65536
+BLOCK_FRAMES = FFT_SIZE - TAPS + 1
+
+# 400 ms gating blocks every 100 ms.
+HOP_FRAMES = SAMPLE_RATE // 10
+HOPS_PER_BLOCK = 4
+# Block loudness in 0.1 LU steps from the absolute gate up. Per step, the number of blocks and
+# their summed power; adding histograms up is how a batch gets its album loudness.
+BIN_LU = 0.1
+HISTOGRAM_BINS = 800
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS loudness (
+    source TEXT PRIMARY KEY,
+    source_size INTEGER NOT NULL,
+    source_mtime REAL NOT NULL,
+    integrated REAL,
+    peak REAL NOT NULL,
+    seconds REAL NOT NULL,
+    bins BLOB NOT NULL,
+    counts BLOB NOT NULL,
+    powers BLOB NOT NULL,
+    analysed REAL NOT NULL
+);
+"""
+
+_filter_spectrum = None
+
+
+def missing_modules() -> List[str]:
+    return [name for name, module in (("numpy", np), ("mutagen", mutagen)) if module is None]
+
+
+def filter_spectrum():
+    # The combined K-weighting response, worked out once from the coefficients and kept
+    # in the frequency domain, so filtering a block is one FFT multiply.
+    global _filter_spectrum
+    if _filter_spectrum is None:
+        size = 4 * TAPS
+        response = np.ones(size // 2 + 1, dtype=complex)
+        for b, a in (SHELF, HIGH_PASS):
+            response *= np.fft.rfft(b, size) / np.fft.rfft(a, size)
+        impulse = np.fft.irfft(response, size)[:TAPS]
+        _filter_spectrum = np.fft.rfft(impulse, FFT_SIZE)[:, None]
+    return _filter_spectrum
+
+
+def block_loudness(power):
+    return -0.691 + 10 * np.log10(power)
+
+
+@dataclass
+class Loudness:
+    # integrated is None when nothing clears the gate: silence, or shorter than one block.
+    integrated: Optional[float]
+    peak: float
+    seconds: float
+    counts: "np.ndarray"
+    powers: "np.ndarray"
+
+    @property
+    def gain(self) -> Optional[float]:
+        return None if self.integrated is None else REFERENCE_LUFS - self.integrated
+
+
+def integrated_loudness(counts, powers) -> Optional[float]:
+    total = counts.sum()
+    if not total:
+        return None
+    threshold = block_loudness(powers.sum() / total) + RELATIVE_GATE
+    # Blocks from the bin the relative gate falls in are counted if the bin's middle is above it.
+    first = max(0, math.ceil((threshold - ABSOLUTE_GATE) / BIN_LU - 0.5))
+    if not counts[first:].sum():
+        return None
+    return float(block_loudness(powers[first:].sum() / counts[first:].sum()))
+
+
+def album_loudness(tracks: Iterable[Loudness]) -> Optional[Loudness]:
+    tracks = list(tracks)
+    if not tracks:
+        return None
+    counts = sum(track.counts for track in tracks)
+    powers = sum(track.powers for track in tracks)
+    return Loudness(integrated_loudness(counts, powers), max(track.peak for track in tracks),
+                    sum(track.seconds for track in tracks), counts, powers)
+
+
+class LoudnessAnalyzer:
+    # Fed raw PCM as it comes off ffmpeg's pipe. Memory stays at one filter block and a histogram,
+    # however long the track is.
+    def __init__(self):
+        self.pending = b""
+        self.overlap = np.zeros((TAPS - 1, CHANNELS))
+        self.leftover = np.zeros((0, CHANNELS))
+        self.recent_hops = np.zeros(0)
+        self.frames = 0
+        self.peak = 0.0
+        self.counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        self.powers = np.zeros(HISTOGRAM_BINS)
+
+    @property
+    def seconds(self) -> float:
+        return self.frames / SAMPLE_RATE
+
+    def feed(self, data: bytes):
+        self.pending += data
+        block_bytes = BLOCK_FRAMES * FRAME_BYTES
+        while len(self.pending) >= block_bytes:
+            self._process(self.pending[:block_bytes])
+            self.pending = self.pending[block_bytes:]
+
+    def _process(self, data: bytes):
+        samples = np.frombuffer(data, dtype="<f4").reshape(-1, CHANNELS).astype(np.float64)
+        self.frames += len(samples)
+        if not len(samples):
+            return
+        self.peak = max(self.peak, float(np.abs(samples).max()))
+
+        # Overlap-add: this block's filtered output, plus the tail the previous block rang into it.
+        filtered = np.fft.irfft(np.fft.rfft(samples, FFT_SIZE, axis=0) * filter_spectrum(), FFT_SIZE, axis=0)
+        filtered = filtered[:len(samples) + TAPS - 1]
+        filtered[:TAPS - 1] += self.overlap
+        self.overlap = filtered[len(samples):].copy()
+        filtered = np.concatenate([self.leftover, filtered[:len(samples)]])
+
+        hops = len(filtered) // HOP_FRAMES
+        self.leftover = filtered[hops * HOP_FRAMES:]
+        if not hops:
+            return
+        # Power per 100 ms, summed over channels (both weigh 1 in stereo), then per 400 ms block.
+        hop_power = np.square(filtered[:hops * HOP_FRAMES]).reshape(hops, HOP_FRAMES, CHANNELS).sum(axis=(1, 2))
+        hop_power = np.concatenate([self.recent_hops, hop_power])
+        if len(hop_power) >= HOPS_PER_BLOCK:
+            windows = np.lib.stride_tricks.sliding_window_view(hop_power, HOPS_PER_BLOCK)
+            self._add_blocks(windows.sum(axis=1) / (HOP_FRAMES * HOPS_PER_BLOCK))
+        self.recent_hops = hop_power[-(HOPS_PER_BLOCK - 1):]
+
+    def _add_blocks(self, power):
+        with np.errstate(divide="ignore"):
+            loudness = block_loudness(power)
+        gated = loudness >= ABSOLUTE_GATE
+        bins = np.minimum(((loudness[gated] - ABSOLUTE_GATE) / BIN_LU).astype(np.int64), HISTOGRAM_BINS - 1)
+        self.counts += np.bincount(bins, minlength=HISTOGRAM_BINS)
+        self.powers += np.bincount(bins, weights=power[gated], minlength=HISTOGRAM_BINS)
+
+    def result(self) -> Loudness:
+        usable = len(self.pending) - len(self.pending) % FRAME_BYTES
+        self._process(self.pending[:usable])
+        self.pending = b""
+        return Loudness(integrated_loudness(self.counts, self.powers), self.peak, self.seconds,
+                        self.counts, self.powers)
+
+
+class LoudnessCache:
+    # One analysis per source file, for as long as the file stays the same. Just the non-empty
+    # histogram bins are kept, a few KB a track.
+    def __init__(self, db_path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def lookup(self, source: str) -> Optional[Loudness]:
+        source = os.path.abspath(source)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT source_size, source_mtime, integrated, peak, seconds, bins, counts, powers FROM loudness "
+                "WHERE source = ?",
+                (source,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        source_size, source_mtime, integrated, peak, seconds, bins, counts, powers = row
+        try:
+            source_stat = os.stat(source)
+        except OSError:
+            return None
+        if (source_stat.st_size, source_stat.st_mtime) != (source_size, source_mtime):
+            return None
+
+        bins = np.frombuffer(bins, dtype=np.uint16)
+        dense_counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        dense_powers = np.zeros(HISTOGRAM_BINS)
+        dense_counts[bins] = np.frombuffer(counts, dtype=np.int64)
+        dense_powers[bins] = np.frombuffer(powers, dtype=np.float64)
+        return Loudness(integrated, peak, seconds, dense_counts, dense_powers)
+
+    def store(self, source: str, loudness: Loudness):
+        source = os.path.abspath(source)
+        source_stat = os.stat(source)
+        bins = np.flatnonzero(loudness.counts)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO loudness VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, source_stat.st_size, source_stat.st_mtime, loudness.integrated, loudness.peak,
+                 loudness.seconds, bins.astype(np.uint16).tobytes(), loudness.counts[bins].tobytes(),
+                 loudness.powers[bins].astype(np.float64).tobytes(), time.time())
+            )
+
+    def refresh(self, path: str):
+        # Tags were rewritten, the audio wasn't: the analysis still holds for the file as it is now.
+        path = os.path.abspath(path)
+        path_stat = os.stat(path)
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE loudness SET source_size = ?, source_mtime = ? WHERE source = ?",
+                (path_stat.st_size, path_stat.st_mtime, path)
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def replaygain_tags(track: Loudness, album: Optional[Loudness]) -> dict:
+    tags = {
+        "REPLAYGAIN_TRACK_GAIN": f"{track.gain:.2f} dB",
+        "REPLAYGAIN_TRACK_PEAK": f"{track.peak:.6f}",
+        "REPLAYGAIN_REFERENCE_LOUDNESS": f"{REFERENCE_LUFS:.2f} LUFS",
+    }
+    if album is not None and album.gain is not None:
+        tags["REPLAYGAIN_ALBUM_GAIN"] = f"{album.gain:.2f} dB"
+        tags["REPLAYGAIN_ALBUM_PEAK"] = f"{album.peak:.6f}"
+    return tags
+
+
+def write_replaygain(path: str, tags: dict) -> bool:
+    # Returns whether the file was touched; tags that are already right are left alone, so a
+    # re-run doesn't rewrite (and re-stamp) every file in the library.
+    audio = mutagen.File(path)
+    if audio is None:
+        logger.warning(f"Can't tag {path}: unknown format")
+        return False
+
+    if isinstance(audio, MP4):
+        # iTunes-style freeform atoms, which is where foobar2000 and friends look.
+        if audio.tags is None:
+            audio.add_tags()
+        wanted = {f"----:com.apple.iTunes:{key.lower()}": value for key, value in tags.items()}
+        current = {key: [bytes(item).decode("utf-8", errors="replace") for item in audio.tags.get(key, [])]
+                   for key in wanted}
+        if all(current[key] == [value] for key, value in wanted.items()):
+            return False
+        for key, value in wanted.items():
+            audio.tags[key] = [MP4FreeForm(value.encode("utf-8"))]
+    elif isinstance(audio, (ID3FileType, WAVE)):
+        # MP3 and WAV carry ID3, where ReplayGain lives in TXXX frames.
+        if audio.tags is None:
+            audio.add_tags()
+        if all([str(text) for text in getattr(audio.tags.get(f"TXXX:{key}"), "text", [])] == [value]
+               for key, value in tags.items()):
+            return False
+        for key, value in tags.items():
+            audio.tags.setall(f"TXXX:{key}", [TXXX(encoding=3, desc=key, text=[value])])
+    else:
+        # FLAC, Ogg Vorbis and Opus: plain comments.
+        if audio.tags is None:
+            audio.add_tags()
+        if all(list(audio.tags.get(key) or []) == [value] for key, value in tags.items()):
+            return False
+        for key, value in tags.items():
+            audio.tags[key] = value
+    audio.save()
+    return True
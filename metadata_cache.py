@@ -0,0 +1,97 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resolutions (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resolutions_last_used ON resolutions (last_used);
+"""
+
+
+class OfflineMiss(Exception):
+    pass
+
+
+class MetadataCache:
+    def __init__(self, db_path: str, ttl_seconds: float, max_entries: int = 0, offline: bool = False):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        now = time.time()
+        found = {}
+        with self.lock:
+            # Chunked to stay under SQLite's bound-parameter limit on big playlists.
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT key, value, fetched FROM resolutions WHERE key IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, value, fetched in rows:
+                    # Offline, a stale answer beats no answer at all.
+                    if self.offline or self.ttl_seconds <= 0 or now - fetched <= self.ttl_seconds:
+                        found[key] = json.loads(value)
+            if found:
+                with self.db:
+                    self.db.executemany(
+                        "UPDATE resolutions SET last_used = ? WHERE key = ?",
+                        [(now, key) for key in found]
+                    )
+        return found
+
+    def put(self, key: str, value: Any):
+        self.put_many({key: value})
+
+    def put_many(self, items: Dict[str, Any]):
+        if not items:
+            return
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, ?)",
+                [(key, json.dumps(value), now, now) for key, value in items.items()]
+            )
+        self.enforce_limit()
+
+    def enforce_limit(self) -> int:
+        if self.max_entries <= 0:
+            return 0
+        with self.lock, self.db:
+            total = self.db.execute("SELECT COUNT(*) FROM resolutions").fetchone()[0]
+            excess = total - self.max_entries
+            if excess <= 0:
+                return 0
+            self.db.execute(
+                "DELETE FROM resolutions WHERE key IN "
+                "(SELECT key FROM resolutions ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+        logger.info(f"Dropped {excess} least recently used metadata cache entries")
+        return excess
+
+    def close(self):
+        with self.lock:
+            self.db.close()
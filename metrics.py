@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Stages, in the order a track goes through them.
+SPAN_RESOLVE = "resolve"
+SPAN_QUEUE_WAIT = "queue_wait"
+SPAN_DOWNLOAD = "download"
+SPAN_CONVERT_WAIT = "convert_wait"
+SPAN_CONVERT = "convert"
+SPAN_LOUDNESS = "loudness"
+SPAN_CATALOG = "catalog"
+
+# Upper bounds in seconds: a catalog upsert is milliseconds, a big playlist through spotdl is minutes.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RECENT_SPANS = 500
+
+
+@dataclass
+class Span:
+    stage: str
+    # The link, like ProgressEvent.job; item is the track or file within it.
+    job: str = ""
+    item: str = ""
+    start: float = 0.0
+    seconds: float = 0.0
+    bytes: Optional[int] = None
+    ok: bool = True
+
+
+class StageStats:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+
+    def add(self, span: Span):
+        self.count += 1
+        self.seconds += span.seconds
+        self.max_seconds = max(self.max_seconds, span.seconds)
+        if not span.ok:
+            self.errors += 1
+        if span.bytes:
+            self.bytes += span.bytes
+        for index, bound in enumerate(BUCKETS):
+            if span.seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+
+class Metrics:
+    # Spans are cheap to record from any thread: a lock, a few additions and a bounded deque.
+    # Aggregates are per stage only; the job and item stay on the recent spans, so the
+    # Prometheus output doesn't grow a series per track.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages: Dict[str, StageStats] = {}
+        self.recent: Deque[Span] = deque(maxlen=RECENT_SPANS)
+
+    def record(self, span: Span):
+        with self.lock:
+            self.stages.setdefault(span.stage, StageStats()).add(span)
+            self.recent.append(span)
+        logger.debug(f"span {span.stage} {span.seconds * 1000:.1f}ms job={span.job} item={span.item} "
+                     f"bytes={span.bytes} ok={span.ok}")
+
+    def observe(self, stage: str, seconds: float, job: str = "", item: str = "",
+                bytes: Optional[int] = None, ok: bool = True):
+        self.record(Span(stage, job, item, time.time() - seconds, seconds, bytes, ok))
+
+    def span(self, stage: str, job: str = "", item: str = "") -> "SpanTimer":
+        return SpanTimer(self, Span(stage, job, item))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stages = {
+                stage: {
+                    "count": stats.count,
+                    "errors": stats.errors,
+                    "seconds": stats.seconds,
+                    "mean_seconds": stats.seconds / stats.count if stats.count else None,
+                    "max_seconds": stats.max_seconds,
+                    "bytes": stats.bytes,
+                    "buckets": dict(zip(map(str, BUCKETS), stats.buckets)),
+                }
+                for stage, stats in self.stages.items()
+            }
+            recent = [asdict(span) for span in self.recent]
+        return {"started": self.started, "timestamp": time.time(), "stages": stages, "recent_spans": recent}
+
+    def render_prometheus(self) -> str:
+        with self.lock:
+            stages: List[Tuple[str, StageStats]] = sorted(self.stages.items())
+            lines = [
+                "# HELP music_stage_seconds Time spent per pipeline stage.",
+                "# TYPE music_stage_seconds histogram",
+            ]
+            for stage, stats in stages:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'music_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'music_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {stats.count}')
+                lines.append(f'music_stage_seconds_sum{{stage="{stage}"}} {stats.seconds}')
+                lines.append(f'music_stage_seconds_count{{stage="{stage}"}} {stats.count}')
+            lines += ["# HELP music_stage_errors_total Stages that ended in an error.",
+                      "# TYPE music_stage_errors_total counter"]
+            lines += [f'music_stage_errors_total{{stage="{stage}"}} {stats.errors}' for stage, stats in stages]
+            lines += ["# HELP music_stage_bytes_total Bytes moved per stage.",
+                      "# TYPE music_stage_bytes_total counter"]
+            lines += [f'music_stage_bytes_total{{stage="{stage}"}} {stats.bytes}' for stage, stats in stages]
+        return "\n".join(lines) + "\n"
+
+
+class SpanTimer:
+    # with metrics.span(SPAN_DOWNLOAD, job=url) as span: ...; span.bytes = size
+    # An exception marks the span failed and carries on up.
+    def __init__(self, metrics: Metrics, span: Span):
+        self.metrics = metrics
+        self.span = span
+
+    @property
+    def bytes(self) -> Optional[int]:
+        return self.span.bytes
+
+    @bytes.setter
+    def bytes(self, value: Optional[int]):
+        self.span.bytes = value
+
+    def fail(self):
+        self.span.ok = False
+
+    def __enter__(self):
+        self.span.start = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.seconds = time.perf_counter() - self.clock
+        if exc_type is not None:
+            self.span.ok = False
+        self.metrics.record(self.span)
+        return False
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = self.metrics.render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(self.metrics.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsExporter:
+    # Either or both: /metrics (Prometheus text) and /metrics.json on localhost:port,
+    # and the JSON snapshot rewritten to dump_path every interval seconds.
+    def __init__(self, metrics: Metrics, port: int = 0, dump_path: str = "", interval: float = 30.0):
+        self.metrics = metrics
+        self.port = int(port or 0)
+        self.dump_path = dump_path
+        self.interval = max(1.0, float(interval))
+        self.server = None
+        self.stop_event = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    @classmethod
+    def from_config(cls, metrics: Metrics, config: dict) -> "MetricsExporter":
+        return cls(metrics, config["metrics_port"], config["metrics_dump_file"], config["metrics_dump_interval_s"])
+
+    def start(self) -> "MetricsExporter":
+        if self.port:
+            try:
+                handler = type("Handler", (MetricsHandler,), {"metrics": self.metrics})
+                self.server = ThreadingHTTPServer(("127.0.0.1", self.port), handler)
+                self.server.daemon_threads = True
+                self.threads.append(threading.Thread(target=self.server.serve_forever, name="metrics-http",
+                                                     daemon=True))
+                logger.info(f"Metrics at http://127.0.0.1:{self.port}/metrics")
+            except OSError as e:
+                # Another instance probably has the port; the app works fine without it.
+                logger.warning(f"Could not serve metrics on port {self.port}: {e}")
+        if self.dump_path:
+            self.threads.append(threading.Thread(target=self._dump_loop, name="metrics-dump", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def dump(self):
+        # Written next to the target and swapped in, so readers never see half a file.
+        temp_path = f"{self.dump_path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.metrics.snapshot(), f, indent=2)
+            os.replace(temp_path, self.dump_path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self.dump_path}: {e}")
+
+    def _dump_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.dump()
+
+    def close(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.dump_path:
+            # One last time, so a short batch run leaves its numbers behind.
+            self.dump()
@@ -0,0 +1,92 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from converter import AudioConverter
+from metrics import SPAN_CONVERT_WAIT, Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionPipeline:
+    def __init__(
+        self,
+        converter: AudioConverter,
+        on_result: Callable[[str, Dict[str, str], Any], None],
+        workers: int,
+        queue_size: int,
+        metrics: Optional[Metrics] = None
+    ):
+        self.converter = converter
+        self.on_result = on_result
+        self.metrics = metrics or Metrics()
+        # Bounded on purpose: when ffmpeg falls behind, downloaders wait at submit() instead
+        # of piling up an ever-growing backlog on disk.
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.threads: List[threading.Thread] = []
+        for index in range(max(1, int(workers))):
+            thread = threading.Thread(target=self._worker, name=f"pipeline-convert-{index}", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def submit(self, source: str, output_formats: Iterable[str], context: Any = None):
+        with self.lock:
+            self.in_flight += 1
+        self.queue.put((source, list(output_formats), context, time.monotonic()))
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.in_flight
+
+    def cancel_pending(self) -> int:
+        cancelled = 0
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            cancelled += 1
+        with self.lock:
+            self.in_flight -= cancelled
+        return cancelled
+
+    def join(self):
+        self.queue.join()
+
+    def close(self):
+        self.cancel_pending()
+        for _ in self.threads:
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                break
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            source, output_formats, context, submitted = item
+            self.metrics.observe(SPAN_CONVERT_WAIT, time.monotonic() - submitted, job=source)
+            outputs = {}
+            try:
+                outputs = self.converter.convert_to_formats(source, output_formats)
+            except Exception as e:
+                logger.error(f"Pipeline conversion of {source} crashed: {e}", exc_info=True)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+            try:
+                self.on_result(source, outputs, context)
+            except Exception as e:
+                logger.error(f"Error reporting pipeline result: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
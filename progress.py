@@ -0,0 +1,67 @@
+import re
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# Stages, roughly in the order a track goes through them.
+STATUS = "status"
+JOB = "job"
+DOWNLOAD = "download"
+CONVERT = "convert"
+CONVERTED = "converted"
+
+DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+@dataclass
+class ProgressEvent:
+    # What the UI groups by: a link for downloads, a source file for conversions.
+    job: str
+    stage: str
+    # The track or file within the job, when a job covers several.
+    item: str = ""
+    message: str = ""
+    percent: Optional[float] = None
+    bytes_done: Optional[int] = None
+    bytes_total: Optional[int] = None
+
+
+class ProgressBus:
+    # Workers publish as often as they like and the UI drains at its own pace. Only the
+    # latest event per (stage, job, item) is kept, so a thousand ticks between two frames
+    # cost the UI one update.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: Dict[Tuple[str, str, str], ProgressEvent] = {}
+
+    def publish(self, event: ProgressEvent):
+        key = (event.stage, event.job, event.item)
+        with self.lock:
+            # Re-inserted, so drain() hands things over in the order they last changed.
+            self.pending.pop(key, None)
+            self.pending[key] = event
+
+    def status(self, message: str):
+        self.publish(ProgressEvent(job="", stage=STATUS, message=message))
+
+    def drain(self) -> List[ProgressEvent]:
+        with self.lock:
+            events, self.pending = self.pending, {}
+        return list(events.values())
+
+
+def parse_ffmpeg_duration(line: str) -> Optional[float]:
+    match = DURATION_PATTERN.search(line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_ffmpeg_progress(line: str) -> Optional[float]:
+    # -progress writes key=value lines; out_time_us is how far into the input we are.
+    # (out_time_ms is the same number, despite the name.)
+    key, _, value = line.strip().partition("=")
+    if key in ("out_time_us", "out_time_ms") and value.isdigit():
+        return int(value) / 1_000_000
+    return None
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# What a failed call tells the limiter. None means it says nothing about load (a 404, a bad token).
+SUCCESS = "success"
+THROTTLED = "throttled"
+TRANSIENT = "transient"
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# yandex_music folds the status into the message: "... (429): b'...'", or just "Bad Gateway".
+STATUS_IN_MESSAGE = re.compile(r"\((\d{3})\)")
+
+# Latency this many times the best seen means the provider is struggling, even without errors.
+LATENCY_FACTOR = 2.0
+BASE_DELAY = 1.0
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status
+    if str(error) == "Bad Gateway":
+        return 502
+    match = STATUS_IN_MESSAGE.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    status = error_status(error)
+    if status == 429:
+        return THROTTLED
+    if status is not None:
+        return TRANSIENT if status in RETRYABLE_STATUSES else None
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return TRANSIENT
+    try:
+        import aiohttp
+        if isinstance(error, aiohttp.ClientError):
+            return TRANSIENT
+    except ImportError:
+        pass
+    # Library errors wrapping a network one (yandex_music's NetworkError, TimedOutError).
+    if error.__cause__ is not None and error.__cause__ is not error:
+        return classify_error(error.__cause__)
+    return None
+
+
+class TokenBucket:
+    # rate tokens a second, up to burst saved up. reserve() always takes a token and says how
+    # long to wait for it, so callers queue up in order instead of polling.
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(0.0, float(rate or 0))
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate <= 0:
+                return wait
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def pause(self, seconds: float):
+        # A 429 is about all of us, not just the call that got it.
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveLimit:
+    # Additive increase, multiplicative decrease, as in TCP: one more slot per limit's worth of
+    # healthy calls, halved on a 429, cut back on other errors or when latency climbs. Decreases
+    # are at most once per cooldown, so a burst of parallel failures counts as one signal.
+    def __init__(self, maximum: int, minimum: int = 1, adaptive: bool = True, latency_aware: bool = True):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.adaptive = adaptive
+        # Whole spotdl jobs take as long as their playlist is, which says nothing about load.
+        self.latency_aware = latency_aware
+        self.limit = float(self.maximum)
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0.0
+
+    def current(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    def on_success(self, seconds: float):
+        if not self.adaptive:
+            return
+        if self.latency_aware:
+            self.latency = seconds if self.latency is None else self.latency * 0.8 + seconds * 0.2
+            # The best latency seen, drifting up slowly so a permanently slower network becomes the new normal.
+            self.baseline = self.latency if self.baseline is None else min(
+                self.latency, self.baseline + (self.latency - self.baseline) * 0.01)
+            if self.latency > LATENCY_FACTOR * self.baseline:
+                self.decrease(0.9)
+                return
+        self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+    def on_failure(self, kind: str):
+        if self.adaptive:
+            self.decrease(0.5 if kind == THROTTLED else 0.8)
+
+    def decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self.last_decrease < max(1.0, self.latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(float(self.minimum), self.limit * factor)
+
+
+class ProviderLimiter:
+    # One per service: a token bucket for the request rate, an adaptive cap on requests in
+    # flight, and retries with jittered exponential backoff for whatever is worth retrying.
+    # Works from asyncio (call, slot) and from plain threads (call_blocking, blocking_slot).
+    def __init__(self, name: str, rate: float = 0, burst: Optional[float] = None, max_concurrency: int = 0,
+                 retries: int = 3, max_delay: float = 60.0, adaptive: bool = True, latency_aware: bool = True):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst or max(1.0, float(rate or 0)))
+        self.concurrency = AdaptiveLimit(max_concurrency, adaptive=adaptive, latency_aware=latency_aware) \
+            if max_concurrency else None
+        self.retries = max(0, int(retries))
+        self.max_delay = max(BASE_DELAY, float(max_delay))
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.slot_freed = threading.Condition(self.lock)
+        self.async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @classmethod
+    def from_config(cls, name: str, config: dict, max_concurrency: int, retries: Optional[int] = None,
+                    latency_aware: bool = True) -> "ProviderLimiter":
+        rate = float(config["provider_rate_limits"].get(name) or 0)
+        return cls(
+            name,
+            rate=rate,
+            # A couple of seconds' worth saved up, so a new job doesn't start out throttled by us.
+            burst=max(1.0, rate * 2),
+            max_concurrency=max_concurrency,
+            retries=config["api_retries"] if retries is None else retries,
+            max_delay=config["retry_max_delay_s"],
+            adaptive=bool(config["adaptive_concurrency"]),
+            latency_aware=latency_aware
+        )
+
+    def _has_room(self) -> bool:
+        return self.concurrency is None or self.in_flight < self.concurrency.current()
+
+    def _leave(self, kind: Optional[str], seconds: float):
+        with self.lock:
+            self.in_flight -= 1
+            if self.concurrency is not None:
+                before = self.concurrency.current()
+                if kind == SUCCESS:
+                    self.concurrency.on_success(seconds)
+                elif kind is not None:
+                    self.concurrency.on_failure(kind)
+                after = self.concurrency.current()
+                if after < before:
+                    logger.info(f"{self.name}: backing off to {after} concurrent requests ({kind or 'slow'})")
+                elif after > before:
+                    logger.debug(f"{self.name}: up to {after} concurrent requests")
+            waiters, self.async_waiters = self.async_waiters, []
+            self.slot_freed.notify_all()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+
+    def backoff(self, attempt: int, kind: str, retry_after: Optional[float] = None) -> float:
+        # Half fixed, half random: retries from parallel calls spread out instead of arriving together.
+        cap = min(self.max_delay, BASE_DELAY * 2 ** attempt * (2 if kind == THROTTLED else 1))
+        delay = cap / 2 + random.uniform(0, cap / 2)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        if kind == THROTTLED:
+            self.bucket.pause(delay)
+        return delay
+
+    async def _enter(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self._has_room():
+                    self.in_flight += 1
+                    break
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            await future
+        delay = self.bucket.reserve()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                self._leave(None, 0)
+                raise
+
+    @asynccontextmanager
+    async def slot(self, classify: Callable[[BaseException], Optional[str]] = classify_error):
+        await self._enter()
+        start = time.perf_counter()
+        kind = SUCCESS
+        try:
+            yield
+        except Exception as e:
+            kind = classify(e)
+            raise
+        except BaseException:
+            kind = None
+            raise
+        finally:
+            self._leave(kind, time.perf_counter() - start)
+
+    async def call(self, operation, what: str, retries: Optional[int] = None,
+                   classify: Callable[[BaseException], Optional[str]] = classify_error):
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                async with self.slot(classify):
+                    return await operation()
+            except Exception as e:
+                kind = classify(e)
+                if kind is None or attempt == retries:
+                    raise
+                delay = self.backoff(attempt, kind, getattr(e, "retry_after", None))
+                logger.warning(f"{what} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    @contextmanager
+    def blocking_slot(self, classify: Callable[[BaseException], Optional[str]] = classify_error):
+        with self.lock:
+            while not self._has_room():
+                self.slot_freed.wait()
+            self.in_flight += 1
+        delay = self.bucket.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        start = time.perf_counter()
+        kind = SUCCESS
+        try:
+            yield
+        except Exception as e:
+            kind = classify(e)
+            raise
+        except BaseException:
+            kind = None
+            raise
+        finally:
+            self._leave(kind, time.perf_counter() - start)
+
+    def call_blocking(self, operation, what: str, retries: Optional[int] = None,
+                      classify: Callable[[BaseException], Optional[str]] = classify_error):
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                with self.blocking_slot(classify):
+                    return operation()
+            except Exception as e:
+                kind = classify(e)
+                if kind is None or attempt == retries:
+                    raise
+                delay = self.backoff(attempt, kind, getattr(e, "retry_after", None))
+                logger.warning(f"{what} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+
+def wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
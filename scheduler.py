@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+from metrics import SPAN_QUEUE_WAIT, Metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+# Nothing needed downloading: every track was already in the library.
+SKIPPED = "skipped"
+
+JOB_STATES = (QUEUED, RUNNING, DONE, SKIPPED, FAILED, CANCELLED)
+
+
+@dataclass
+class DownloadJob:
+    job_id: int
+    platform: str
+    url: str
+    state: str = QUEUED
+    files: List[str] = field(default_factory=list)
+    # Library files that were already there, so their downloads never happened.
+    skipped: List[str] = field(default_factory=list)
+    # Tracks in the link that didn't download, even if the rest did.
+    failed_tracks: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+    queued_at: float = field(default_factory=time.monotonic)
+    # Formats the job was queued with; None means whatever the app is set to when it runs.
+    output_formats: Optional[List[str]] = None
+
+
+def parse_links(text: str) -> List[str]:
+    # One link per line (or per whitespace gap), comments and duplicates politely ignored.
+    links = []
+    seen = set()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        for link in line.split():
+            if link not in seen:
+                seen.add(link)
+                links.append(link)
+    return links
+
+
+def read_links_file(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_links(f.read())
+
+
+class DownloadScheduler:
+    def __init__(
+        self,
+        handlers: Dict[str, Callable[[DownloadJob], List[str]]],
+        max_workers: int,
+        platform_limits: Optional[Dict[str, int]] = None,
+        on_update: Optional[Callable[[DownloadJob], None]] = None,
+        metrics: Optional[Metrics] = None
+    ):
+        self.handlers = handlers
+        self.max_workers = max(1, int(max_workers))
+        self.platform_limits = platform_limits or {}
+        self.on_update = on_update
+        self.metrics = metrics or Metrics()
+
+        self.jobs: List[DownloadJob] = []
+        self.pending: Dict[str, deque] = {platform: deque() for platform in handlers}
+        self.running: Dict[str, int] = {platform: 0 for platform in handlers}
+        self.condition = threading.Condition()
+        self.workers: List[threading.Thread] = []
+        self.closed = False
+        # Round-robin pointer, so one giant Spotify playlist can't starve Yandex.
+        self.next_platform = 0
+
+    def platform_limit(self, platform: str) -> int:
+        limit = self.platform_limits.get(platform) or self.max_workers
+        return max(1, min(int(limit), self.max_workers))
+
+    def submit(self, platform: str, urls: Iterable[str],
+               output_formats: Optional[List[str]] = None) -> List[DownloadJob]:
+        if platform not in self.handlers:
+            raise ValueError(f"Unknown platform: {platform}")
+
+        new_jobs = []
+        with self.condition:
+            for url in urls:
+                job = DownloadJob(job_id=len(self.jobs), platform=platform, url=url, output_formats=output_formats)
+                self.jobs.append(job)
+                self.pending[platform].append(job)
+                new_jobs.append(job)
+            self._start_workers()
+            self.condition.notify_all()
+
+        for job in new_jobs:
+            self._notify(job)
+        logger.info(f"Queued {len(new_jobs)} {platform} jobs")
+        return new_jobs
+
+    def cancel_pending(self) -> int:
+        cancelled = []
+        with self.condition:
+            for queue in self.pending.values():
+                while queue:
+                    job = queue.popleft()
+                    job.state = CANCELLED
+                    cancelled.append(job)
+        for job in cancelled:
+            self._notify(job)
+        return len(cancelled)
+
+    def counts(self) -> Dict[str, int]:
+        with self.condition:
+            counts = {state: 0 for state in JOB_STATES}
+            for job in self.jobs:
+                counts[job.state] += 1
+            return counts
+
+    def is_idle(self) -> bool:
+        with self.condition:
+            return not any(self.pending.values()) and not any(self.running.values())
+
+    def shutdown(self):
+        self.cancel_pending()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _start_workers(self):
+        self.workers = [worker for worker in self.workers if worker.is_alive()]
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._worker,
+                name=f"download-{len(self.workers)}",
+                daemon=True
+            )
+            self.workers.append(worker)
+            worker.start()
+
+    def _next_job(self) -> Optional[DownloadJob]:
+        platforms = list(self.pending)
+        for offset in range(len(platforms)):
+            platform = platforms[(self.next_platform + offset) % len(platforms)]
+            if self.pending[platform] and self.running[platform] < self.platform_limit(platform):
+                self.next_platform = (self.next_platform + offset + 1) % len(platforms)
+                return self.pending[platform].popleft()
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    job = self._next_job()
+                self.running[job.platform] += 1
+                job.state = RUNNING
+            self.metrics.observe(SPAN_QUEUE_WAIT, time.monotonic() - job.queued_at, job=job.url)
+            self._notify(job)
+
+            files = []
+            error = None
+            try:
+                files = self.handlers[job.platform](job) or []
+            except Exception as e:
+                logger.error(f"Job {job.job_id} ({job.url}) crashed: {e}", exc_info=True)
+                error = str(e)
+
+            with self.condition:
+                job.files = files
+                if error is None and job.failed_tracks:
+                    error = f"{len(job.failed_tracks)} tracks failed to download"
+                job.error = error
+                if files:
+                    job.state = DONE
+                elif job.skipped and error is None:
+                    job.state = SKIPPED
+                else:
+                    job.state = FAILED
+            # Report before freeing the slot, so nobody sees an idle scheduler with news still unsent.
+            self._notify(job)
+            with self.condition:
+                self.running[job.platform] -= 1
+                self.condition.notify_all()
+
+    def _notify(self, job: DownloadJob):
+        if self.on_update:
+            try:
+                self.on_update(job)
+            except Exception as e:
+                logger.error(f"Error reporting job update: {e}", exc_info=True)
@@ -0,0 +1,283 @@
+import hmac
+import json
+import logging
+import re
+import threading
+import time
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from downloader import detect_platform
+from job_queue import FINISHED_STATES, JobQueue, LeaseLost, QueuedJob
+
+logger = logging.getLogger(__name__)
+
+# Bind addresses that mean "every interface"; nothing can connect to them as such.
+WILDCARD_HOSTS = {"", "0.0.0.0"}
+
+# Long-polling claims hang on at most this long, so workers notice a dead server soon enough.
+MAX_CLAIM_WAIT = 30.0
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def job_json(job: QueuedJob) -> dict:
+    return asdict(job)
+
+
+class JobServer:
+    # The daemon: a small JSON API in front of a JobQueue. It never downloads anything itself;
+    # workers (local processes, or other machines pointed at it) claim jobs and report back.
+    def __init__(self, config: dict, host: Optional[str] = None, port: Optional[int] = None):
+        self.config = config
+        self.queue = JobQueue(config["library_db"], config["server_max_attempts"])
+        self.lease_seconds = max(5.0, float(config["server_lease_s"]))
+        self.token = config["server_token"]
+        # Woken on every submit, so idle workers waiting in a claim pick new jobs up at once.
+        self.submitted = threading.Condition()
+        self.workers_lock = threading.Lock()
+        self.workers_seen: Dict[str, float] = {}
+        handler = type("Handler", (ApiHandler,), {"server_app": self})
+        self.http = ThreadingHTTPServer((host or config["server_host"], int(port or config["server_port"])), handler)
+        self.http.daemon_threads = True
+        self.thread = None
+        self.stopping = threading.Event()
+        self.reaper = None
+
+    @property
+    def url(self) -> str:
+        # Where this machine reaches the server: a 0.0.0.0 bind is fine to listen on, but not to
+        # connect to (Windows refuses outright), so local workers get loopback instead.
+        host, port = self.http.server_address[:2]
+        return f"http://{'127.0.0.1' if host in WILDCARD_HOSTS else host}:{port}"
+
+    def start(self) -> "JobServer":
+        self.thread = threading.Thread(target=self.http.serve_forever, name="job-server", daemon=True)
+        self.thread.start()
+        self.reaper = threading.Thread(target=self.reap_leases, name="lease-reaper", daemon=True)
+        self.reaper.start()
+        host, port = self.http.server_address[:2]
+        logger.info(f"Job server listening on {host}:{port}")
+        return self
+
+    def reap_leases(self):
+        # Dead workers' jobs go back in the queue on time, not whenever someone next claims,
+        # so /jobs and /stats don't keep showing them as running.
+        while not self.stopping.wait(self.lease_seconds / 4):
+            try:
+                if self.queue.expire_leases():
+                    with self.submitted:
+                        self.submitted.notify_all()
+            except Exception as e:
+                logger.error(f"Error expiring leases: {e}", exc_info=True)
+
+    def close(self):
+        self.stopping.set()
+        if self.reaper is not None:
+            self.reaper.join()
+        self.http.shutdown()
+        self.http.server_close()
+        self.queue.close()
+
+    def seen(self, worker: str):
+        with self.workers_lock:
+            self.workers_seen[worker] = time.time()
+
+    def submit(self, body: dict) -> Tuple[int, dict]:
+        urls = body.get("urls") or ([body["url"]] if body.get("url") else [])
+        if not isinstance(urls, list) or not urls:
+            raise ApiError(400, "Expected \"urls\": [...] or \"url\"")
+        formats = [str(fmt).lower() for fmt in body.get("formats") or []]
+        unsupported = [fmt for fmt in formats if fmt not in self.config["supported_formats"]]
+        if unsupported:
+            raise ApiError(400, f"Unsupported formats: {', '.join(unsupported)}")
+
+        by_platform: Dict[str, list] = {}
+        rejected = []
+        for url in dict.fromkeys(str(url).strip() for url in urls):
+            platform = detect_platform(url)
+            if platform is None:
+                rejected.append(url)
+            else:
+                by_platform.setdefault(platform, []).append(url)
+        if not by_platform:
+            raise ApiError(400, f"No recognisable links in: {', '.join(rejected)}")
+
+        jobs = [job for platform, links in by_platform.items() for job in self.queue.submit(platform, links, formats)]
+        with self.submitted:
+            self.submitted.notify_all()
+        logger.info(f"Queued {len(jobs)} jobs")
+        return 201, {"jobs": [job_json(job) for job in jobs], "rejected": rejected}
+
+    def claim(self, body: dict) -> Tuple[int, Optional[dict]]:
+        worker = str(body.get("worker") or "")
+        if not worker:
+            raise ApiError(400, "Expected \"worker\"")
+        platforms = body.get("platforms") or None
+        if platforms is not None and (not isinstance(platforms, list) or
+                                      not all(isinstance(platform, str) for platform in platforms)):
+            raise ApiError(400, "\"platforms\" must be a list of platform names")
+        deadline = time.monotonic() + min(MAX_CLAIM_WAIT, max(0.0, float(body.get("wait_s") or 0)))
+        while True:
+            self.seen(worker)
+            job = self.queue.claim(worker, self.lease_seconds, platforms)
+            if job is not None:
+                logger.info(f"Job {job.id} ({job.url}) went to {worker}")
+                return 200, {"job": job_json(job), "lease_s": self.lease_seconds}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return 204, None
+            with self.submitted:
+                # Also wakes up now and then, for leases that expired in the meantime.
+                self.submitted.wait(min(remaining, self.lease_seconds / 2))
+
+    def renew(self, job_id: int, body: dict) -> Tuple[int, dict]:
+        worker = str(body.get("worker") or "")
+        self.seen(worker)
+        try:
+            self.queue.renew(job_id, worker, self.lease_seconds)
+        except LeaseLost as e:
+            raise ApiError(409, str(e))
+        return 200, {"lease_s": self.lease_seconds}
+
+    def complete(self, job_id: int, body: dict) -> Tuple[int, dict]:
+        worker = str(body.get("worker") or "")
+        self.seen(worker)
+        state = body.get("state")
+        if state not in FINISHED_STATES:
+            raise ApiError(400, f"\"state\" must be one of {', '.join(FINISHED_STATES)}")
+        try:
+            job = self.queue.complete(job_id, worker, state, list(body.get("files") or []),
+                                      list(body.get("skipped") or []), body.get("error"))
+        except LeaseLost as e:
+            raise ApiError(409, str(e))
+        logger.info(f"Job {job_id} {state} on {worker}: {len(job.files)} files")
+        return 200, job_json(job)
+
+    def job(self, job_id: int) -> Tuple[int, dict]:
+        job = self.queue.get(job_id)
+        if job is None:
+            raise ApiError(404, f"No job {job_id}")
+        return 200, job_json(job)
+
+    def cancel(self, job_id: int) -> Tuple[int, dict]:
+        job = self.queue.cancel(job_id)
+        if job is None:
+            raise ApiError(404, f"No job {job_id}")
+        return 200, job_json(job)
+
+    def list_jobs(self, query: dict) -> Tuple[int, dict]:
+        jobs = self.queue.list_jobs(query.get("state"), int(query.get("after") or 0), int(query.get("limit") or 100))
+        return 200, {"jobs": [job_json(job) for job in jobs]}
+
+    def results(self, query: dict) -> Tuple[int, dict]:
+        # The cursor is "<finished>:<id>"; a bare timestamp works too, for "everything since then".
+        since, _, after = str(query.get("since") or "0").partition(":")
+        since, after = float(since), int(after or 0)
+        jobs = self.queue.finished_since(since, after, int(query.get("limit") or 100))
+        if jobs:
+            since, after = jobs[-1].finished, jobs[-1].id
+        return 200, {
+            "results": [job_json(job) for job in jobs],
+            # Pass back as ?since= for the next page.
+            "next": f"{since!r}:{after}"
+        }
+
+    def stats(self) -> Tuple[int, dict]:
+        now = time.time()
+        with self.workers_lock:
+            workers = sorted(self.workers_seen.items())
+        return 200, {
+            "jobs": self.queue.counts(),
+            # Seconds since each worker last claimed, renewed or reported.
+            "workers": {name: round(now - seen, 1) for name, seen in workers}
+        }
+
+
+ROUTES = [
+    ("GET", re.compile(r"/health"), lambda app, match, query, body: (200, {"ok": True})),
+    ("GET", re.compile(r"/stats"), lambda app, match, query, body: app.stats()),
+    ("GET", re.compile(r"/jobs"), lambda app, match, query, body: app.list_jobs(query)),
+    ("POST", re.compile(r"/jobs"), lambda app, match, query, body: app.submit(body)),
+    ("GET", re.compile(r"/jobs/(\d+)"), lambda app, match, query, body: app.job(int(match.group(1)))),
+    ("POST", re.compile(r"/jobs/(\d+)/cancel"), lambda app, match, query, body: app.cancel(int(match.group(1)))),
+    ("GET", re.compile(r"/results"), lambda app, match, query, body: app.results(query)),
+    # The worker protocol.
+    ("POST", re.compile(r"/claim"), lambda app, match, query, body: app.claim(body)),
+    ("POST", re.compile(r"/jobs/(\d+)/renew"), lambda app, match, query, body: app.renew(int(match.group(1)), body)),
+    ("POST", re.compile(r"/jobs/(\d+)/complete"),
+     lambda app, match, query, body: app.complete(int(match.group(1)), body)),
+]
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_app: JobServer = None
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def send_json(self, status: int, payload: Optional[dict]):
+        body = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        if payload is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            raise ApiError(413, "Request body too large")
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            raise ApiError(400, "Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise ApiError(400, "Request body must be a JSON object")
+        return body
+
+    def dispatch(self, method: str):
+        try:
+            app = self.server_app
+            # The token is all that stands between the network and the queue: compare it in constant time.
+            if app.token and not hmac.compare_digest(
+                    (self.headers.get("Authorization") or "").encode("utf-8"), f"Bearer {app.token}".encode("utf-8")):
+                raise ApiError(401, "Missing or wrong token")
+            parsed = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+            path = parsed.path.rstrip("/") or "/"
+            for route_method, pattern, action in ROUTES:
+                match = pattern.fullmatch(path)
+                if match and route_method == method:
+                    body = self.read_body() if method == "POST" else {}
+                    status, payload = action(app, match, query, body)
+                    self.send_json(status, payload)
+                    return
+            raise ApiError(404, f"No such endpoint: {method} {path}")
+        except Exception as e:
+            # The request body may not have been read, so this connection can't be reused.
+            self.close_connection = True
+            if isinstance(e, ApiError):
+                self.send_json(e.status, {"error": str(e)})
+            elif isinstance(e, ValueError):
+                self.send_json(400, {"error": str(e)})
+            else:
+                logger.error(f"Error handling {method} {self.path}: {e}", exc_info=True)
+                self.send_json(500, {"error": "Internal error"})
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
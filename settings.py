@@ -0,0 +1,77 @@
+import json
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = Path("config.json")
+
+DEFAULT_CONFIG = {
+    "output_dir": "downloads",
+    "converted_dir": "converted",
+    "library_db": "library.db",
+    "supported_formats": ["mp3", "wav", "m4a", "flac"],
+    "default_format": "mp3",
+    "max_concurrent_downloads": 3,
+    "platform_concurrency": {"spotify": 2, "yandex": 3},
+    "spotify_bitrate": "128k",
+    "spotify_threads": 7,
+    "conversion_workers": 0,
+    "encoder_options": {},
+    "converted_cache_max_mb": 0,
+    "replaygain": False,
+    "auto_convert": False,
+    "auto_convert_format": "mp3",
+    "pipeline_queue_size": 16,
+    "yandex_streaming": False,
+    "yandex_chunk_kb": 256,
+    "download_retries": 3,
+    "download_parallel_ranges": 1,
+    "download_split_min_mb": 8,
+    "http_pool_size": 16,
+    "yandex_resolve_concurrency": 8,
+    "yandex_parallel_downloads": 4,
+    "metadata_cache_ttl_hours": 24,
+    "metadata_cache_max_entries": 50000,
+    "offline": False,
+    "journal_flush_ms": 500,
+    "skip_existing": True,
+    "dedup_duration_tolerance_s": 2,
+    "ui_fps": 10,
+    "provider_rate_limits": {"spotify": 1, "yandex": 20},
+    "api_retries": 4,
+    "retry_max_delay_s": 60,
+    "adaptive_concurrency": True,
+    "log_file": "music_downloader.log",
+    "log_level": "DEBUG",
+    "log_max_mb": 10,
+    "log_backups": 3,
+    "metrics_port": 0,
+    "metrics_dump_file": "",
+    "metrics_dump_interval_s": 30,
+    "server_host": "127.0.0.1",
+    "server_port": 8765,
+    "server_token": "",
+    "server_workers": 2,
+    "server_lease_s": 60,
+    "server_max_attempts": 3,
+    "worker_threads": 2
+}
+
+
+def load_config(config_path: Path = CONFIG_PATH) -> dict:
+    try:
+        if config_path.exists():
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+            # Updating config with default_config, because mixing old and new is fun!
+            return {**DEFAULT_CONFIG, **config}
+        return dict(DEFAULT_CONFIG)
+    except Exception as e:
+        logger.error(f"Error loading config: {e}", exc_info=True)
+        return dict(DEFAULT_CONFIG)
+
+
+def save_config(config: dict, config_path: Path = CONFIG_PATH):
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=4)
@@ -0,0 +1,283 @@
+import bisect
+import time
+import tkinter as tk
+from tkinter import font as tkfont
+from tkinter import ttk
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from catalog import Track
+
+# Small batches are slotted in where they belong; past this, one sort is cheaper.
+BULK_RESORT_FRACTION = 0.05
+# How many rows a search looks at between checks of the clock.
+FILTER_CHUNK = 2000
+
+
+def search_text(track: Track) -> str:
+    return " ".join(part for part in (track.artist, track.title, track.format, track.name) if part).casefold()
+
+
+class SongIndex:
+    # The whole library in display order, plus whichever part of it matches the search box.
+    # Matching runs in slices (step()), so typing into a huge library never freezes the window.
+    def __init__(self, sort_key: Callable[[Track], tuple]):
+        self.sort_key = sort_key
+        self.tracks: List[Track] = []
+        self.keys: List[tuple] = []
+        self.haystacks: Dict[str, str] = {}
+
+        self.query = ""
+        self.tokens: List[str] = []
+        self.matches: List[Track] = []
+        self.candidates: List[Track] = []
+        self.position = 0
+        self.searching = False
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def set_tracks(self, tracks: Iterable[Track]):
+        self.set_sorted(tracks)
+        self.haystacks = {track.path: search_text(track) for track in self.tracks}
+        self.restart_search()
+
+    def add_many(self, tracks: Iterable[Track]):
+        tracks = list(tracks)
+        if not tracks:
+            return
+        # A rescan reports changed files again; they replace the old row.
+        self.remove_many([track.path for track in tracks if track.path in self.haystacks])
+        for track in tracks:
+            self.haystacks[track.path] = search_text(track)
+        if len(tracks) > len(self.tracks) * BULK_RESORT_FRACTION:
+            self.set_sorted(self.tracks + tracks)
+        else:
+            for track in tracks:
+                key = self.sort_key(track)
+                index = bisect.bisect_right(self.keys, key)
+                self.keys.insert(index, key)
+                self.tracks.insert(index, track)
+        self.restart_search()
+
+    def set_sorted(self, tracks: Iterable[Track]):
+        # Each key computed once; root and name are unique, so ties never reach the tracks.
+        decorated = sorted((self.sort_key(track), index, track) for index, track in enumerate(tracks))
+        self.keys = [key for key, _, _ in decorated]
+        self.tracks = [track for _, _, track in decorated]
+
+    def remove_many(self, paths: Iterable[str]):
+        gone = {path for path in paths if path in self.haystacks}
+        if not gone:
+            return
+        for path in gone:
+            del self.haystacks[path]
+        kept = [(key, track) for key, track in zip(self.keys, self.tracks) if track.path not in gone]
+        self.keys = [key for key, _ in kept]
+        self.tracks = [track for _, track in kept]
+        self.restart_search()
+
+    def set_query(self, query: str):
+        query = query.strip().casefold()
+        if query == self.query:
+            return
+        narrowing = bool(self.query) and query.startswith(self.query) and not self.searching
+        self.query = query
+        self.tokens = query.split()
+        # Typing one more letter can only drop rows, so only the current matches need a second look.
+        self.candidates = self.matches if narrowing else self.tracks
+        self.begin_search()
+
+    def restart_search(self):
+        self.candidates = self.tracks
+        self.begin_search()
+
+    def begin_search(self):
+        if not self.tokens:
+            self.matches = self.tracks
+            self.searching = False
+            return
+        self.matches = []
+        self.position = 0
+        self.searching = True
+
+    def step(self, budget: float) -> bool:
+        # Matches as many rows as fit in the time budget. True once the search is complete.
+        if not self.searching:
+            return True
+        deadline = time.perf_counter() + budget
+        tokens = self.tokens
+        haystacks = self.haystacks
+        while self.position < len(self.candidates):
+            chunk = self.candidates[self.position:self.position + FILTER_CHUNK]
+            self.position += len(chunk)
+            self.matches.extend(
+                track for track in chunk
+                if all(token in haystacks[track.path] for token in tokens)
+            )
+            if time.perf_counter() >= deadline:
+                return False
+        self.searching = False
+        return True
+
+
+class VirtualSongList(tk.Frame):
+    # Looks like the Listbox it replaces, but only ever draws the rows on screen, so a library
+    # of fifty thousand songs costs the same to show and scroll as one of fifty.
+    def __init__(self, master, sort_key: Callable[[Track], tuple], frame_budget: float = 0.05,
+                 selectable: bool = True, empty_text: str = "No files found.",
+                 bg: str = "#2b2b2b", fg: str = "white", selectbackground: str = "#1f538d", height: int = 15):
+        super().__init__(master, bg=bg)
+        self.index = SongIndex(sort_key)
+        self.frame_budget = frame_budget
+        self.selectable = selectable
+        self.empty_text = empty_text
+        self.fg = fg
+        self.selectbackground = selectbackground
+
+        self.font = tkfont.nametofont("TkDefaultFont")
+        self.row_height = self.font.metrics("linespace") + 2
+        self.canvas = tk.Canvas(self, bg=bg, highlightthickness=0, height=height * self.row_height)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar = ttk.Scrollbar(self, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        # Rows are recycled: scrolling just relabels the same few canvas items.
+        self.row_items: List[tuple] = []
+        self.top = 0
+        self.selected: Set[str] = set()
+        self.anchor: Optional[int] = None
+        self.search_job = None
+
+        self.canvas.bind("<Configure>", lambda _: self.render())
+        self.canvas.bind("<MouseWheel>", self.on_wheel)
+        self.canvas.bind("<Button-4>", lambda _: self.scroll_rows(-3))
+        self.canvas.bind("<Button-5>", lambda _: self.scroll_rows(3))
+        self.canvas.bind("<Up>", lambda _: self.scroll_rows(-1))
+        self.canvas.bind("<Down>", lambda _: self.scroll_rows(1))
+        self.canvas.bind("<Prior>", lambda _: self.scroll_rows(-self.visible_rows()))
+        self.canvas.bind("<Next>", lambda _: self.scroll_rows(self.visible_rows()))
+        if selectable:
+            self.canvas.bind("<Button-1>", self.on_click)
+            self.canvas.bind("<Shift-Button-1>", self.on_shift_click)
+            self.canvas.bind("<Control-a>", lambda _: self.select_all())
+
+    def set_tracks(self, tracks: Iterable[Track]):
+        self.index.set_tracks(tracks)
+        self.selected &= set(self.index.haystacks)
+        self.search_updated()
+
+    def add_tracks(self, tracks: Iterable[Track]):
+        self.index.add_many(tracks)
+        self.search_updated()
+
+    def remove_paths(self, paths: Iterable[str]):
+        paths = set(paths)
+        self.index.remove_many(paths)
+        self.selected -= paths
+        self.search_updated()
+
+    def set_filter(self, query: str):
+        self.index.set_query(query)
+        self.top = 0
+        self.search_updated()
+
+    def search_updated(self):
+        if self.index.searching and self.search_job is None:
+            self.search_job = self.after_idle(self.continue_search)
+        self.render()
+
+    def continue_search(self):
+        # A slice per frame; what has matched so far shows up right away.
+        self.search_job = None
+        if not self.index.step(self.frame_budget):
+            self.search_job = self.after(1, self.continue_search)
+        self.render()
+
+    def selected_paths(self) -> List[str]:
+        # In display order, including selected rows the current search hides.
+        return [track.path for track in self.index.tracks if track.path in self.selected]
+
+    def select_all(self):
+        self.selected.update(track.path for track in self.index.matches)
+        self.render()
+
+    def visible_rows(self) -> int:
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def render(self):
+        matches = self.index.matches
+        visible = self.visible_rows()
+        self.top = max(0, min(self.top, len(matches) - visible))
+
+        while len(self.row_items) < visible + 1:
+            y = len(self.row_items) * self.row_height
+            rect = self.canvas.create_rectangle(0, y, 0, y + self.row_height, width=0, fill="")
+            text = self.canvas.create_text(4, y + 1, anchor="nw", font=self.font, fill=self.fg, text="")
+            self.row_items.append((rect, text))
+
+        width = self.canvas.winfo_width()
+        for offset, (rect, text) in enumerate(self.row_items):
+            position = self.top + offset
+            y = offset * self.row_height
+            self.canvas.coords(rect, 0, y, width, y + self.row_height)
+            if position < len(matches):
+                track = matches[position]
+                fill = self.selectbackground if track.path in self.selected else ""
+                self.canvas.itemconfigure(rect, fill=fill)
+                self.canvas.itemconfigure(text, text=track.name)
+            else:
+                self.canvas.itemconfigure(rect, fill="")
+                self.canvas.itemconfigure(text, text="")
+
+        if not matches and not self.index.searching and self.row_items:
+            self.canvas.itemconfigure(self.row_items[0][1], text="No matches." if self.index.tokens else self.empty_text)
+
+        if matches:
+            self.scrollbar.set(self.top / len(matches), min(1.0, (self.top + visible) / len(matches)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll_rows(self, rows: int):
+        self.top += rows
+        self.render()
+
+    def on_scrollbar(self, action: str, amount: str, unit: Optional[str] = None):
+        if action == "moveto":
+            self.top = int(float(amount) * len(self.index.matches))
+            self.render()
+        elif action == "scroll":
+            step = self.visible_rows() if unit == "pages" else 1
+            self.scroll_rows(int(amount) * step)
+
+    def on_wheel(self, event):
+        # Windows reports multiples of 120, macOS single steps.
+        delta = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        self.scroll_rows(-3 * delta)
+
+    def row_at(self, y: int) -> Optional[int]:
+        position = self.top + y // self.row_height
+        return position if position < len(self.index.matches) else None
+
+    def on_click(self, event):
+        # Same as the old MULTIPLE-mode Listbox: a click toggles just that row.
+        self.canvas.focus_set()
+        position = self.row_at(event.y)
+        if position is None:
+            return
+        path = self.index.matches[position].path
+        if path in self.selected:
+            self.selected.discard(path)
+        else:
+            self.selected.add(path)
+        self.anchor = position
+        self.render()
+
+    def on_shift_click(self, event):
+        position = self.row_at(event.y)
+        if position is None:
+            return
+        start = position if self.anchor is None else self.anchor
+        low, high = sorted((start, position))
+        self.selected.update(track.path for track in self.index.matches[low:high + 1])
+        self.anchor = position
+        self.render()
@@ -0,0 +1,281 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from rate_limit import THROTTLED, TRANSIENT, classify_error
+
+logger = logging.getLogger(__name__)
+
+SPOTDL_MISSING = "spotdl is not installed. Please install it using: pip install spotdl"
+
+
+class SpotdlError(Exception):
+    pass
+
+
+def classify_spotdl_error(error: BaseException) -> Optional[str]:
+    # Errors come back from the worker as text, so the text is all there is to go on.
+    if not isinstance(error, SpotdlError):
+        return classify_error(error)
+    text = str(error).lower()
+    if "429" in text or "rate limit" in text or "too many requests" in text:
+        return THROTTLED
+    if any(hint in text for hint in ("timed out", "timeout", "connection", "temporarily", "exited unexpectedly",
+                                     "500", "502", "503", "504")):
+        return TRANSIENT
+    return None
+
+
+def _worker_main(conn, downloader_settings: dict):
+    # Everything expensive happens exactly once per worker: the spotdl import,
+    # the Spotify auth and the audio provider sessions.
+    try:
+        from spotdl import Spotdl
+        from spotdl.types.song import Song
+        from spotdl.utils.config import DEFAULT_CONFIG
+    except ImportError:
+        conn.send({"type": "ready", "error": SPOTDL_MISSING})
+        return
+
+    send_lock = threading.Lock()
+    current_job = {"id": None}
+
+    def send(message: dict):
+        with send_lock:
+            conn.send(message)
+
+    try:
+        spotdl = Spotdl(
+            client_id=DEFAULT_CONFIG["client_id"],
+            client_secret=DEFAULT_CONFIG["client_secret"],
+            headless=True,
+            downloader_settings=downloader_settings
+        )
+    except Exception as e:
+        send({"type": "ready", "error": f"Could not start spotdl: {e}"})
+        return
+
+    def on_progress(tracker, message):
+        send({
+            "type": "progress",
+            "id": current_job["id"],
+            "song": tracker.song.display_name,
+            "progress": tracker.progress,
+            "message": message
+        })
+
+    spotdl.downloader.progress_handler.update_callback = on_progress
+    settings = spotdl.downloader.settings
+    default_format = {"format": settings["format"], "bitrate": settings["bitrate"]}
+    send({"type": "ready"})
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        current_job["id"] = job["id"]
+        # The bitrate only means something for MP3; other formats keep what the source has.
+        settings.update(default_format)
+        if job.get("format"):
+            settings.update({"format": job["format"], "bitrate": job["bitrate"]})
+        try:
+            if job.get("songs"):
+                songs = [Song.from_dict(song) for song in job["songs"]]
+            else:
+                songs = spotdl.search([job["url"]])
+            resolved = [song.json for song in songs]
+
+            chosen = range(len(songs))
+            if job.get("select"):
+                # The parent knows the library; it answers with the songs actually worth fetching.
+                send({"type": "resolved", "id": job["id"], "songs": resolved})
+                chosen = conn.recv()["download"]
+
+            results = spotdl.download_songs([songs[i] for i in chosen]) if chosen else []
+            for i, (song, _) in zip(chosen, results):
+                # Now with the audio source spotdl matched, worth remembering for next time.
+                resolved[i] = song.json
+            send({
+                "type": "result",
+                "id": job["id"],
+                "files": [str(path) for _, path in results if path],
+                "sources": [[song.song_id, str(path)] for song, path in results if path],
+                "missing": [song.display_name for song, path in results if not path],
+                "songs": resolved
+            })
+        except Exception as e:
+            send({"type": "result", "id": job["id"], "files": [], "error": str(e)})
+        finally:
+            current_job["id"] = None
+
+
+class SpotdlWorker:
+    def __init__(self, downloader_settings: dict):
+        self.downloader_settings = downloader_settings
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, downloader_settings),
+            name="spotdl-worker",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.job_ids = itertools.count()
+        self.ready = False
+
+    def _receive(self) -> dict:
+        # poll() first, so a worker that died mid-job doesn't leave us hanging forever.
+        while not self.conn.poll(0.5):
+            if not self.process.is_alive():
+                raise SpotdlError("spotdl worker exited unexpectedly")
+        try:
+            return self.conn.recv()
+        except EOFError:
+            raise SpotdlError("spotdl worker exited unexpectedly")
+
+    def wait_ready(self):
+        if self.ready:
+            return
+        message = self._receive()
+        if message.get("error"):
+            raise SpotdlError(message["error"])
+        self.ready = True
+
+    def download(self, url: str, on_progress: Optional[Callable[[dict], None]] = None,
+                 songs: Optional[List[dict]] = None,
+                 select: Optional[Callable[[List[dict]], List[int]]] = None,
+                 output_format: Optional[str] = None) -> dict:
+        self.wait_ready()
+        job_id = next(self.job_ids)
+        bitrate = self.downloader_settings["bitrate"] if output_format in (None, "mp3") else None
+        self.conn.send({
+            "id": job_id, "url": url, "songs": songs, "select": select is not None,
+            "format": output_format, "bitrate": bitrate
+        })
+
+        while True:
+            message = self._receive()
+            if message.get("id") != job_id:
+                continue
+            if message["type"] == "progress":
+                if on_progress:
+                    on_progress(message)
+                continue
+            if message["type"] == "resolved":
+                # The worker is blocked until it hears back, so it always gets an answer.
+                try:
+                    chosen = select(message["songs"])
+                except Exception as e:
+                    logger.error(f"Error checking songs against the library: {e}", exc_info=True)
+                    chosen = list(range(len(message["songs"])))
+                self.conn.send({"download": chosen})
+                continue
+            if message.get("error"):
+                raise SpotdlError(message["error"])
+            for song in message.get("missing", []):
+                logger.warning(f"spotdl could not download: {song}")
+            return message
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def close(self, timeout: float = 5.0):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class SpotdlWorkerPool:
+    def __init__(self, config: dict, size: int):
+        self.config = config
+        self.size = max(1, int(size))
+        self.idle = queue.Queue()
+        self.workers: List[SpotdlWorker] = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.startup_error = None
+
+    def downloader_settings(self) -> dict:
+        output_dir = Path(self.config["output_dir"])
+        return {
+            "format": "mp3",
+            "bitrate": self.config["spotify_bitrate"],
+            "output": str(output_dir / "{artists} - {title}.{output-ext}"),
+            "threads": self.config["spotify_threads"],
+            "preload": True,
+            "simple_tui": True,
+            "log_level": "ERROR"
+        }
+
+    def _acquire(self) -> SpotdlWorker:
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise SpotdlError("spotdl workers are shut down")
+                if self.startup_error:
+                    raise SpotdlError(self.startup_error)
+                if self.idle.empty() and len(self.workers) < self.size:
+                    logger.info("Starting spotdl worker")
+                    worker = SpotdlWorker(self.downloader_settings())
+                    self.workers.append(worker)
+                    return worker
+            # Short timeout, so a slot freed by a dead worker gets noticed too.
+            try:
+                worker = self.idle.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if worker.is_alive():
+                return worker
+            self._forget(worker)
+
+    def _forget(self, worker: SpotdlWorker):
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+    def _release(self, worker: SpotdlWorker):
+        if worker.is_alive():
+            self.idle.put(worker)
+            return
+        # A dead worker gives its slot back, the next job gets a fresh one.
+        self._forget(worker)
+        logger.warning("spotdl worker exited, it will be replaced on the next job")
+
+    def download(self, url: str, on_progress: Optional[Callable[[dict], None]] = None,
+                 songs: Optional[List[dict]] = None,
+                 select: Optional[Callable[[List[dict]], List[int]]] = None,
+                 output_format: Optional[str] = None) -> dict:
+        # Returns the worker's result message: "files", "sources" ([song_id, path] pairs) and "songs".
+        # output_format overrides the configured MP3 for this one job.
+        worker = self._acquire()
+        try:
+            worker.wait_ready()
+            return worker.download(url, on_progress, songs, select, output_format)
+        except SpotdlError as e:
+            if not worker.ready:
+                # No point spawning a new process per URL just to learn spotdl is missing again.
+                self.startup_error = str(e)
+            raise
+        finally:
+            self._release(worker)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.close()
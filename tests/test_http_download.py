@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+
+import rate_limit
+from http_download import DownloadError, download_file, info_path, part_path
+from rate_limit import ProviderLimiter
+
+RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+SIZE = 3 * 1024 * 1024 + 12345
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Cancelled segments hang up mid-request; that's the client's business, not a failure.
+        pass
+
+
+class StubCdn:
+    # A local stand-in for the CDN that misbehaves on request: cut-off transfers, 429s, and
+    # servers that ignore Range (all of them, or all but the one-byte probe).
+    def __init__(self, payload: bytes, ranges: str = "all", cut_after: int = 0, throttle: int = 0,
+                 retry_after: str = "0", validators: bool = True):
+        self.payload = payload
+        self.ranges = ranges
+        self.cut_after = cut_after
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.validators = validators
+        self.requests = []
+        self.lock = threading.Lock()
+        handler = type("Handler", (StubHandler,), {"cdn": self})
+        self.http = QuietServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.http.server_address[1]}/track.flac"
+
+    @property
+    def etag(self) -> str:
+        return f'"{hashlib.md5(self.payload).hexdigest()}"'
+
+    def close(self):
+        self.http.shutdown()
+        self.http.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cdn: StubCdn = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        cdn = self.cdn
+        requested = self.headers.get("Range")
+        with cdn.lock:
+            cdn.requests.append(dict(self.headers))
+            throttled = cdn.throttle > 0
+            cdn.throttle -= throttled
+            payload = cdn.payload
+
+        if throttled:
+            self.send_response(429)
+            self.send_header("Retry-After", cdn.retry_after)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        match = RANGE.fullmatch(requested or "")
+        honoured = match and (cdn.ranges == "all" or (cdn.ranges == "probe" and requested == "bytes=0-0"))
+        if_range = self.headers.get("If-Range")
+        if honoured and if_range is not None and if_range != cdn.etag:
+            # RFC 9110: the file changed, so the whole new one instead of a piece of it.
+            honoured = False
+        if honoured:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(payload) - 1
+            if start >= len(payload):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = payload[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{start + len(body) - 1}/{len(payload)}")
+        else:
+            body = payload
+            self.send_response(200)
+        if cdn.validators:
+            self.send_header("ETag", cdn.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        with cdn.lock:
+            # The first response big enough to cut short (not the one-byte probe).
+            cut = cdn.cut_after if len(body) > cdn.cut_after else 0
+            cdn.cut_after -= cut
+        if cut:
+            # Promises the whole body, sends part of it and hangs up.
+            self.wfile.write(body[:cut])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture(autouse=True)
+def quick_retries(monkeypatch):
+    # Backoff is exercised in test_rate_limit; here it would only make the tests slow.
+    monkeypatch.setattr(rate_limit, "BASE_DELAY", 0.01)
+
+
+@pytest.fixture
+def payload():
+    return os.urandom(SIZE)
+
+
+@pytest.fixture
+def cdn(request, payload):
+    server = StubCdn(payload, **getattr(request, "param", {}))
+    yield server
+    server.close()
+
+
+def download(cdn: StubCdn, dest: str, parallel_ranges: int = 1, retries: int = 3, max_delay: float = 0.05):
+    progress = []
+
+    async def run():
+        limiter = ProviderLimiter("test", retries=retries, max_delay=max_delay)
+        async with aiohttp.ClientSession() as session:
+            await download_file(session, cdn.url, dest, chunk_size=64 * 1024, parallel_ranges=parallel_ranges,
+                                split_min_bytes=1024 * 1024, retries=retries,
+                                on_progress=lambda done, total: progress.append(done), limiter=limiter)
+
+    asyncio.run(run())
+    return progress
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def leftovers(tmp_path) -> list:
+    return sorted(name for name in os.listdir(tmp_path) if ".part" in name)
+
+
+def test_plain_download(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    progress = download(cdn, dest)
+    assert read(dest) == payload
+    assert progress[-1] == len(payload)
+    assert len(cdn.requests) == 1
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("cdn", [{"cut_after": 1024 * 1024}], indirect=True)
+def test_resume_after_cut_transfer(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    progress = download(cdn, dest)
+    assert read(dest) == payload
+    assert [request.get("Range") for request in cdn.requests] == [None, f"bytes={1024 * 1024}-"]
+    # Picked up where it stopped, checked against the file it started on.
+    assert cdn.requests[1]["If-Range"] == cdn.etag
+    assert max(progress) == progress[-1] == len(payload)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("cdn", [{"throttle": 2, "retry_after": "1"}], indirect=True)
+def test_429_waits_for_retry_after(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    start = time.monotonic()
+    download(cdn, dest, max_delay=5)
+    assert read(dest) == payload
+    assert len(cdn.requests) == 3
+    assert time.monotonic() - start >= 2
+
+
+@pytest.mark.parametrize("cdn", [{"throttle": 5}], indirect=True)
+def test_429_gives_up_after_retries(cdn, tmp_path):
+    with pytest.raises(DownloadError) as error:
+        download(cdn, str(tmp_path / "track.flac"), retries=2)
+    assert error.value.status == 429
+    assert len(cdn.requests) == 3
+
+
+def test_split_download_reassembles(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    progress = download(cdn, dest, parallel_ranges=4)
+    assert read(dest) == payload
+    ranges = sorted(request["Range"] for request in cdn.requests)
+    assert "bytes=0-0" in ranges
+    assert len([r for r in ranges if r != "bytes=0-0"]) == 4
+    assert max(progress) == progress[-1] == len(payload)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("cdn", [{"cut_after": 200000}], indirect=True)
+def test_split_download_resumes_a_cut_segment(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    download(cdn, dest, parallel_ranges=4)
+    assert read(dest) == payload
+    assert len(cdn.requests) == 6
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("cdn", [{"ranges": "probe"}], indirect=True)
+def test_split_falls_back_when_ranges_are_ignored(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    progress = download(cdn, dest, parallel_ranges=4)
+    assert read(dest) == payload
+    assert max(progress) <= len(payload)
+    assert progress[-1] == len(payload)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("cdn", [{"ranges": "none", "cut_after": 100000}], indirect=True)
+def test_resume_restarts_when_ranges_are_ignored(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    progress = download(cdn, dest)
+    assert read(dest) == payload
+    assert cdn.requests[1]["Range"] == "bytes=100000-"
+    assert max(progress) <= len(payload)
+    assert progress[-1] == len(payload)
+
+
+@pytest.mark.parametrize("cdn", [{"cut_after": 100000}], indirect=True)
+def test_resume_restarts_when_the_file_changed(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    with pytest.raises(Exception):
+        download(cdn, dest, retries=0)
+    assert os.path.getsize(part_path(dest)) == 100000
+
+    # Same URL, same size, different bytes: only the validator tells them apart.
+    cdn.payload = os.urandom(len(payload))
+    progress = download(cdn, dest)
+    assert read(dest) == cdn.payload
+    assert cdn.requests[1]["If-Range"] != cdn.etag
+    assert max(progress) <= len(payload)
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("cdn", [{"cut_after": 100000, "validators": False}], indirect=True)
+def test_resume_restarts_when_the_size_changed(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    with pytest.raises(Exception):
+        download(cdn, dest, retries=0)
+
+    # No validator to go on, but a different bitrate is a different size.
+    cdn.payload = os.urandom(len(payload) - 5000)
+    download(cdn, dest)
+    assert read(dest) == cdn.payload
+    assert leftovers(tmp_path) == []
+
+
+def test_part_of_unknown_origin_is_not_resumed(cdn, payload, tmp_path):
+    dest = str(tmp_path / "track.flac")
+    with open(part_path(dest), "wb") as f:
+        f.write(b"x" * 100000)
+    assert not os.path.exists(info_path(part_path(dest)))
+
+    progress = download(cdn, dest)
+    assert read(dest) == payload
+    assert cdn.requests[0].get("Range") is None
+    assert max(progress) <= len(payload)
@@ -0,0 +1,233 @@
+import asyncio
+
+import pytest
+
+import rate_limit
+from rate_limit import (BASE_DELAY, THROTTLED, TRANSIENT, AdaptiveLimit, ProviderLimiter, TokenBucket,
+                        classify_error)
+
+
+class FakeClock:
+    # Stands in for the time module inside rate_limit: sleeping just moves the clock.
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+class Flaky:
+    # Fails with the given errors in turn, then succeeds.
+    def __init__(self, *errors: BaseException):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.mark.parametrize("error, kind", [
+    (HttpError(429), THROTTLED),
+    (HttpError(503), TRANSIENT),
+    (HttpError(408), TRANSIENT),
+    (HttpError(404), None),
+    (HttpError(401), None),
+    # yandex_music puts the status in the message.
+    (Exception("Too many requests (429): b'slow down'"), THROTTLED),
+    (Exception("Server error (500): b''"), TRANSIENT),
+    (Exception("Bad Gateway"), TRANSIENT),
+    (TimeoutError(), TRANSIENT),
+    (asyncio.TimeoutError(), TRANSIENT),
+    (ConnectionResetError(), TRANSIENT),
+    (ValueError("no such track"), None),
+])
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+
+def test_classify_error_follows_the_cause():
+    try:
+        try:
+            raise ConnectionResetError()
+        except ConnectionResetError as e:
+            raise RuntimeError("network error") from e
+    except RuntimeError as wrapped:
+        assert classify_error(wrapped) == TRANSIENT
+
+
+@pytest.mark.parametrize("attempt", range(6))
+def test_backoff_stays_within_bounds(clock, attempt):
+    limiter = ProviderLimiter("test", max_delay=10)
+    cap = min(10, BASE_DELAY * 2 ** attempt)
+    for _ in range(200):
+        assert cap / 2 <= limiter.backoff(attempt, TRANSIENT) <= cap
+        # Throttling backs off twice as far.
+        assert min(10, cap * 2) / 2 <= limiter.backoff(attempt, THROTTLED) <= min(10, cap * 2)
+
+
+def test_backoff_honours_retry_after_up_to_max_delay(clock):
+    limiter = ProviderLimiter("test", max_delay=10)
+    assert limiter.backoff(0, THROTTLED, retry_after=7) >= 7
+    assert limiter.backoff(0, THROTTLED, retry_after=600) == 10
+
+
+def test_throttling_pauses_everyone(clock):
+    limiter = ProviderLimiter("test", max_delay=10)
+    delay = limiter.backoff(0, THROTTLED, retry_after=5)
+    assert limiter.bucket.reserve() == pytest.approx(delay)
+    # Transient errors are the failing call's own business.
+    clock.advance(delay)
+    limiter.backoff(3, TRANSIENT)
+    assert limiter.bucket.reserve() == 0
+
+
+def test_token_bucket_spaces_out_calls(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    assert [bucket.reserve(), bucket.reserve()] == [0, 0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    clock.advance(10)
+    assert bucket.reserve() == 0
+
+
+def test_throttled_halves_the_concurrency(clock):
+    limit = AdaptiveLimit(8)
+    limit.on_failure(THROTTLED)
+    assert limit.current() == 4
+
+
+def test_transient_cuts_the_concurrency_less(clock):
+    limit = AdaptiveLimit(10)
+    limit.on_failure(TRANSIENT)
+    assert limit.current() == 8
+
+
+def test_parallel_failures_count_once(clock):
+    limit = AdaptiveLimit(8)
+    for _ in range(5):
+        limit.on_failure(THROTTLED)
+    assert limit.current() == 4
+    clock.advance(1)
+    limit.on_failure(THROTTLED)
+    assert limit.current() == 2
+
+
+def test_concurrency_never_drops_below_minimum(clock):
+    limit = AdaptiveLimit(8, minimum=2)
+    for _ in range(10):
+        limit.on_failure(THROTTLED)
+        clock.advance(1)
+    assert limit.current() == 2
+
+
+def test_concurrency_climbs_back_one_slot_per_window(clock):
+    limit = AdaptiveLimit(8, latency_aware=False)
+    limit.on_failure(THROTTLED)
+    assert limit.current() == 4
+    # A slot per limit's worth of healthy calls.
+    for _ in range(5):
+        limit.on_success(0.1)
+    assert limit.current() == 5
+    for _ in range(100):
+        limit.on_success(0.1)
+    assert limit.current() == 8
+
+
+def test_climbing_latency_backs_off(clock):
+    limit = AdaptiveLimit(10)
+    for _ in range(20):
+        limit.on_success(0.1)
+    assert limit.current() == 10
+    for _ in range(10):
+        limit.on_success(1.0)
+        clock.advance(1)
+    assert limit.current() < 10
+
+
+def test_fixed_limit_ignores_failures(clock):
+    limit = AdaptiveLimit(4, adaptive=False)
+    limit.on_failure(THROTTLED)
+    assert limit.current() == 4
+
+
+def test_call_retries_throttling_and_backs_off(clock):
+    limiter = ProviderLimiter("test", max_concurrency=8, retries=3, max_delay=30)
+    operation = Flaky(HttpError(429, retry_after=3))
+    assert limiter.call_blocking(operation, "test call") == "ok"
+    assert operation.calls == 2
+    assert limiter.concurrency.current() == 4
+    # Waited out Retry-After, before the retry and (through the paused bucket) before its slot.
+    assert clock.sleeps[0] >= 3
+
+
+def test_call_retries_transient_errors_until_they_pass(clock):
+    limiter = ProviderLimiter("test", retries=3)
+    operation = Flaky(HttpError(503), TimeoutError(), HttpError(502))
+    assert limiter.call_blocking(operation, "test call") == "ok"
+    assert operation.calls == 4
+    assert len(clock.sleeps) == 3
+    assert clock.sleeps[2] >= BASE_DELAY * 2 ** 2 / 2
+
+
+def test_call_gives_up_after_retries(clock):
+    limiter = ProviderLimiter("test", retries=2)
+    operation = Flaky(*[HttpError(503)] * 5)
+    with pytest.raises(HttpError):
+        limiter.call_blocking(operation, "test call")
+    assert operation.calls == 3
+
+
+def test_call_does_not_retry_what_retrying_cannot_fix(clock):
+    limiter = ProviderLimiter("test", max_concurrency=4, retries=3)
+    operation = Flaky(HttpError(404))
+    with pytest.raises(HttpError):
+        limiter.call_blocking(operation, "test call")
+    assert operation.calls == 1
+    assert clock.sleeps == []
+    # Says nothing about load either.
+    assert limiter.concurrency.current() == 4
+
+
+def test_async_call_retries_and_frees_its_slots(clock, monkeypatch):
+    async def no_wait(seconds):
+        clock.sleep(seconds)
+
+    monkeypatch.setattr(rate_limit.asyncio, "sleep", no_wait)
+    limiter = ProviderLimiter("test", max_concurrency=2, retries=3)
+    operation = Flaky(HttpError(429), HttpError(503))
+
+    async def attempt():
+        return operation()
+
+    assert asyncio.run(limiter.call(attempt, "test call")) == "ok"
+    assert operation.calls == 3
+    assert len(clock.sleeps) == 2
+    # Every attempt gave its slot back, failed or not.
+    assert limiter.in_flight == 0
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, Dict, List, Optional, Tuple
+
+from catalog import LibraryCatalog
+from converter import AudioConverter, needs_conversion, outputs_by_track
+from downloader import Downloader, safe_filename
+from metrics import Metrics
+from scheduler import DONE, FAILED, SKIPPED
+
+logger = logging.getLogger(__name__)
+
+# How long an idle worker's claim waits on the server for a job to turn up.
+CLAIM_WAIT = 25.0
+
+
+class ServerClient:
+    # Plain urllib, so a worker needs nothing beyond what the downloader itself needs.
+    def __init__(self, base_url: str, token: str = "", timeout: float = CLAIM_WAIT + 10):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, Optional[dict]]:
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        request = urllib.request.Request(f"{self.base_url}{path}", data=data, method=method)
+        request.add_header("Content-Type", "application/json")
+        if self.token:
+            request.add_header("Authorization", f"Bearer {self.token}")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                payload = response.read()
+                return response.status, json.loads(payload) if payload else None
+        except urllib.error.HTTPError as e:
+            payload = e.read()
+            try:
+                return e.code, json.loads(payload) if payload else None
+            except ValueError:
+                return e.code, None
+
+
+class DownloadHandler:
+    # The stock job handler: the same download, dedup and conversion the GUI and batch mode do,
+    # on this machine's disks. Anything with the same call signature can stand in for it.
+    def __init__(self, config: dict, token: Optional[str] = None):
+        self.config = config
+        self.metrics = Metrics()
+        self.catalog = LibraryCatalog(config["library_db"], [config["output_dir"], config["converted_dir"]],
+                                      metrics=self.metrics)
+        self.converter = AudioConverter(config, on_evict=self.catalog.remove_many, metrics=self.metrics,
+                                       on_retag=self.catalog.add_many)
+        self.downloader = Downloader(config, self.converter, library=self.catalog, metrics=self.metrics)
+        self.downloader.yandex_token = token or os.environ.get("YANDEX_MUSIC_TOKEN")
+        self.catalog.rescan()
+
+    def __call__(self, job: dict) -> dict:
+        url, output_formats = job["url"], job["output_formats"]
+        skipped: List[str] = []
+        lost: List[str] = []
+        if job["platform"] == "spotify":
+            files = self.downloader.download_spotify_track(url, on_skip=skipped.append, output_formats=output_formats,
+                                                           on_fail=lost.append)
+        elif job["platform"] == "yandex":
+            if not self.downloader.yandex_token:
+                return {"state": FAILED, "error": "This worker has no Yandex token (--token or YANDEX_MUSIC_TOKEN)"}
+            if output_formats and self.config["yandex_streaming"]:
+                # Converted on the way in, nothing left to do afterwards.
+                files = self.downloader.run_yandex_download(url, output_formats, on_skip=skipped.append,
+                                                            on_fail=lost.append)
+                self.converter.apply_replaygain(outputs_by_track(files))
+                return self.result(files, files, skipped, lost=lost)
+            files = self.downloader.run_yandex_download(url, on_skip=skipped.append, output_formats=output_formats,
+                                                        on_fail=lost.append)
+        else:
+            return {"state": FAILED, "error": f"Unknown platform: {job['platform']}"}
+
+        outputs: List[str] = []
+        album: Dict[str, List[str]] = {}
+        failed = 0
+        for path in files:
+            if not output_formats or not needs_conversion(path, output_formats):
+                outputs.append(path)
+                album[path] = [path]
+                continue
+            converted = self.converter.convert_to_formats(path, output_formats)
+            if len(converted) < len(set(output_formats)):
+                failed += 1
+            self.catalog.add_many(converted.values())
+            outputs.extend(converted.values())
+            album[path] = list(converted.values())
+        # The job's tracks are one album for ReplayGain.
+        self.converter.apply_replaygain(album)
+
+        return self.result(files, outputs, skipped, failed, lost)
+
+    @staticmethod
+    def result(files: List[str], outputs: List[str], skipped: List[str], failed: int = 0,
+               lost: Optional[List[str]] = None) -> dict:
+        # Tracks that didn't download don't fail the job when others did, but the error names them.
+        missing = f"{len(lost)} tracks failed to download: {', '.join(lost)}" if lost else None
+        if files and not failed:
+            return {"state": DONE, "files": outputs, "skipped": skipped, "error": missing}
+        if not files and skipped and not lost:
+            return {"state": SKIPPED, "files": [], "skipped": skipped}
+        error = f"{failed} of {len(files)} files failed to convert" if failed else missing or "Nothing was downloaded"
+        if failed and missing:
+            error += f"; {missing}"
+        return {"state": FAILED, "files": outputs, "skipped": skipped, "error": error}
+
+    def close(self):
+        self.downloader.close()
+        self.converter.close()
+        self.catalog.close()
+
+
+class JobWorker:
+    # Pulls jobs from a JobServer and runs them through handler, `threads` at a time. Workers
+    # share nothing but the server, so they scale across processes and machines alike.
+    def __init__(self, client: ServerClient, name: str, handler: Callable[[dict], dict], threads: int = 1,
+                 platforms: Optional[List[str]] = None):
+        self.client = client
+        self.name = name
+        self.handler = handler
+        self.threads = max(1, int(threads))
+        self.platforms = platforms
+        self.stopping = threading.Event()
+
+    def run(self):
+        logger.info(f"Worker {self.name} pulling jobs from {self.client.base_url}")
+        workers = [threading.Thread(target=self._loop, name=f"job-worker-{index}", daemon=True)
+                   for index in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in workers):
+                for thread in workers:
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            # Jobs in flight are abandoned; their leases run out and the server hands them to someone else.
+            logger.info(f"Worker {self.name} stopping")
+            self.stop()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _loop(self):
+        failures = 0
+        while not self.stopping.is_set():
+            try:
+                status, payload = self.client.request(
+                    "POST", "/claim", {"worker": self.name, "platforms": self.platforms, "wait_s": CLAIM_WAIT})
+                failures = 0
+            except (OSError, ValueError) as e:
+                # Server restarting or unreachable: keep trying, a little less eagerly each time.
+                failures += 1
+                delay = min(60, 2 ** failures)
+                logger.warning(f"Could not reach {self.client.base_url} ({e}), retrying in {delay}s")
+                self.stopping.wait(delay)
+                continue
+            if status == 204:
+                continue
+            if status != 200:
+                logger.error(f"Claim refused ({status}): {payload}")
+                self.stopping.wait(10)
+                continue
+            self._run_job(payload["job"], float(payload["lease_s"]))
+
+    def _heartbeat(self, job_id: int, lease_seconds: float, finished: threading.Event, lost: threading.Event):
+        while not finished.wait(lease_seconds / 3):
+            try:
+                status, payload = self.client.request("POST", f"/jobs/{job_id}/renew", {"worker": self.name})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not renew the lease on job {job_id}: {e}")
+                continue
+            if status == 409:
+                logger.warning(f"Job {job_id} was cancelled or given to another worker")
+                lost.set()
+                return
+
+    def _run_job(self, job: dict, lease_seconds: float):
+        logger.info(f"Worker {self.name} running job {job['id']}: {job['url']}")
+        finished = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job["id"], lease_seconds, finished, lost),
+                                     name=f"lease-{job['id']}", daemon=True)
+        heartbeat.start()
+        try:
+            result = self.handler(job)
+        except Exception as e:
+            logger.error(f"Job {job['id']} ({job['url']}) crashed: {e}", exc_info=True)
+            result = {"state": FAILED, "error": str(e)}
+        finally:
+            finished.set()
+            heartbeat.join()
+        if lost.is_set():
+            return
+
+        report: Dict = {"worker": self.name, "files": [], "skipped": [], "error": None}
+        report.update(result)
+        for attempt in range(5):
+            try:
+                status, payload = self.client.request("POST", f"/jobs/{job['id']}/complete", report)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not report job {job['id']} ({e}), retrying")
+                time.sleep(2 ** attempt)
+                continue
+            if status != 200:
+                logger.warning(f"Result for job {job['id']} not accepted ({status}): {payload}")
+            return
+        logger.error(f"Gave up reporting job {job['id']}; it will be retried once its lease runs out")
+
+
+def default_worker_name(index: Optional[int] = None) -> str:
+    host = socket.gethostname()
+    return f"{host}-{index}" if index is not None else f"{host}-{os.getpid()}"
+
+
+def run_worker(server_url: str, config: dict, name: str, token: Optional[str] = None,
+               server_token: Optional[str] = None) -> int:
+    handler = DownloadHandler(config, token)
+    try:
+        worker = JobWorker(
+            ServerClient(server_url, config["server_token"] if server_token is None else server_token),
+            name,
+            handler,
+            threads=config["worker_threads"]
+        )
+        worker.run()
+    finally:
+        handler.close()
+    return 0
+
+
+def worker_process(server_url: str, config: dict, name: str, token: Optional[str] = None):
+    # Entry point for the local workers --serve starts. Each one logs to its own file,
+    # rotating one file from several processes would mangle it.
+    from app import setup_logging
+    stem, extension = os.path.splitext(config["log_file"])
+    setup_logging({**config, "log_file": f"{stem}.{safe_filename(name)}{extension or '.log'}"}, logging.INFO)
+    try:
+        run_worker(server_url, config, name, token)
+    except KeyboardInterrupt:
+        pass